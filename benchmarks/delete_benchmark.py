@@ -0,0 +1,124 @@
+"""
+Thread deletion benchmark. Deletes threads of growing size through the API
+and reports the time until the deletion job has finished, the number of SQL
+statements and the peak Python memory use of the deletion, and the slowest
+write of a client that creates threads at the same time. The job deletes
+JOB_CHUNK_SIZE messages per transaction with database cascades, so memory
+use stays flat as the thread grows and other writes don't wait for the
+whole deletion.
+
+With --loaded the messages, reactions and media of the thread are instead
+loaded into the session and deleted in one transaction, which is what the
+ORM cascades used to do, for comparison.
+
+Usage:
+    python benchmarks/delete_benchmark.py [--sizes N,N,...] [--chunk-size N]
+        [--loaded]
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from sqlalchemy import event
+
+from src import jobs
+from src.app import create_app, db
+from src.models import Thread
+from src.utils import synthetic_database
+
+
+def _writer(app, stop, latencies):
+    client = app.test_client()
+    while not stop.is_set():
+        start = time.perf_counter()
+        client.post("/api/threads/", json={"title": "benchmark thread"})
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.01)
+
+
+def run_size(size, chunk_size, loaded):
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app(
+        {
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+            "JOB_CHUNK_SIZE": chunk_size,
+        }
+    )
+    with app.app_context():
+        db.create_all()
+        synthetic_database(
+            users=100,
+            threads=1,
+            messages_per_thread=size,
+            reaction_rate=0.5,
+            reply_depth=3,
+            seed=1,
+            batch_size=10000,
+        )
+
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        if threading.current_thread() is not writer:
+            statements.append(statement)
+
+    stop = threading.Event()
+    latencies = []
+    writer = threading.Thread(target=_writer, args=(app, stop, latencies))
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", count)
+        tracemalloc.start()
+        writer.start()
+        start = time.perf_counter()
+        if loaded:
+            thread = db.session.get(Thread, 1)
+            for message in thread.messages:
+                message.reactions, message.media
+            db.session.delete(thread)
+            db.session.commit()
+            status = 204
+        else:
+            status = app.test_client().delete("/api/threads/thread-1/").status_code
+            jobs.wait()
+        elapsed = time.perf_counter() - start
+        stop.set()
+        writer.join()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        event.remove(db.engine, "before_cursor_execute", count)
+        db.engine.dispose()
+
+    os.close(db_fd)
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(db_fname + suffix):
+            os.unlink(db_fname + suffix)
+    return status, elapsed, len(statements), peak, max(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--loaded", action="store_true")
+    args = parser.parse_args()
+
+    print(
+        f"{'messages':>10}{'status':>8}{'seconds':>10}{'statements':>12}"
+        f"{'peak MiB':>10}{'max write s':>13}"
+    )
+    for size in [int(size) for size in args.sizes.split(",")]:
+        status, elapsed, statements, peak, write = run_size(
+            size, args.chunk_size, args.loaded
+        )
+        print(
+            f"{size:>10}{status:>8}{elapsed:>10.3f}{statements:>12}"
+            f"{peak / 2**20:>10.1f}{write:>13.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
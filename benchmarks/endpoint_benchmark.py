@@ -0,0 +1,698 @@
+"""
+Endpoint benchmark that drives every route of the API with a reproducible
+load profile and reports latency percentiles, throughput and SQL statements
+per request.
+
+A scaled database is generated with the populate-db generator (or an
+existing one is reused with --database). Requests go through the WSGI app,
+or to a running server with --url, in which case the server must use the
+same database file and SQL statements can't be counted. The mix of reads
+and writes is drawn from a seeded random generator, hot threads getting
+most of the traffic, so the same arguments always send the same requests
+from each worker.
+
+Results can be saved as a JSON baseline and compared against one, for
+example before and after a change:
+    python benchmarks/endpoint_benchmark.py --save benchmarks/baselines/small.json
+    python benchmarks/endpoint_benchmark.py --compare benchmarks/baselines/small.json
+
+Usage:
+    python benchmarks/endpoint_benchmark.py [--users N] [--threads N]
+        [--messages-per-thread N] [--requests N] [--workers N] [--seed N]
+        [--database PATH] [--url URL] [--save PATH] [--compare PATH]
+        [--threshold FRACTION]
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import requests
+from sqlalchemy import event, select
+
+from src.app import create_app, db
+from src.models import Thread, Message, Reaction, User
+from src.utils import synthetic_database
+
+# Number of hot threads whose messages are targeted, and messages sampled
+# from each of them
+TARGET_THREADS = 200
+TARGET_MESSAGES = 100
+
+# Route name, URL rule it covers, method and weight in the load profile
+PROFILE = [
+    ("thread collection", "/api/threads/", "GET", 5),
+    ("thread item", "/api/threads/<thread:thread>/", "GET", 5),
+    ("thread put", "/api/threads/<thread:thread>/", "PUT", 1),
+    ("thread post", "/api/threads/", "POST", 1),
+    ("thread delete", "/api/threads/<thread:thread>/", "DELETE", 1),
+    ("thread export", "/api/threads/<thread:thread>/export/", "GET", 1),
+    ("thread events", "/api/threads/<thread:thread>/events/", "GET", 1),
+    ("job item", "/api/jobs/<job:job>/", "GET", 1),
+    ("reaction summary", "/api/threads/<thread:thread>/reactions/summary/", "GET", 3),
+    ("message collection", "/api/threads/<thread:thread>/messages/", "GET", 15),
+    ("message expanded", "/api/threads/<thread:thread>/messages/", "GET", 5),
+    ("message post", "/api/threads/<thread:thread>/messages/", "POST", 5),
+    ("message bulk", "/api/threads/<thread:thread>/messages/bulk/", "POST", 1),
+    ("message tree", "/api/threads/<thread:thread>/tree/", "GET", 2),
+    (
+        "message item",
+        "/api/threads/<thread:thread>/messages/<message:message>/",
+        "GET",
+        10,
+    ),
+    (
+        "message put",
+        "/api/threads/<thread:thread>/messages/<message:message>/",
+        "PUT",
+        2,
+    ),
+    (
+        "message delete",
+        "/api/threads/<thread:thread>/messages/<message:message>/",
+        "DELETE",
+        1,
+    ),
+    (
+        "message subtree",
+        "/api/threads/<thread:thread>/messages/<message:message>/subtree/",
+        "GET",
+        3,
+    ),
+    (
+        "reaction collection",
+        "/api/threads/<thread:thread>/messages/<message:message>/reactions/",
+        "GET",
+        5,
+    ),
+    (
+        "reaction post",
+        "/api/threads/<thread:thread>/messages/<message:message>/reactions/",
+        "POST",
+        2,
+    ),
+    (
+        "reaction item",
+        "/api/threads/<thread:thread>/messages/<message:message>/reactions/"
+        "<reaction:reaction>/",
+        "GET",
+        3,
+    ),
+    (
+        "reaction put",
+        "/api/threads/<thread:thread>/messages/<message:message>/reactions/"
+        "<reaction:reaction>/",
+        "PUT",
+        1,
+    ),
+    (
+        "reaction delete",
+        "/api/threads/<thread:thread>/messages/<message:message>/reactions/"
+        "<reaction:reaction>/",
+        "DELETE",
+        1,
+    ),
+    (
+        "media collection",
+        "/api/threads/<thread:thread>/messages/<message:message>/media/",
+        "GET",
+        2,
+    ),
+    (
+        "media post",
+        "/api/threads/<thread:thread>/messages/<message:message>/media/",
+        "POST",
+        1,
+    ),
+    (
+        "media item",
+        "/api/threads/<thread:thread>/messages/<message:message>/media/<media:media>/",
+        "GET",
+        2,
+    ),
+    (
+        "media put",
+        "/api/threads/<thread:thread>/messages/<message:message>/media/<media:media>/",
+        "PUT",
+        1,
+    ),
+    (
+        "media delete",
+        "/api/threads/<thread:thread>/messages/<message:message>/media/<media:media>/",
+        "DELETE",
+        1,
+    ),
+    ("search", "/api/search/", "GET", 3),
+    ("user collection", "/api/users/", "GET", 2),
+    ("user item", "/api/users/<user:user>/", "GET", 3),
+    ("user post", "/api/users/", "POST", 1),
+    ("user put", "/api/users/<user:user>/", "PUT", 1),
+    ("user delete", "/api/users/<user:user>/", "DELETE", 1),
+]
+
+# Statements executed by the current thread, counted by an engine event
+_statements = threading.local()
+
+
+def _count_statement(*args):
+    _statements.count = getattr(_statements, "count", 0) + 1
+
+
+class WsgiClient:
+    """
+    Sends the requests to the app in this process and counts the SQL
+    statements executed for each of them.
+    """
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, url, stream=False, **kwargs):
+        _statements.count = 0
+        resp = self.client.open(url, method=method, buffered=not stream, **kwargs)
+        if stream:
+            next(resp.iter_encoded())
+            resp.close()
+        location = urlsplit(resp.headers.get("Location", "")).path
+        return resp.status_code, location, resp.headers, _statements.count
+
+
+class HttpClient:
+    """
+    Sends the requests to a running server.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+
+    def request(self, method, url, stream=False, **kwargs):
+        resp = self.session.request(method, self.url + url, stream=stream, **kwargs)
+        if stream:
+            next(resp.iter_content(chunk_size=None))
+        resp.close()
+        location = urlsplit(resp.headers.get("Location", "")).path
+        return resp.status_code, location, resp.headers, None
+
+
+class Workload:
+    """
+    Picks the targets of the requests. Threads are picked by Zipf's law,
+    the hottest first, and messages from a sample of each thread. Rows
+    created by the benchmark are remembered, so that they can be updated
+    and deleted.
+    """
+
+    def __init__(self, app):
+        with app.app_context():
+            threads = db.session.execute(
+                select(Thread.id)
+                .order_by(Thread.message_count.desc(), Thread.id)
+                .limit(TARGET_THREADS)
+            )
+            self.threads = [thread_id for thread_id, in threads]
+            self.messages = {}
+            for thread_id in self.threads:
+                messages = db.session.execute(
+                    select(Message.message_id)
+                    .where(Message.thread_id == thread_id)
+                    .order_by(Message.timestamp)
+                    .limit(TARGET_MESSAGES)
+                )
+                self.messages[thread_id] = [message_id for message_id, in messages]
+            reactions = db.session.execute(
+                select(Message.thread_id, Reaction.message_id, Reaction.reaction_id)
+                .join(Message, Message.message_id == Reaction.message_id)
+                .where(Message.thread_id.in_(self.threads))
+                .limit(TARGET_THREADS * TARGET_MESSAGES)
+            )
+            self.reactions = [tuple(row) for row in reactions]
+            users = db.session.execute(
+                select(User.id, User.username).order_by(User.id).limit(1000)
+            )
+            self.users = [tuple(row) for row in users]
+        ranks = range(1, len(self.threads) + 1)
+        self.weights = list(itertools.accumulate(1 / rank for rank in ranks))
+        self.lock = threading.Lock()
+        self.created = {"thread": [], "message": [], "reaction": [], "media": []}
+        self.created["user"] = []
+        self.created["job"] = []
+        self.sequence = 0
+
+    def thread(self, rng):
+        return rng.choices(self.threads, cum_weights=self.weights)[0]
+
+    def message(self, rng):
+        thread_id = self.thread(rng)
+        return thread_id, rng.choice(self.messages[thread_id])
+
+    def remember(self, kind, item):
+        with self.lock:
+            self.created[kind].append(item)
+
+    def take(self, kind, rng):
+        with self.lock:
+            items = self.created[kind]
+            if items:
+                return items.pop(rng.randrange(len(items)))
+        return None
+
+    def peek(self, kind, rng):
+        with self.lock:
+            items = self.created[kind]
+            return rng.choice(items) if items else None
+
+    def unique(self):
+        with self.lock:
+            self.sequence += 1
+            return f"{os.getpid()}-{self.sequence}"
+
+
+def _message_doc(rng, work):
+    return {
+        "message_content": "benchmark message " + str(rng.random()),
+        "timestamp": datetime(2024, 1, 1).isoformat() + "+00:00",
+        "sender_id": rng.choice(work.users)[0],
+    }
+
+
+def _thread_url(thread_id):
+    return f"/api/threads/thread-{thread_id}/"
+
+
+def _message_url(thread_id, message_id):
+    return f"/api/threads/thread-{thread_id}/messages/message-{message_id}/"
+
+
+def _request(name, client, work, rng):
+    """
+    Sends one request of the named kind. Requests that need a row created
+    by the benchmark create it first when there is none, in which case the
+    creating request is measured instead.
+    :return: name of the measured request and the client's result
+    """
+    thread_id, message_id = work.message(rng)
+    thread_url = _thread_url(thread_id)
+    message_url = _message_url(thread_id, message_id)
+
+    if name == "thread collection":
+        return name, client.request("GET", "/api/threads/?include=title,counts")
+    if name == "thread item":
+        return name, client.request("GET", thread_url)
+    if name == "thread put":
+        return name, client.request("PUT", thread_url, json={"title": work.unique()})
+    if name == "thread post":
+        doc = {"title": work.unique()}
+        result = client.request("POST", "/api/threads/", json=doc)
+        if result[1]:
+            work.remember("thread", result[1])
+        return name, result
+    if name == "thread delete":
+        url = work.take("thread", rng)
+        if url is None:
+            return _request("thread post", client, work, rng)
+        result = client.request("DELETE", url)
+        if result[1]:
+            work.remember("job", result[1])
+        return name, result
+    if name == "job item":
+        url = work.peek("job", rng)
+        if url is None:
+            return _request("thread delete", client, work, rng)
+        return name, client.request("GET", url)
+    if name == "thread export":
+        # Exports of hot threads are too big to be a common request
+        thread_id = rng.choice(work.threads)
+        return name, client.request("GET", _thread_url(thread_id) + "export/")
+    if name == "thread events":
+        return name, client.request("GET", thread_url + "events/", stream=True)
+    if name == "reaction summary":
+        return name, client.request("GET", thread_url + "reactions/summary/")
+    if name == "message collection":
+        return name, client.request("GET", thread_url + "messages/?limit=50")
+    if name == "message expanded":
+        url = thread_url + "messages/?limit=50&expand=content,reaction_counts"
+        return name, client.request("GET", url)
+    if name == "message post":
+        result = client.request(
+            "POST", thread_url + "messages/", json=_message_doc(rng, work)
+        )
+        if result[1]:
+            work.remember("message", result[1])
+        return name, result
+    if name == "message bulk":
+        docs = [_message_doc(rng, work) for _ in range(100)]
+        return name, client.request("POST", thread_url + "messages/bulk/", json=docs)
+    if name == "message tree":
+        return name, client.request("GET", thread_url + "tree/?max_depth=2")
+    if name == "message item":
+        return name, client.request("GET", message_url)
+    if name == "message put":
+        doc = _message_doc(rng, work)
+        return name, client.request("PUT", message_url, json=doc)
+    if name == "message delete":
+        url = work.take("message", rng)
+        if url is None:
+            return _request("message post", client, work, rng)
+        return name, client.request("DELETE", url)
+    if name == "message subtree":
+        return name, client.request("GET", message_url + "subtree/?max_depth=3")
+    if name == "reaction collection":
+        return name, client.request("GET", message_url + "reactions/")
+    if name == "reaction post":
+        # A user can react to a message once, so every reaction has a new user
+        user_id = rng.choice(work.users)[0]
+        doc = {"reaction_type": 1, "user_id": user_id, "message_id": message_id}
+        result = client.request("POST", message_url + "reactions/", json=doc)
+        if result[1]:
+            work.remember("reaction", (result[1], user_id, message_id))
+        return name, result
+    if name == "reaction item":
+        thread_id, message_id, reaction_id = rng.choice(work.reactions)
+        url = _message_url(thread_id, message_id) + f"reactions/{reaction_id}/"
+        return name, client.request("GET", url)
+    if name in ("reaction put", "reaction delete"):
+        if name == "reaction put":
+            reaction = work.peek("reaction", rng)
+        else:
+            reaction = work.take("reaction", rng)
+        if reaction is None:
+            return _request("reaction post", client, work, rng)
+        url, user_id, message_id = reaction
+        if name == "reaction delete":
+            return name, client.request("DELETE", url)
+        doc = {"reaction_type": 2, "user_id": user_id, "message_id": message_id}
+        return name, client.request("PUT", url, json=doc)
+    if name == "media collection":
+        return name, client.request("GET", message_url + "media/")
+    if name == "media post":
+        doc = {"media_url": f"https://example.com/{work.unique()}.png"}
+        doc["message_id"] = message_id
+        result = client.request("POST", message_url + "media/", json=doc)
+        if result[1]:
+            work.remember("media", (result[1], message_id))
+        return name, result
+    if name in ("media item", "media put", "media delete"):
+        if name == "media delete":
+            media = work.take("media", rng)
+        else:
+            media = work.peek("media", rng)
+        if media is None:
+            return _request("media post", client, work, rng)
+        url, message_id = media
+        if name == "media item":
+            return name, client.request("GET", url)
+        if name == "media delete":
+            return name, client.request("DELETE", url)
+        doc = {"media_url": f"https://example.com/{work.unique()}.jpg"}
+        doc["message_id"] = message_id
+        return name, client.request("PUT", url, json=doc)
+    if name == "search":
+        return name, client.request("GET", "/api/search/?q=lorem+ipsum&limit=20")
+    if name == "user collection":
+        users = rng.sample(work.users, min(20, len(work.users)))
+        ids = ",".join(str(user_id) for user_id, _ in users)
+        return name, client.request("GET", f"/api/users/?ids={ids}")
+    if name == "user item":
+        username = rng.choice(work.users)[1]
+        return name, client.request("GET", f"/api/users/{username}/")
+    if name == "user post":
+        doc = {"username": f"b{work.unique()}"[:16], "password": "password"}
+        result = client.request("POST", "/api/users/", json=doc)
+        if result[1]:
+            work.remember("user", (result[1], result[2]["Api-key"]))
+        return name, result
+    if name in ("user put", "user delete"):
+        if name == "user put":
+            user = work.peek("user", rng)
+        else:
+            user = work.take("user", rng)
+        if user is None:
+            return _request("user post", client, work, rng)
+        url, key = user
+        headers = {"Api-key": key}
+        if name == "user delete":
+            result = client.request("DELETE", url, headers=headers)
+            if result[1]:
+                work.remember("job", result[1])
+            return name, result
+        doc = {"username": urlsplit(url).path.rstrip("/").split("/")[-1]}
+        doc["password"] = "changed"
+        return name, client.request("PUT", url, json=doc, headers=headers)
+    raise ValueError(f"Unknown request {name}")
+
+
+def _worker(client, work, seed, count, results):
+    rng = random.Random(seed)
+    names = [name for name, _, _, _ in PROFILE]
+    weights = [weight for _, _, _, weight in PROFILE]
+    for _ in range(count):
+        name = rng.choices(names, weights)[0]
+        start = time.perf_counter()
+        name, (status, _, _, statements) = _request(name, client, work, rng)
+        results.append((name, time.perf_counter() - start, status, statements))
+
+
+def check_coverage(app):
+    """
+    Returns the routes of the API that the load profile doesn't cover.
+    """
+    covered = {(rule, method) for _, rule, method, _ in PROFILE}
+    missing = []
+    for rule in app.url_map.iter_rules():
+        if not rule.endpoint.startswith("api."):
+            continue
+        for method in sorted(rule.methods - {"HEAD", "OPTIONS"}):
+            if (rule.rule, method) not in covered:
+                missing.append(f"{method} {rule.rule}")
+    return missing
+
+
+def _percentiles(seconds):
+    latencies = [value * 1000 for value in seconds]
+    if len(latencies) < 2:
+        latencies = latencies * 2
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "p50_ms": round(quantiles[49], 3),
+        "p95_ms": round(quantiles[94], 3),
+        "p99_ms": round(quantiles[98], 3),
+    }
+
+
+def summarize(results, duration):
+    routes = {}
+    for name, _, _, _ in PROFILE:
+        samples = [result for result in results if result[0] == name]
+        if not samples:
+            continue
+        statements = [sample[3] for sample in samples if sample[3] is not None]
+        routes[name] = {
+            "requests": len(samples),
+            "errors": sum(sample[2] >= 500 for sample in samples),
+            "client_errors": sum(400 <= sample[2] < 500 for sample in samples),
+            **_percentiles([sample[1] for sample in samples]),
+            "sql_per_request": (
+                round(statistics.mean(statements), 2) if statements else None
+            ),
+        }
+    total = {
+        "requests": len(results),
+        "throughput_rps": round(len(results) / duration, 1),
+        **_percentiles([result[1] for result in results]),
+    }
+    return routes, total
+
+
+def print_report(routes, total):
+    print(
+        f"{'route':<22}{'requests':>9}{'errors':>8}{'4xx':>6}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'SQL/req':>9}"
+    )
+    for name, route in routes.items():
+        sql = route["sql_per_request"]
+        print(
+            f"{name:<22}{route['requests']:>9}{route['errors']:>8}"
+            f"{route['client_errors']:>6}{route['p50_ms']:>9.2f}"
+            f"{route['p95_ms']:>9.2f}{route['p99_ms']:>9.2f}"
+            f"{'-' if sql is None else f'{sql:.1f}':>9}"
+        )
+    print(
+        f"\n{total['requests']} requests, {total['throughput_rps']} requests/s, "
+        f"p50 {total['p50_ms']:.2f} ms, p95 {total['p95_ms']:.2f} ms, "
+        f"p99 {total['p99_ms']:.2f} ms"
+    )
+
+
+def compare(baseline, routes, total, threshold):
+    """
+    Prints the changes from a baseline and returns the regressions: routes
+    whose p95 latency grew more than the threshold fraction, or that run
+    more SQL statements per request.
+    """
+    regressions = []
+    print(f"\n{'route':<22}{'p95 ms':>9}{'baseline':>10}{'change':>9}{'SQL/req':>17}")
+    for name, route in routes.items():
+        old = baseline["routes"].get(name)
+        if old is None:
+            continue
+        change = route["p95_ms"] / old["p95_ms"] - 1 if old["p95_ms"] else 0.0
+        sql, old_sql = route["sql_per_request"], old["sql_per_request"]
+        sql_text = "-" if sql is None or old_sql is None else f"{old_sql} -> {sql}"
+        print(
+            f"{name:<22}{route['p95_ms']:>9.2f}{old['p95_ms']:>10.2f}"
+            f"{change:>+9.0%}{sql_text:>17}"
+        )
+        if change > threshold:
+            regressions.append(f"{name}: p95 {change:+.0%}")
+        if sql is not None and old_sql is not None and sql > old_sql + 0.5:
+            regressions.append(f"{name}: {old_sql} -> {sql} SQL statements")
+    old_rps = baseline["total"]["throughput_rps"]
+    print(f"\nthroughput {total['throughput_rps']} requests/s, baseline {old_rps}")
+    return regressions
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--threads", type=int, default=200)
+    parser.add_argument("--messages-per-thread", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--database", help="database file, generated if missing")
+    parser.add_argument("--url", help="URL of a server that uses the database")
+    parser.add_argument("--save", help="file to save the results to as a baseline")
+    parser.add_argument("--compare", help="baseline file to compare the results to")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="p95 latency growth that counts as a regression",
+    )
+    args = parser.parse_args()
+
+    if args.database:
+        db_fname = os.path.abspath(args.database)
+        temporary = False
+    else:
+        db_fd, db_fname = tempfile.mkstemp()
+        os.close(db_fd)
+        temporary = True
+    generate = temporary or not os.path.exists(db_fname)
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname})
+    with app.app_context():
+        if generate:
+            start = time.perf_counter()
+            db.create_all()
+            created = synthetic_database(
+                args.users,
+                args.threads,
+                args.messages_per_thread,
+                reaction_rate=0.5,
+                reply_depth=5,
+                seed=args.seed,
+                batch_size=10000,
+            )
+            print(
+                "Generated {} users, {} threads, {} messages and {} reactions".format(
+                    *created
+                ),
+                f"in {time.perf_counter() - start:.1f} s",
+            )
+        event.listen(db.engine, "before_cursor_execute", _count_statement)
+
+    missing = check_coverage(app)
+    if missing:
+        print("Routes not in the load profile:", ", ".join(missing))
+
+    work = Workload(app)
+    results = []
+    count = args.requests // args.workers
+    workers = [
+        threading.Thread(
+            target=_worker,
+            args=(
+                HttpClient(args.url) if args.url else WsgiClient(app),
+                work,
+                args.seed * 1000 + index,
+                count,
+                results,
+            ),
+        )
+        for index in range(args.workers)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    duration = time.perf_counter() - start
+
+    with app.app_context():
+        db.engine.dispose()
+    if temporary:
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(db_fname + suffix):
+                os.unlink(db_fname + suffix)
+
+    routes, total = summarize(results, duration)
+    print_report(routes, total)
+    report = {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "target": args.url or "wsgi",
+        "config": {
+            key: getattr(args, key)
+            for key in (
+                "users",
+                "threads",
+                "messages_per_thread",
+                "requests",
+                "workers",
+                "seed",
+            )
+        },
+        "routes": routes,
+        "total": total,
+    }
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as file:
+            json.dump(report, file, indent=2)
+            file.write("\n")
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if baseline["config"] != report["config"]:
+            print("Warning: the baseline was run with a different configuration")
+        regressions = compare(baseline, routes, total, args.threshold)
+        if regressions:
+            print("Regressions:\n  " + "\n  ".join(regressions))
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
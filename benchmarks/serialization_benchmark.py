@@ -0,0 +1,70 @@
+"""
+Micro-benchmark of encoding large message collections with each installed
+JSON encoder of src.serialization, against json.dumps of messages whose
+timestamps were first converted with isoformat, as the resources used to do.
+
+Usage:
+    python benchmarks/serialization_benchmark.py [--sizes N,N,...] [--number N]
+"""
+
+import argparse
+import json
+import timeit
+from datetime import datetime, timedelta
+
+from src import serialization
+
+
+def _messages(count):
+    start = datetime(2024, 1, 1)
+    return [
+        {
+            "message_id": index,
+            "message_content": f"message {index} " + "lorem ipsum dolor " * 5,
+            "timestamp": start + timedelta(seconds=index),
+            "sender_id": index % 100,
+            "thread_ID": 1,
+            "parent_ID": index - 1 if index % 3 else None,
+        }
+        for index in range(count)
+    ]
+
+
+def _stdlib_isoformat(messages):
+    body = [
+        dict(message, timestamp=message["timestamp"].isoformat())
+        for message in messages
+    ]
+    return json.dumps(body).encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="100,1000,10000")
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+
+    encoders = ["json + isoformat"] + serialization.available_encoders()
+
+    print(f"{'messages':>10}  {'encoder':<18}{'ms':>10}{'MB/s':>10}{'speedup':>10}")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        messages = _messages(size)
+        baseline = None
+        for name in encoders:
+            if name == "json + isoformat":
+                encode = _stdlib_isoformat
+            else:
+                serialization.configure(name)
+                encode = serialization.dumps
+            length = len(encode(messages))
+            seconds = timeit.timeit(lambda: encode(messages), number=args.number)
+            seconds /= args.number
+            baseline = baseline or seconds
+            print(
+                f"{size:>10}  {name:<18}{seconds * 1000:>10.2f}"
+                f"{length / seconds / 1e6:>10.1f}{baseline / seconds:>9.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
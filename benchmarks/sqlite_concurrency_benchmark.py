@@ -0,0 +1,110 @@
+"""
+Concurrent read/write benchmark comparing SQLite's default rollback journal
+settings with the tuned pragma profile of create_app.
+
+Reader threads page through a thread's messages while writer threads post new
+messages to it, all through the WSGI app. Reports the throughput of both and
+the number of failed requests (for example "database is locked" errors).
+
+Usage:
+    python benchmarks/sqlite_concurrency_benchmark.py [--readers N] [--writers N]
+        [--duration SECONDS]
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from src.app import create_app, db
+from src.utils import sample_database
+
+PROFILES = {
+    "rollback journal": {
+        "SQLITE_PRAGMAS": {"journal_mode": "DELETE", "synchronous": "FULL"},
+    },
+    "tuned": {},
+}
+
+URL = "/api/threads/thread-1/messages/"
+
+
+def _message():
+    return {
+        "message_content": "benchmark message",
+        "timestamp": datetime.now().isoformat(),
+        "sender_id": 1,
+    }
+
+
+def _worker(app, write, stop, results):
+    client = app.test_client()
+    done = failed = 0
+    while not stop.is_set():
+        try:
+            if write:
+                resp = client.post(URL, json=_message())
+            else:
+                resp = client.get(URL + "?limit=50")
+            ok = resp.status_code < 500
+        except Exception:
+            ok = False
+        done += ok
+        failed += not ok
+    results.append((write, done, failed))
+
+
+def run_profile(config, readers, writers, duration):
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app(
+        {"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname, "TESTING": False, **config}
+    )
+    with app.app_context():
+        db.create_all()
+        sample_database()
+
+    stop = threading.Event()
+    results = []
+    threads = [
+        threading.Thread(target=_worker, args=(app, i < writers, stop, results))
+        for i in range(readers + writers)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    with app.app_context():
+        db.engine.dispose()
+    os.close(db_fd)
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(db_fname + suffix):
+            os.unlink(db_fname + suffix)
+
+    reads = sum(done for write, done, _ in results if not write)
+    writes = sum(done for write, done, _ in results if write)
+    failed = sum(failed for _, _, failed in results)
+    return reads / duration, writes / duration, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=5.0)
+    args = parser.parse_args()
+
+    print(f"{'profile':<20}{'reads/s':>10}{'writes/s':>10}{'failed':>8}")
+    for name, config in PROFILES.items():
+        reads, writes, failed = run_profile(
+            config, args.readers, args.writers, args.duration
+        )
+        print(f"{name:<20}{reads:>10.1f}{writes:>10.1f}{failed:>8}")
+
+
+if __name__ == "__main__":
+    main()
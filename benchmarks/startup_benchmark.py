@@ -0,0 +1,160 @@
+"""
+Startup benchmark. Measures, each in a fresh interpreter, the import time
+of src.app and the packages that take most of it (from python -X importtime),
+the wall time of the first and of later create_app calls, and the first
+request to the API documentation, which parses the documentation file.
+
+Results can be saved as a JSON baseline and compared against one:
+    python benchmarks/startup_benchmark.py --save benchmarks/baselines/startup.json
+    python benchmarks/startup_benchmark.py --compare benchmarks/baselines/startup.json
+
+Usage:
+    python benchmarks/startup_benchmark.py [--runs N] [--top N] [--save PATH]
+        [--compare PATH] [--threshold FRACTION]
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in a fresh interpreter, prints the timings in milliseconds as JSON
+TIMING_SCRIPT = """
+import json, time
+start = time.perf_counter()
+from src.app import create_app
+imported = time.perf_counter()
+config = {"SQLALCHEMY_DATABASE_URI": "sqlite://", "TESTING": True}
+app = create_app(config)
+created = time.perf_counter()
+for _ in range(5):
+    create_app(config)
+again = time.perf_counter()
+app.test_client().get("/apispec_1.json")
+docs = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "create_app_first_ms": (created - imported) * 1000,
+    "create_app_ms": (again - created) * 1000 / 5,
+    "first_docs_request_ms": (docs - again) * 1000,
+}))
+"""
+
+
+def _run(args):
+    return subprocess.run(
+        [sys.executable, *args],
+        cwd=ROOT,
+        env={**os.environ, "PYTHONPATH": ROOT},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def import_times():
+    """
+    Returns the total import time of src.app in milliseconds and the self
+    import time of each top-level package.
+    """
+    stderr = _run(["-X", "importtime", "-c", "import src.app"]).stderr
+    packages = defaultdict(float)
+    total = 0.0
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:") :].split("|")
+        packages[name.strip().split(".")[0]] += int(own) / 1000
+        if name.strip() == "src.app":
+            total = int(cumulative) / 1000
+    return total, dict(packages)
+
+
+def timings(runs):
+    """
+    Returns the median of each timing of TIMING_SCRIPT over the runs.
+    """
+    results = [json.loads(_run(["-c", TIMING_SCRIPT]).stdout) for _ in range(runs)]
+    return {
+        key: round(statistics.median(result[key] for result in results), 2)
+        for key in results[0]
+    }
+
+
+def compare(baseline, results, threshold):
+    """
+    Prints the changes from a baseline and returns the timings that grew
+    more than the threshold fraction.
+    """
+    regressions = []
+    print(f"\n{'timing':<24}{'ms':>9}{'baseline':>10}{'change':>9}")
+    for key, value in results.items():
+        old = baseline["timings"].get(key)
+        if not old:
+            continue
+        change = value / old - 1
+        print(f"{key:<24}{value:>9.2f}{old:>10.2f}{change:>+9.0%}")
+        if change > threshold:
+            regressions.append(f"{key}: {change:+.0%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--save", help="file to save the results to as a baseline")
+    parser.add_argument("--compare", help="baseline file to compare the results to")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="growth of a timing that counts as a regression",
+    )
+    args = parser.parse_args()
+
+    total, packages = import_times()
+    print(f"import src.app: {total:.1f} ms (python -X importtime)")
+    print(f"\n{'package':<24}{'self ms':>9}")
+    for name, own in sorted(packages.items(), key=lambda item: -item[1])[: args.top]:
+        print(f"{name:<24}{own:>9.1f}")
+
+    results = timings(args.runs)
+    print(f"\n{'timing':<24}{'ms':>9}   (median of {args.runs} runs)")
+    for key, value in results.items():
+        print(f"{key:<24}{value:>9.2f}")
+
+    report = {
+        "python": platform.python_version(),
+        "timings": results,
+        "import_packages_ms": {
+            name: round(own, 2)
+            for name, own in sorted(packages.items(), key=lambda item: -item[1])[
+                : args.top
+            ]
+        },
+    }
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(report, file, indent=2)
+            file.write("\n")
+        print(f"\nSaved the results to {args.save}")
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        regressions = compare(baseline, results, args.threshold)
+        if regressions:
+            print("Regressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
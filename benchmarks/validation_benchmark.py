@@ -0,0 +1,55 @@
+"""
+Micro-benchmark comparing the compiled validator registry against calling
+jsonschema.validate with a freshly built schema, as the resources used to do.
+
+Usage:
+    python benchmarks/validation_benchmark.py [--number N]
+"""
+
+import argparse
+import timeit
+from jsonschema import validate, Draft7Validator
+
+from src.models import Thread, Message, User, Reaction, Media
+from src.validation import compile_validators, validate_json
+
+DOCUMENTS = {
+    Thread: ({"title": "Thread title"}, None),
+    Message: (
+        {
+            "message_content": "message content",
+            "timestamp": "2023-01-01T00:00:00+00:00",
+            "sender_id": 1,
+            "parent_id": 1,
+        },
+        Draft7Validator.FORMAT_CHECKER,
+    ),
+    User: ({"username": "username", "password": "password"}, None),
+    Reaction: ({"reaction_type": 1, "user_id": 1, "message_id": 1}, None),
+    Media: ({"media_url": "https://example.com/image.png", "message_id": 1}, None),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    compile_validators()
+    print(f"{'model':<10}{'per-request (us)':>18}{'compiled (us)':>16}{'speedup':>10}")
+    for model, (doc, format_checker) in DOCUMENTS.items():
+        old = timeit.timeit(
+            lambda: validate(doc, model.json_schema(), format_checker=format_checker),
+            number=args.number,
+        )
+        new = timeit.timeit(lambda: validate_json(doc, model), number=args.number)
+        print(
+            f"{model.__name__:<10}"
+            f"{old / args.number * 1e6:>18.1f}"
+            f"{new / args.number * 1e6:>16.1f}"
+            f"{old / new:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
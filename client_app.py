@@ -1,5 +1,7 @@
 import re
+import time
 import requests
+from urllib.parse import urljoin
 from operator import itemgetter
 from datetime import datetime
 import pytz
@@ -14,20 +16,16 @@ def show_all_threads(session):
         and the next state
     """
     threads_collection_url = "/api/threads/"
-    resp = session.get(SERVER_URL + threads_collection_url)
+    resp = session.get(SERVER_URL + threads_collection_url + "?include=title,counts")
     body = resp.json()
     thread_ids = body["thread_ids"]
-    resp_headers = []
     if not thread_ids:
         print("No threads to show.")
-    else:
-        for thread_id in thread_ids:
-            resp = session.get(
-                SERVER_URL + threads_collection_url + f"thread-{thread_id}/"
-            )
-            resp_headers.append(resp.headers)
-    for headers in resp_headers:
-        print(f"{headers['thread_id']}.\t{headers['title']}")
+    for thread in body["threads"]:
+        print(
+            f"{thread['thread_id']}.\t{thread['title']}"
+            f" ({thread['message_count']} messages)"
+        )
     print("Open thread by typing a number.")
     print("Delete thread by typing 'delete' and number (example: 'delete 1').")
     while True:
@@ -38,10 +36,15 @@ def show_all_threads(session):
                 resp = session.delete(
                     SERVER_URL + threads_collection_url + f"thread-{num}/"
                 )
-                if resp.status_code != 204:
-                    print("Failed to delete thread")
-                else:
+                status = None
+                if resp.status_code == 202:
+                    status = wait_for_job(session, resp)
+                if status == "done":
                     print("Thread deleted successfully.")
+                elif status in ("pending", "running"):
+                    print("Thread is still being deleted.")
+                else:
+                    print("Failed to delete thread")
                 return resp, "all threads"
         else:
             try:
@@ -57,33 +60,52 @@ def show_all_threads(session):
     return resp, "thread view"
 
 
+def wait_for_job(session, resp, timeout=10):
+    """
+    Polls the background job that a request started until it has finished.
+    :param session: requests session to be used in the requests
+    :param resp: the 202 response with the job in the Location header
+    :param timeout: seconds to wait for the job
+    :return: status of the job: pending, running, done or failed
+    """
+    job_url = urljoin(SERVER_URL, resp.headers["Location"])
+    status = resp.json()["status"]
+    deadline = time.monotonic() + timeout
+    while status in ("pending", "running") and time.monotonic() < deadline:
+        time.sleep(0.2)
+        status = session.get(job_url).json()["status"]
+    return status
+
+
 def print_message(message):
     """
     Creates a printable string for a message.
     :param message: message that nees to be printed
     :return: printable string for the message
     """
-    id, content, timestamp, parent, reactions = itemgetter(
-        "id", "content", "timestamp", "parent", "reactions"
+    id, content, timestamp, parent, reactions, depth = itemgetter(
+        "id", "content", "timestamp", "parent", "reactions", "depth"
     )(message)
-    printed_message = f"Message: {id}, {timestamp}"
+    indent = "    " * depth
+    printed_message = f"{indent}Message: {id}, {timestamp}"
     printed_message += (
         f", reply to message {parent}, likes: {reactions}\n"
-        if parent != "None"
+        if parent is not None
         else f", likes: {reactions}\n"
     )
-    printed_message += content
+    printed_message += indent + content
     return printed_message
 
 
 def print_thread(thread_title, thread_id, messages):
     """
-    Prints all the messages in a thread ordered by timestamp.
+    Prints all the messages in a thread, replies indented under the
+    messages they reply to.
     :param thread_title: title of thread
     :param thread_id: id of thread
-    :param messages: list of messages to be printed (list of dictionaries)
+    :param messages: list of messages to be printed in reply tree order
+        (list of dictionaries)
     """
-    messages.sort(key=lambda x: x["timestamp"], reverse=False)
     printed_thread = f"Thread Title: {thread_title} Id: {thread_id}\n\n"
     for message in messages:
         printed_thread += f"{print_message(message)}\n\n"
@@ -104,37 +126,24 @@ def show_thread_view(session, thread):
     thread_title = thread.headers["title"]
     thread_id = thread.headers["thread_id"]
 
-    resp = session.get(
-        SERVER_URL + threads_coll_url + f"thread-{thread_id}" + messages_coll_url
-    )
-    body = resp.json()
-    message_ids = body["message_ids"]
+    resp = session.get(SERVER_URL + threads_coll_url + f"thread-{thread_id}/tree/")
     messages = []
-    for message_id in message_ids:
-        resp = session.get(
-            SERVER_URL
-            + threads_coll_url
-            + f"thread-{thread_id}/"
-            + messages_coll_url
-            + f"message-{message_id}/"
-        )
-        resp1 = session.get(
-            SERVER_URL
-            + threads_coll_url
-            + f"thread-{thread_id}/"
-            + messages_coll_url
-            + f"message-{message_id}/reactions/"
+    # Flatten the reply tree depth first, so that replies follow their parents
+    tree = list(reversed(resp.json()["messages"]))
+    while tree:
+        message = tree.pop()
+        messages.append(
+            {
+                "id": message["message_id"],
+                "content": message["message_content"],
+                "timestamp": message["timestamp"],
+                "parent": message["parent_id"],
+                "reactions": str(message["reaction_count"]),
+                "depth": message["depth"],
+            }
         )
-        reaction_amount = len(resp1.json()["reaction_ids"])
-        message = {
-            "id": message_id,
-            "content": resp.headers["message_content"],
-            "timestamp": resp.headers["timestamp"],
-            "parent": resp.headers["parent_id"],
-            "reactions": str(reaction_amount),
-        }
-
-        messages.append(message)
+        tree.extend(reversed(message["replies"]))
+    message_ids = [message["id"] for message in messages]
 
     print_thread(thread_title, thread_id, messages)
 
@@ -253,7 +262,7 @@ def reply_to_message(session, resp):
             user_id = ask_username(session)
             message_item = {
                 "message_content": message_content,
-                "timestamp": datetime.now(pytz.timezone('Europe/Helsinki')).isoformat(),
+                "timestamp": datetime.now(pytz.timezone("Europe/Helsinki")).isoformat(),
                 "sender_id": int(user_id),
                 "parent_id": int(parent_id),
             }
@@ -1,12 +1,27 @@
 from flask import Blueprint
 from flask_restful import Api
 from src.resources.user import UserItem, UserCollection
-from src.resources.reaction import ReactionItem, ReactionCollection
-from src.resources.thread import ThreadItem, ThreadCollection
-from src.resources.message import MessageItem, MessageCollection
+from src.resources.reaction import ReactionItem, ReactionCollection, ReactionSummary
+from src.resources.thread import (
+    ThreadItem,
+    ThreadCollection,
+    ThreadExport,
+    ThreadEvents,
+)
+from src.resources.message import (
+    MessageItem,
+    MessageCollection,
+    MessageBulk,
+    MessageTree,
+    MessageSubtree,
+)
 from src.resources.media import MediaCollection, MediaItem
+from src.resources.search import MessageSearch
+from src.resources.job import JobItem
+from src.resolver import resolve_url_values
 
 api_bp = Blueprint("api", __name__, url_prefix="/api")
+api_bp.url_value_preprocessor(resolve_url_values)
 api = Api(api_bp)
 
 api.add_resource(UserItem, "/users/<user:user>/")
@@ -19,9 +34,19 @@ api.add_resource(
     ReactionCollection, "/threads/<thread:thread>/messages/<message:message>/reactions/"
 )
 api.add_resource(ThreadCollection, "/threads/")
+api.add_resource(JobItem, "/jobs/<job:job>/")
+api.add_resource(MessageSearch, "/search/")
 api.add_resource(ThreadItem, "/threads/<thread:thread>/")
+api.add_resource(ThreadExport, "/threads/<thread:thread>/export/")
+api.add_resource(ThreadEvents, "/threads/<thread:thread>/events/")
+api.add_resource(ReactionSummary, "/threads/<thread:thread>/reactions/summary/")
 api.add_resource(MessageCollection, "/threads/<thread:thread>/messages/")
+api.add_resource(MessageBulk, "/threads/<thread:thread>/messages/bulk/")
+api.add_resource(MessageTree, "/threads/<thread:thread>/tree/")
 api.add_resource(MessageItem, "/threads/<thread:thread>/messages/<message:message>/")
+api.add_resource(
+    MessageSubtree, "/threads/<thread:thread>/messages/<message:message>/subtree/"
+)
 api.add_resource(
     MediaCollection, "/threads/<thread:thread>/messages/<message:message>/media/"
 )
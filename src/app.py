@@ -1,7 +1,6 @@
 import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from flasgger import Swagger
 
 db = SQLAlchemy()
 
@@ -14,6 +13,58 @@ def create_app(test_config=None):
         SQLALCHEMY_DATABASE_URI="sqlite:///"
         + os.path.join(app.instance_path, "development.db"),
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        # PRAGMA statements run on every new SQLite connection
+        SQLITE_PRAGMAS={
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "mmap_size": 256 * 1024 * 1024,
+            "cache_size": -64 * 1024,
+            "temp_store": "MEMORY",
+            "busy_timeout": 5000,
+        },
+        # Connection pool settings for file based SQLite databases
+        SQLITE_POOL_OPTIONS={"pool_size": 10, "max_overflow": 10, "pool_timeout": 10},
+        # Number of verified API keys cached in memory and their lifetime
+        # in seconds, 0 size disables the cache
+        API_KEY_CACHE_SIZE=1024,
+        API_KEY_CACHE_TTL=300,
+        # Number of recent events kept per thread for resuming event streams,
+        # number of threads whose events are kept and seconds between
+        # keepalive comments on idle streams
+        EVENT_BUFFER_SIZE=100,
+        EVENT_CHANNELS=1024,
+        EVENT_KEEPALIVE=15,
+        # Request profiling, off by default. A PROFILING_SAMPLE_RATE fraction
+        # of requests gets a Server-Timing header and a log line with its
+        # timings, and other requests slower than PROFILING_SLOW_MS
+        # milliseconds are logged with their wall time
+        PROFILING=False,
+        PROFILING_SAMPLE_RATE=0.01,
+        PROFILING_SLOW_MS=500,
+        PROFILING_SERVER_TIMING=True,
+        # Prometheus metrics at /metrics. With several worker processes
+        # METRICS_DIR must be set to a directory shared by the workers,
+        # where each one writes its metrics at most every
+        # METRICS_WRITE_INTERVAL seconds
+        METRICS=True,
+        METRICS_DIR=None,
+        METRICS_WRITE_INTERVAL=5,
+        # Background deletion of threads and users: rows deleted per
+        # transaction and seconds between the transactions. Writers waiting
+        # for the lock retry up to 100 ms apart, so a shorter pause can
+        # starve them.
+        JOB_CHUNK_SIZE=500,
+        JOB_CHUNK_DELAY=0.1,
+        # Seconds without progress after which a running job is considered
+        # abandoned by its worker and another worker may resume it
+        JOB_STALE_AFTER=60,
+        # API documentation at /apidocs/. The documentation file is read on
+        # the first request to it, and flasgger isn't imported if this is
+        # false.
+        API_DOCS=True,
+        # Encoder of JSON responses, exports and events: orjson, ujson, json
+        # or auto for the fastest one that is installed
+        JSON_ENCODER="auto",
     )
     app.config["SWAGGER"] = {
         "title": "Chat Platform API",
@@ -21,8 +72,6 @@ def create_app(test_config=None):
         "uiverion": 3,
     }
 
-    swagger = Swagger(app, template_file="../doc/documentation.yml")
-
     if test_config is None:
         # load the instance config, if it exists, when not testing
         app.config.from_pyfile("config.py", silent=True)
@@ -36,23 +85,69 @@ def create_app(test_config=None):
     except OSError:
         pass
 
+    if app.config["API_DOCS"]:
+        from src.docs import init_api_docs
+
+        init_api_docs(app)
+    _configure_sqlite_pool(app)
     db.init_app(app)
 
-    from src.models import init_db, populate_db
+    from src.models import init_db, populate_db, check_query_plans
+    from src.models import repair_counters_command, reindex_search_command
+    from src.models import set_sqlite_pragmas
+    from src.validation import compile_validators
+    from src import key_cache, events, profiling, metrics, jobs, serialization
     from src.resources.user import UserConverter
     from src.resources.reaction import ReactionConverter
     from src.resources.thread import ThreadConverter
     from src.resources.message import MessageConverter
     from src.resources.media import MediaConverter
+    from src.resources.job import JobConverter
     from . import api
 
+    with app.app_context():
+        set_sqlite_pragmas(db.engine, app.config["SQLITE_PRAGMAS"])
+    compile_validators()
+    key_cache.configure(
+        app.config["API_KEY_CACHE_SIZE"], app.config["API_KEY_CACHE_TTL"]
+    )
+    events.configure(app.config["EVENT_BUFFER_SIZE"], app.config["EVENT_CHANNELS"])
+    jobs.init_app(app)
+    serialization.configure(app.config["JSON_ENCODER"])
+    if app.config["PROFILING"]:
+        profiling.init_app(app)
+    if app.config["METRICS"]:
+        metrics.init_app(app)
     app.cli.add_command(init_db)
     app.cli.add_command(populate_db)
+    app.cli.add_command(check_query_plans)
+    app.cli.add_command(repair_counters_command)
+    app.cli.add_command(reindex_search_command)
     app.url_map.converters["user"] = UserConverter
     app.url_map.converters["reaction"] = ReactionConverter
     app.url_map.converters["thread"] = ThreadConverter
     app.url_map.converters["message"] = MessageConverter
     app.url_map.converters["media"] = MediaConverter
+    app.url_map.converters["job"] = JobConverter
     app.register_blueprint(api.api_bp)
 
     return app
+
+
+def _configure_sqlite_pool(app):
+    """
+    Adds the SQLITE_POOL_OPTIONS to the engine options when the app uses a
+    file based SQLite database, and a pool that records connection wait
+    times when metrics are enabled. In-memory databases use a static pool
+    that doesn't accept pool settings.
+    """
+    uri = app.config["SQLALCHEMY_DATABASE_URI"]
+    if not uri.startswith("sqlite") or uri.rstrip("/").endswith((":", ":memory:")):
+        return
+    options = app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+    for key, value in app.config["SQLITE_POOL_OPTIONS"].items():
+        options.setdefault(key, value)
+    if app.config["METRICS"]:
+        from src.metrics import TimedQueuePool
+
+        options.setdefault("poolclass", TimedQueuePool)
@@ -0,0 +1,31 @@
+from flasgger import Swagger
+
+
+class LazySwagger(Swagger):
+    """
+    Swagger that reads its template file on the first request to the API
+    documentation instead of when the app is created. Parsing the YAML
+    file takes longer than the rest of create_app.
+    """
+
+    def init_app(self, app, decorators=None):
+        # Swagger.init_app reads the template file right away
+        self._lazy_file, self.template_file = self.template_file, None
+        super().init_app(app, decorators)
+
+    @property
+    def template(self):
+        if self._template is None and getattr(self, "_lazy_file", None):
+            self._template = self.load_swagger_file(self._lazy_file)
+        return self._template
+
+    @template.setter
+    def template(self, value):
+        self._template = value
+
+
+def init_api_docs(app):
+    """
+    Adds the API documentation at /apidocs/ to an app.
+    """
+    LazySwagger(app, template_file="../doc/documentation.yml")
@@ -0,0 +1,253 @@
+import threading
+from collections import OrderedDict, deque
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from src.versioning import row_changed, foreign_key_values
+from src.serialization import dumps
+
+# Channels of the threads that have had events or subscribers recently,
+# in least recently used order
+_channels = OrderedDict()
+_settings = {"buffer_size": 100, "channels": 1024}
+# Id of the latest published event, and the id of the latest event of any
+# evicted channel. A new channel can't know if it missed events up to it.
+_last_id = [0]
+_evicted_id = [0]
+_lock = threading.Lock()
+
+
+class _Channel:
+    """
+    Recent events of one thread and the condition its subscribers wait on.
+    """
+
+    def __init__(self, trimmed_id, buffer_size):
+        self.events = deque(maxlen=buffer_size)
+        # Id of the latest event that is no longer in the buffer
+        self.trimmed_id = trimmed_id
+        self.subscribers = 0
+        self.condition = threading.Condition(_lock)
+
+
+def configure(buffer_size, channels):
+    """
+    Sets the number of events kept per thread for resuming streams and the
+    number of threads whose events are kept, and empties the buffers.
+    Called when the app is created.
+    :param buffer_size: number of recent events kept per thread
+    :param channels: number of threads whose recent events are kept
+    """
+    with _lock:
+        _settings["buffer_size"] = buffer_size
+        _settings["channels"] = channels
+        for channel in _channels.values():
+            channel.condition.notify_all()
+        _channels.clear()
+        _evicted_id[0] = _last_id[0]
+
+
+def _channel(thread_id):
+    """
+    Returns the channel of a thread, creating it if needed and evicting
+    the least recently used channels without subscribers. Must be called
+    with the lock held.
+    """
+    channel = _channels.get(thread_id)
+    if channel is None:
+        channel = _channels[thread_id] = _Channel(
+            _evicted_id[0], _settings["buffer_size"]
+        )
+    _channels.move_to_end(thread_id)
+    idle = [key for key, value in _channels.items() if not value.subscribers]
+    for key in idle[: max(len(_channels) - _settings["channels"], 0)]:
+        evicted = _channels.pop(key)
+        if evicted.events:
+            _evicted_id[0] = max(_evicted_id[0], evicted.events[-1][0])
+        _evicted_id[0] = max(_evicted_id[0], evicted.trimmed_id)
+    return channel
+
+
+def publish(events):
+    """
+    Gives ids to committed events and wakes up the subscribers of their
+    threads.
+    :param events: list of (thread id, event type, data) tuples
+    """
+    with _lock:
+        for thread_id, event_type, data in events:
+            _last_id[0] += 1
+            channel = _channel(thread_id)
+            if len(channel.events) == channel.events.maxlen:
+                channel.trimmed_id = channel.events[0][0]
+            channel.events.append((_last_id[0], event_type, data))
+            channel.condition.notify_all()
+
+
+def format_event(event_id, event_type, data):
+    """
+    Formats an event as a Server-Sent Events message.
+    """
+    return f"id: {event_id}\nevent: {event_type}\ndata: {dumps(data).decode()}\n\n"
+
+
+def current_event_id():
+    """
+    Returns the id of the latest published event. A stream that starts
+    from it only gets new events.
+    """
+    with _lock:
+        return _last_id[0]
+
+
+def subscribe(thread_id, last_event_id, keepalive=15.0):
+    """
+    Streams the events of a thread after the given event id as Server-Sent
+    Events messages, starting with the buffered ones. If some of them are
+    no longer buffered, or the id is from before a restart, a reset event
+    tells the client to fetch the thread again.
+    :param thread_id: id of the thread
+    :param last_event_id: id of the last event the client received
+    :param keepalive: seconds between comments sent to idle connections
+    :return: generator of the messages
+    """
+    with _lock:
+        channel = _channel(thread_id)
+        channel.subscribers += 1
+        if last_event_id > _last_id[0] or last_event_id < channel.trimmed_id:
+            last_id = None
+        else:
+            last_id = last_event_id
+    try:
+        if last_id is None:
+            last_id = _last_id[0]
+            yield format_event(last_id, "reset", {"thread_id": thread_id})
+        else:
+            # Sent right away, so that the client and any proxies see the
+            # stream open before the first event
+            yield ": connected\n\n"
+        while True:
+            with _lock:
+                pending = [item for item in channel.events if item[0] > last_id]
+                if not pending:
+                    channel.condition.wait(keepalive)
+                    pending = [item for item in channel.events if item[0] > last_id]
+            if not pending:
+                yield ": keepalive\n\n"
+            for event_id, event_type, data in pending:
+                last_id = event_id
+                yield format_event(event_id, event_type, data)
+    finally:
+        with _lock:
+            channel.subscribers -= 1
+
+
+def _thread_ids(session, message_ids):
+    """
+    Returns the thread ids of the given messages by message id.
+    """
+    from src.models import Message
+
+    if not message_ids:
+        return {}
+    rows = session.connection().execute(
+        select(Message.message_id, Message.thread_id).where(
+            Message.message_id.in_(message_ids)
+        )
+    )
+    return dict(rows.all())
+
+
+def _pending(session):
+    """
+    Returns the list of events of the current transaction of a session.
+    """
+    return session.info.setdefault("pending_events", [])
+
+
+def queue_event(session, thread_id, event_type, data):
+    """
+    Adds an event that is published when the transaction of the session is
+    committed. Changes that bypass the session, such as bulk inserts, must
+    call this themselves.
+    :param session: session of the transaction that made the change
+    :param thread_id: id of the thread the event is sent to
+    :param event_type: type of the event, such as message.created
+    :param data: JSON serializable data of the event
+    """
+    _pending(session).append((thread_id, event_type, data))
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_events(session, flush_context):
+    """
+    Creates the events of the messages, reactions and media that the flush
+    added, updated or deleted. Events of reactions and media go to the
+    thread of their message.
+    """
+    from src.models import Message, Reaction, Media
+
+    kinds = {Message: "message", Reaction: "reaction", Media: "media"}
+    changes = [(obj, "created") for obj in session.new]
+    changes += [(obj, "updated") for obj in session.dirty if row_changed(obj)]
+    changes += [(obj, "deleted") for obj in session.deleted]
+    changes = [(obj, action) for obj, action in changes if type(obj) in kinds]
+    if not changes:
+        return
+
+    deleted_threads = {}
+    message_ids = set()
+    for obj, action in changes:
+        if isinstance(obj, Message):
+            if action == "deleted":
+                deleted_threads[obj.message_id] = obj.thread_id
+        else:
+            message_ids.update(foreign_key_values(obj, "message_id", "message"))
+            message_ids.add(obj.message_id)
+    message_ids.discard(None)
+    threads = _thread_ids(session, message_ids)
+    # Messages deleted in the same flush are no longer in the table
+    threads = {**deleted_threads, **threads}
+
+    for obj, action in changes:
+        kind = kinds[type(obj)]
+        if isinstance(obj, Message):
+            current = obj.thread_id
+            thread_ids = foreign_key_values(obj, "thread_id", "thread")
+            data = {"message_id": obj.message_id, "thread_id": current}
+        else:
+            current = threads.get(obj.message_id)
+            message_ids = foreign_key_values(obj, "message_id", "message")
+            thread_ids = {threads.get(message_id) for message_id in message_ids}
+            data = {
+                f"{kind}_id": getattr(obj, f"{kind}_id"),
+                "message_id": obj.message_id,
+            }
+        if action != "deleted":
+            data = obj.serialize()
+        thread_ids = (thread_ids | {current}) - {None}
+        for thread_id in thread_ids:
+            # A message moved to another thread is deleted from the stream
+            # of the old thread, if the old thread was loaded
+            moved = action == "updated" and thread_id != current
+            queue_event(
+                session, thread_id, f"{kind}.{'deleted' if moved else action}", data
+            )
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_events(session):
+    """
+    Publishes the events of the committed transaction.
+    """
+    events = session.info.pop("pending_events", None)
+    if events:
+        publish(events)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_events(session):
+    """
+    Discards the events of the rolled back transaction.
+    """
+    session.info.pop("pending_events", None)
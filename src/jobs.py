@@ -0,0 +1,231 @@
+import os
+import time
+import socket
+import logging
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from sqlalchemy import update, or_, and_
+from sqlalchemy.exc import OperationalError
+
+from src.app import db
+
+logger = logging.getLogger(__name__)
+
+# Jobs run one at a time, since SQLite has one writer at a time anyway
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jobs")
+
+
+class ClaimLost(Exception):
+    """
+    Raised when another worker has taken over a job that had gone stale.
+    """
+
+
+def _owner():
+    """
+    Returns the name of this worker process. Read on every claim, since the
+    process may have been forked after the module was imported.
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _claimable():
+    """
+    Returns the condition of the jobs that can be claimed: pending jobs and
+    running jobs whose worker hasn't reported progress for JOB_STALE_AFTER
+    seconds.
+    """
+    from src.models import Job
+
+    stale = datetime.now() - timedelta(seconds=current_app.config["JOB_STALE_AFTER"])
+    return or_(
+        Job.status == "pending",
+        and_(
+            Job.status == "running",
+            or_(Job.heartbeat_at.is_(None), Job.heartbeat_at < stale),
+        ),
+    )
+
+
+def init_app(app):
+    """
+    Makes the first request of an app resume the jobs that were left
+    unfinished when the server was stopped. Every worker process does this,
+    but a job is run only by the worker that claims it. Deletions are
+    idempotent, so a job that was interrupted in the middle can be run again.
+    """
+    resumed = []
+
+    @app.before_request
+    def _resume_jobs():
+        if resumed:
+            return
+        resumed.append(True)
+        from src.models import Job
+
+        try:
+            unfinished = db.session.scalars(db.select(Job.id).where(_claimable())).all()
+        except OperationalError:
+            # The database hasn't been initialized yet
+            db.session.rollback()
+            return
+        for job_id in unfinished:
+            submit(job_id)
+
+
+def create_job(kind, target_id):
+    """
+    Creates a job in the current session and returns it, or returns the
+    unfinished job that already does the same thing. The job must be
+    committed before it is given to submit.
+    :param kind: kind of the job, one of JOB_KINDS
+    :param target_id: id of the thread or user the job works on
+    :return: the job and whether it was created
+    """
+    from src.models import Job
+
+    job = db.session.scalars(
+        db.select(Job).where(
+            Job.kind == kind,
+            Job.target_id == target_id,
+            Job.status.in_(("pending", "running")),
+        )
+    ).first()
+    if job is not None:
+        return job, False
+    job = Job(kind=kind, target_id=target_id)
+    db.session.add(job)
+    return job, True
+
+
+def submit(job_id):
+    """
+    Runs a committed job in the background, unless another worker has
+    already claimed it.
+    :param job_id: id of the job
+    """
+    _executor.submit(_run, current_app._get_current_object(), job_id)
+
+
+def wait():
+    """
+    Waits until the jobs submitted so far have finished.
+    """
+    _executor.submit(lambda: None).result()
+
+
+def _claim(job_id):
+    """
+    Marks a job running by this worker in one UPDATE, so that only one of
+    the workers that try to claim the same job succeeds.
+    :param job_id: id of the job
+    :return: whether this worker claimed the job
+    """
+    from src.models import Job
+
+    result = db.session.execute(
+        update(Job)
+        .where(Job.id == job_id, _claimable())
+        .values(status="running", owner=_owner(), heartbeat_at=datetime.now())
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def _heartbeat(job):
+    """
+    Records the progress of a job in the current transaction. Raises
+    ClaimLost if another worker has taken over the job in the meantime.
+    """
+    from src.models import Job
+
+    result = db.session.execute(
+        update(Job)
+        .where(Job.id == job.id, Job.owner == _owner(), Job.status == "running")
+        .values(heartbeat_at=datetime.now())
+    )
+    if result.rowcount != 1:
+        raise ClaimLost(f"Job {job.id} was taken over by another worker")
+
+
+def _run(app, job_id):
+    """
+    Claims a job and runs it in its own app context and records its result.
+    """
+    from src.models import Job
+
+    with app.app_context():
+        if not _claim(job_id):
+            return
+        job = db.session.get(Job, job_id)
+        try:
+            JOB_KINDS[job.kind](job)
+            _heartbeat(job)
+        except ClaimLost:
+            logger.warning("Job %s was taken over by another worker", job_id)
+            db.session.rollback()
+            return
+        except Exception as exc:
+            logger.exception("Job %s failed", job_id)
+            db.session.rollback()
+            job.status = "failed"
+            job.error = str(exc)[:500]
+        else:
+            job.status = "done"
+        job.finished_at = datetime.now()
+        db.session.commit()
+
+
+def _delete_thread(job):
+    """
+    Deletes a thread a chunk of messages at a time, each chunk in its own
+    transaction, so that other writers get the database between them. The
+    thread itself is deleted in the same transaction that finishes the job.
+    """
+    from src.models import Thread
+    from src.utils import delete_thread, delete_thread_messages
+
+    while True:
+        deleted = delete_thread_messages(
+            job.target_id, current_app.config["JOB_CHUNK_SIZE"]
+        )
+        if not deleted:
+            break
+        job.deleted_rows += deleted
+        _heartbeat(job)
+        db.session.commit()
+        time.sleep(current_app.config["JOB_CHUNK_DELAY"])
+    thread = db.session.get(Thread, job.target_id)
+    if thread is not None:
+        delete_thread(thread)
+        job.deleted_rows += 1
+
+
+def _delete_user(job):
+    """
+    Deletes a user a chunk of reactions or messages at a time like
+    _delete_thread.
+    """
+    from src.models import User
+    from src.utils import delete_user, delete_user_rows
+
+    thread_ids = set()
+    while True:
+        deleted, chunk_threads = delete_user_rows(
+            job.target_id, current_app.config["JOB_CHUNK_SIZE"]
+        )
+        if not deleted:
+            break
+        thread_ids |= chunk_threads
+        job.deleted_rows += deleted
+        _heartbeat(job)
+        db.session.commit()
+        time.sleep(current_app.config["JOB_CHUNK_DELAY"])
+    user = db.session.get(User, job.target_id)
+    if user is not None:
+        delete_user(user, thread_ids)
+        job.deleted_rows += 1
+
+
+JOB_KINDS = {"delete-thread": _delete_thread, "delete-user": _delete_user}
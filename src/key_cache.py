@@ -0,0 +1,159 @@
+import time
+import threading
+from collections import OrderedDict
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from src.versioning import row_changed
+
+# Verified (username, key hash) pairs mapped to the user id, the row version
+# of the user and the expiry time, in least recently used order
+_cache = OrderedDict()
+_settings = {"size": 1024, "ttl": 300.0}
+_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+# Incremented on every invalidation, so that a lookup that started before
+# a key was changed doesn't add the old key back to the cache
+_generation = [0]
+_lock = threading.Lock()
+
+
+def configure(size, ttl):
+    """
+    Sets the size and time to live of the cache and empties it.
+    Called when the app is created.
+    :param size: maximum number of cached keys, 0 disables the cache
+    :param ttl: seconds a verified key is kept in the cache
+    """
+    with _lock:
+        _settings["size"] = size
+        _settings["ttl"] = ttl
+        _cache.clear()
+        _generation[0] += 1
+
+
+def generation():
+    """
+    Returns the current invalidation generation. Pass it to store so that
+    a key verified from the database is only cached if it wasn't changed
+    during the lookup.
+    """
+    with _lock:
+        return _generation[0]
+
+
+def lookup(username, key_hash, user_id, version):
+    """
+    Checks if the key of a user has been verified recently. Changing the
+    user or its key in any process increments the row version of the user,
+    so a key that was cached before the change doesn't match.
+    :param username: username of the user
+    :param key_hash: hash of the API key from the request
+    :param user_id: id of the user, must match the cached user
+    :param version: current row version of the user, must match the cached one
+    :return: True if the key is cached, False if the database must be checked
+    """
+    with _lock:
+        entry = _cache.get((username, key_hash))
+        if entry is not None:
+            cached_id, cached_version, expires = entry
+            if (cached_id, cached_version) == (
+                user_id,
+                version,
+            ) and expires > time.monotonic():
+                _cache.move_to_end((username, key_hash))
+                _stats["hits"] += 1
+                return True
+            del _cache[(username, key_hash)]
+        _stats["misses"] += 1
+        return False
+
+
+def store(username, key_hash, user_id, version, since):
+    """
+    Adds a key verified from the database to the cache.
+    :param username: username of the user
+    :param key_hash: hash of the verified API key
+    :param user_id: id of the user
+    :param version: row version of the user the key was verified for
+    :param since: generation returned before the database lookup
+    """
+    with _lock:
+        if _settings["size"] <= 0 or since != _generation[0]:
+            return
+        expires = time.monotonic() + _settings["ttl"]
+        _cache[(username, key_hash)] = (user_id, version, expires)
+        _cache.move_to_end((username, key_hash))
+        while len(_cache) > _settings["size"]:
+            _cache.popitem(last=False)
+
+
+def invalidate(user_ids):
+    """
+    Removes the cached keys of the given users.
+    :param user_ids: ids of the users whose keys are removed
+    """
+    with _lock:
+        _generation[0] += 1
+        stale = [key for key, entry in _cache.items() if entry[0] in user_ids]
+        for key in stale:
+            del _cache[key]
+        _stats["invalidations"] += 1
+
+
+def key_cache_stats():
+    """
+    Returns the number of cache hits, misses and invalidations and the
+    current number of cached keys.
+    """
+    with _lock:
+        return dict(_stats, size=len(_cache))
+
+
+@event.listens_for(Session, "before_flush")
+def _bump_key_owner_versions(session, flush_context, instances):
+    """
+    Increments the row version of the users whose API key is added, changed
+    or deleted, which invalidates their cached keys in every process.
+    Changes to the user row itself increment it in src.versioning.
+    """
+    from src.models import User, ApiKey
+
+    owners = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, ApiKey):
+            state = inspect(obj)
+            owners.update(state.attrs.user_id.history.sum())
+            owners.update(
+                user.id for user in state.attrs.user.history.sum() if user is not None
+            )
+    owners.discard(None)
+    for user_id in owners:
+        user = session.get(User, user_id)
+        if user is not None and user not in session.deleted:
+            user.version = User.version + 1
+
+
+@event.listens_for(Session, "after_flush")
+def _invalidate_changed_keys(session, flush_context):
+    """
+    Invalidates the cached keys of users that were updated or deleted, and
+    of users whose API key was added, changed or deleted in the flush.
+    """
+    from src.models import User, ApiKey
+
+    user_ids = set()
+    for obj in session.deleted:
+        if isinstance(obj, (User, ApiKey)):
+            user_ids.add(obj.id if isinstance(obj, User) else obj.user_id)
+    for obj in session.dirty:
+        if isinstance(obj, User) and row_changed(obj):
+            user_ids.add(obj.id)
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, ApiKey):
+            history = inspect(obj).attrs.user_id.history
+            user_ids.update(history.added or ())
+            user_ids.update(history.deleted or ())
+            user_ids.add(obj.user_id)
+    user_ids.discard(None)
+    if user_ids:
+        invalidate(user_ids)
@@ -0,0 +1,324 @@
+import os
+import re
+import json
+import time
+import atexit
+import bisect
+import threading
+from flask import Response, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+from src.key_cache import key_cache_stats
+
+# Upper bounds of the histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CHECKOUT_BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Metrics of this process. Counters map label values to counts, histograms
+# map label values to bucket counts followed by the sum and the count.
+_counters = {"http_requests_total": {}, "sqlite_busy_errors_total": {}}
+_histograms = {
+    "http_request_duration_seconds": {},
+    "db_pool_checkout_wait_seconds": {},
+}
+_gauges = {"http_requests_in_flight": {(): 0}}
+_buckets = {
+    "http_request_duration_seconds": LATENCY_BUCKETS,
+    "db_pool_checkout_wait_seconds": CHECKOUT_BUCKETS,
+}
+_labels = {
+    "http_requests_total": ("route", "method", "status"),
+    "sqlite_busy_errors_total": (),
+    "http_request_duration_seconds": ("route", "method"),
+    "db_pool_checkout_wait_seconds": (),
+    "http_requests_in_flight": (),
+    "api_key_cache_hits_total": (),
+    "api_key_cache_misses_total": (),
+    "api_key_cache_invalidations_total": (),
+    "api_key_cache_size": (),
+}
+_help = {
+    "http_requests_total": "Number of handled requests.",
+    "sqlite_busy_errors_total": (
+        "Number of statements that failed because the database stayed locked "
+        "for longer than the busy timeout."
+    ),
+    "http_request_duration_seconds": "Time spent handling requests.",
+    "db_pool_checkout_wait_seconds": (
+        "Time spent waiting for a database connection from the pool."
+    ),
+    "http_requests_in_flight": "Number of requests being handled.",
+    "api_key_cache_hits_total": "Number of API keys found in the key cache.",
+    "api_key_cache_misses_total": (
+        "Number of API keys that had to be checked from the database."
+    ),
+    "api_key_cache_invalidations_total": (
+        "Number of times changed users or keys were removed from the key cache."
+    ),
+    "api_key_cache_size": "Number of API keys in the key cache.",
+}
+_settings = {"directory": None, "interval": 5.0, "next_write": 0.0}
+_lock = threading.Lock()
+
+
+def configure(directory, interval):
+    """
+    Sets the directory shared by the processes of the server and how often
+    this process writes its metrics there. Called when the app is created.
+    :param directory: path of the directory, None for a single process
+    :param interval: minimum number of seconds between writes
+    """
+    with _lock:
+        _settings["directory"] = directory
+        _settings["interval"] = interval
+        _settings["next_write"] = 0.0
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+
+def init_app(app):
+    """
+    Adds the request metric hooks and the /metrics endpoint to an app.
+    With METRICS_DIR set, every process writes its metrics to a file in the
+    directory at most every METRICS_WRITE_INTERVAL seconds, and /metrics
+    returns the sum of the metrics of all processes, so that it works with
+    several worker processes. The directory must be emptied when the
+    server is restarted.
+    """
+    configure(app.config["METRICS_DIR"], app.config["METRICS_WRITE_INTERVAL"])
+
+    @app.before_request
+    def _start_request():
+        request.environ["metrics.start"] = time.perf_counter()
+        with _lock:
+            _gauges["http_requests_in_flight"][()] += 1
+
+    @app.after_request
+    def _count_request(response):
+        start = request.environ.get("metrics.start")
+        if start is not None:
+            rule = request.url_rule
+            route = _route_template(rule.rule) if rule is not None else "unmatched"
+            elapsed = time.perf_counter() - start
+            with _lock:
+                key = (route, request.method, str(response.status_code))
+                counts = _counters["http_requests_total"]
+                counts[key] = counts.get(key, 0) + 1
+                _observe(
+                    "http_request_duration_seconds", (route, request.method), elapsed
+                )
+        return response
+
+    @app.teardown_request
+    def _end_request(exc):
+        if request.environ.pop("metrics.start", None) is not None:
+            with _lock:
+                _gauges["http_requests_in_flight"][()] -= 1
+        if _settings["directory"] and time.monotonic() >= _settings["next_write"]:
+            write_snapshot()
+
+    app.add_url_rule("/metrics", "metrics", metrics_view)
+
+
+def _route_template(rule):
+    """
+    Removes the converters from a URL rule, for example
+    /api/threads/<thread:thread>/ becomes /api/threads/<thread>/.
+    """
+    return re.sub(r"<(?:[^:<>]+:)?([^<>]+)>", r"<\1>", rule)
+
+
+def _observe(name, key, value):
+    """
+    Adds a value to a histogram. Must be called with the lock held.
+    """
+    buckets = _buckets[name]
+    series = _histograms[name].get(key)
+    if series is None:
+        series = _histograms[name][key] = [0] * (len(buckets) + 1) + [0.0, 0]
+    series[bisect.bisect_left(buckets, value)] += 1
+    series[-2] += value
+    series[-1] += 1
+
+
+def _snapshot():
+    """
+    Returns a copy of the metrics of this process, including the statistics
+    of src.key_cache.
+    """
+    with _lock:
+        snapshot = {
+            "counters": {name: dict(values) for name, values in _counters.items()},
+            "histograms": {
+                name: {key: list(series) for key, series in values.items()}
+                for name, values in _histograms.items()
+            },
+            "gauges": {name: dict(values) for name, values in _gauges.items()},
+        }
+    stats = key_cache_stats()
+    for name in ("hits", "misses", "invalidations"):
+        snapshot["counters"][f"api_key_cache_{name}_total"] = {(): stats[name]}
+    snapshot["gauges"]["api_key_cache_size"] = {(): stats["size"]}
+    return snapshot
+
+
+def write_snapshot():
+    """
+    Writes the metrics of this process to its file in METRICS_DIR.
+    """
+    directory = _settings["directory"]
+    if not directory:
+        return
+    _settings["next_write"] = time.monotonic() + _settings["interval"]
+    snapshot = _snapshot()
+    for kind in ("counters", "histograms", "gauges"):
+        for name, values in snapshot[kind].items():
+            snapshot[kind][name] = [[list(key), value] for key, value in values.items()]
+    path = os.path.join(directory, f"metrics-{os.getpid()}.json")
+    with open(path + ".tmp", "w") as file:
+        json.dump(snapshot, file)
+    os.replace(path + ".tmp", path)
+
+
+@atexit.register
+def _write_at_exit():
+    try:
+        write_snapshot()
+    except OSError:
+        pass
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(total, snapshot, alive):
+    """
+    Adds the metrics of a process to the total. Gauges of processes that
+    have exited are left out.
+    """
+    for name, values in snapshot["counters"].items():
+        merged = total["counters"].setdefault(name, {})
+        for key, value in values:
+            merged[tuple(key)] = merged.get(tuple(key), 0) + value
+    for name, values in snapshot["histograms"].items():
+        merged = total["histograms"].setdefault(name, {})
+        for key, series in values:
+            current = merged.get(tuple(key))
+            if current is None:
+                merged[tuple(key)] = list(series)
+            else:
+                merged[tuple(key)] = [a + b for a, b in zip(current, series)]
+    if alive:
+        for name, values in snapshot["gauges"].items():
+            merged = total["gauges"].setdefault(name, {})
+            for key, value in values:
+                merged[tuple(key)] = merged.get(tuple(key), 0) + value
+
+
+def collect():
+    """
+    Returns the metrics of all processes that share METRICS_DIR, or of this
+    process if it isn't set.
+    """
+    directory = _settings["directory"]
+    if not directory:
+        return _snapshot()
+    write_snapshot()
+    total = {"counters": {}, "histograms": {}, "gauges": {}}
+    for filename in os.listdir(directory):
+        match = re.fullmatch(r"metrics-(\d+)\.json", filename)
+        if match is None:
+            continue
+        try:
+            with open(os.path.join(directory, filename)) as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            continue
+        _merge(total, snapshot, _pid_alive(int(match.group(1))))
+    return total
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for _, value in pairs
+    )
+    return "{" + ",".join(f'{n}="{v}"' for (n, _), v in zip(pairs, escaped)) + "}"
+
+
+def render(metrics):
+    """
+    Formats metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for kind, type_name in (("counters", "counter"), ("gauges", "gauge")):
+        for name, values in sorted(metrics[kind].items()):
+            lines.append(f"# HELP {name} {_help[name]}")
+            lines.append(f"# TYPE {name} {type_name}")
+            for key, value in sorted(values.items()):
+                lines.append(f"{name}{_format_labels(_labels[name], key)} {value}")
+    for name, values in sorted(metrics["histograms"].items()):
+        lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} histogram")
+        bounds = [str(bound) for bound in _buckets[name]] + ["+Inf"]
+        for key, series in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, series):
+                cumulative += count
+                labels = _format_labels(_labels[name], key, [("le", bound)])
+                lines.append(f"{name}_bucket{labels} {cumulative}")
+            labels = _format_labels(_labels[name], key)
+            lines.append(f"{name}_sum{labels} {series[-2]}")
+            lines.append(f"{name}_count{labels} {series[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view():
+    """
+    GET method for the metrics of the API.
+    :return:
+        Returns a response with the metrics in the Prometheus text format
+        and status 200.
+    """
+    return Response(render(collect()), status=200, mimetype="text/plain; version=0.0.4")
+
+
+class TimedQueuePool(QueuePool):
+    """
+    Connection pool that records how long getting a connection takes.
+    """
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            with _lock:
+                _observe(
+                    "db_pool_checkout_wait_seconds", (), time.perf_counter() - start
+                )
+
+
+@event.listens_for(Engine, "handle_error")
+def _count_busy_errors(context):
+    """
+    Counts statements that failed because the SQLite database was locked.
+    SQLite retries locked statements internally until the busy timeout, so
+    only the statements that ran out of time are seen here.
+    """
+    if "database is locked" in str(context.original_exception):
+        with _lock:
+            busy = _counters["sqlite_busy_errors_total"]
+            busy[()] = busy.get((), 0) + 1
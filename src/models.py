@@ -3,9 +3,14 @@ import hashlib
 from datetime import datetime
 from src.app import db
 from sqlalchemy.engine import Engine
-from sqlalchemy import event
+from sqlalchemy import event, inspect, select, update, func, tuple_
+from sqlalchemy import table as table_clause, column as column_clause
+from sqlalchemy.schema import CreateColumn, CreateTable
 from flask.cli import with_appcontext
 
+# Largest id that fits the signed 64-bit integers of SQLite
+MAX_ID = 2**63 - 1
+
 
 @event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
@@ -14,12 +19,42 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor.close()
 
 
+def set_sqlite_pragmas(engine, pragmas):
+    """
+    Runs the given PRAGMA statements on every new connection of a SQLite engine.
+    :param engine: the engine whose connections are configured
+    :param pragmas: dictionary of pragma values by pragma name
+    """
+    if engine.dialect.name != "sqlite" or not pragmas:
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_engine_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
 class Thread(db.Model):
     id = db.Column(db.Integer, unique=True, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
+    # Incremented on every update, used for the ETag of the item
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    # Maintained by the COUNTER_TRIGGERS
+    message_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    last_activity_at = db.Column(db.DateTime)
+
+    # Ids of deleted rows aren't reused, so ETags stay unique over time
+    __table_args__ = {"sqlite_autoincrement": True}
 
+    # Children are deleted by the ON DELETE CASCADE foreign keys, without
+    # loading them
     messages = db.relationship(
-        "Message", back_populates="thread", cascade="all, delete, delete-orphan"
+        "Message",
+        back_populates="thread",
+        cascade="all, delete, delete-orphan",
+        passive_deletes=True,
     )
 
     def serialize(self):
@@ -53,20 +88,39 @@ class Message(db.Model):
     parent_id = db.Column(
         db.Integer, db.ForeignKey("message.message_id", ondelete="CASCADE")
     )
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    # Maintained by the COUNTER_TRIGGERS
+    reaction_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
+    reply_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     parent = db.relationship("Message", remote_side=[message_id])
     thread = db.relationship("Thread", back_populates="messages")
     reactions = db.relationship(
-        "Reaction", back_populates="message", cascade="all, delete"
+        "Reaction",
+        back_populates="message",
+        cascade="all, delete",
+        passive_deletes=True,
+    )
+    media = db.relationship(
+        "Media", back_populates="message", cascade="all, delete", passive_deletes=True
     )
-    media = db.relationship("Media", back_populates="message", cascade="all, delete")
     user = db.relationship("User", back_populates="messages")
 
+    __table_args__ = (
+        # Message collection pages are ordered by (timestamp, message_id)
+        db.Index("ix_message_thread_timestamp", thread_id, timestamp, message_id),
+        db.Index("ix_message_sender", sender_id),
+        db.Index("ix_message_parent", parent_id),
+        {"sqlite_autoincrement": True},
+    )
+
     def serialize(self):
         return {
             "message_id": self.message_id,
             "message_content": self.message_content,
-            "timestamp": self.timestamp.isoformat(),
+            "timestamp": self.timestamp,
             "sender_id": self.sender_id,
             "thread_ID": self.thread_id,
             "parent_ID": self.parent_id,
@@ -102,6 +156,12 @@ class Message(db.Model):
         props["sender_id"] = {
             "description": "Message sender identification",
             "type": "integer",
+            "maximum": MAX_ID,
+        }
+        props["parent_id"] = {
+            "description": "Id of the message this message replies to",
+            "type": ["integer", "null"],
+            "maximum": MAX_ID,
         }
         return schema
 
@@ -110,10 +170,15 @@ class User(db.Model):
     id = db.Column(db.Integer, unique=True, primary_key=True)
     username = db.Column(db.String(16), unique=True, nullable=False)
     password = db.Column(db.String(32), nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+
+    __table_args__ = {"sqlite_autoincrement": True}
 
-    messages = db.relationship("Message", back_populates="user", cascade="all, delete")
+    messages = db.relationship(
+        "Message", back_populates="user", cascade="all, delete", passive_deletes=True
+    )
     reactions = db.relationship(
-        "Reaction", back_populates="user", cascade="all, delete"
+        "Reaction", back_populates="user", cascade="all, delete", passive_deletes=True
     )
     key = db.relationship("ApiKey", back_populates="user", uselist=False)
 
@@ -156,23 +221,30 @@ class Reaction(db.Model):
         db.ForeignKey("message.message_id", ondelete="CASCADE"),
         nullable=False,
     )
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
 
     user = db.relationship("User", back_populates="reactions")
     message = db.relationship("Message", back_populates="reactions")
 
+    __table_args__ = (
+        # A user can react to a message only once
+        db.Index("ix_reaction_message_user", message_id, user_id, unique=True),
+        db.Index("ix_reaction_user", user_id),
+        {"sqlite_autoincrement": True},
+    )
+
     def deserialize(self, doc):
         self.reaction_type = doc["reaction_type"]
         self.user_id = doc["user_id"]
         self.message_id = doc["message_id"]
 
     def serialize(self):
-        data = {
-            "reaction_id": str(self.reaction_id),
-            "reaction_type": str(self.reaction_type),
-            "user_id": str(self.user_id),
-            "message_id": str(self.message_id),
+        return {
+            "reaction_id": self.reaction_id,
+            "reaction_type": self.reaction_type,
+            "user_id": self.user_id,
+            "message_id": self.message_id,
         }
-        return data
 
     @staticmethod
     def json_schema():
@@ -183,12 +255,15 @@ class Reaction(db.Model):
         props = schema["properties"] = {}
         props["reaction_type"] = {
             "type": "integer",
+            "maximum": MAX_ID,
         }
         props["user_id"] = {
             "type": "integer",
+            "maximum": MAX_ID,
         }
         props["message_id"] = {
             "type": "integer",
+            "maximum": MAX_ID,
         }
         return schema
 
@@ -201,20 +276,25 @@ class Media(db.Model):
         db.ForeignKey("message.message_id", ondelete="CASCADE"),
         nullable=False,
     )
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
 
     message = db.relationship("Message", back_populates="media")
 
+    __table_args__ = (
+        db.Index("ix_media_message", message_id),
+        {"sqlite_autoincrement": True},
+    )
+
     def deserialize(self, doc):
         self.media_url = doc["media_url"]
         self.message_id = doc["message_id"]
 
     def serialize(self):
-        data = {
-            "media_id": str(self.media_id),
-            "media_url": str(self.media_url),
-            "message_id": str(self.message_id),
+        return {
+            "media_id": self.media_id,
+            "media_url": self.media_url,
+            "message_id": self.message_id,
         }
-        return data
 
     @staticmethod
     def json_schema():
@@ -234,6 +314,7 @@ class Media(db.Model):
         props["message_id"] = {
             "description": "Message that the image is sent with",
             "type": "integer",
+            "maximum": MAX_ID,
         }
         return schema
 
@@ -246,20 +327,582 @@ class ApiKey(db.Model):
 
     user = db.relationship("User", back_populates="key")
 
+    __table_args__ = (db.Index("ix_api_key_user", user_id),)
+
     @staticmethod
     def key_hash(key):
         return hashlib.sha256(key.encode()).digest()
 
 
+class CollectionVersion(db.Model):
+    """
+    Version of a collection resource, incremented whenever an item is added
+    to, removed from or changed in the collection. Used for the ETag of the
+    collection. Kept up to date by src.versioning.
+    """
+
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+
+class Job(db.Model):
+    """
+    Background job, such as deleting a thread or a user in small
+    transactions. Run by src.jobs.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    # delete-thread or delete-user
+    kind = db.Column(db.String(32), nullable=False)
+    # Id of the thread or user the job works on
+    target_id = db.Column(db.Integer, nullable=False)
+    # pending, running, done or failed
+    status = db.Column(db.String(16), nullable=False, default="pending")
+    # Number of rows deleted so far, not counting rows deleted by cascades
+    deleted_rows = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    finished_at = db.Column(db.DateTime)
+    # Worker process that has claimed the job and when it last reported
+    # progress. Another worker can take over a running job whose
+    # heartbeat is older than JOB_STALE_AFTER seconds.
+    owner = db.Column(db.String(128))
+    heartbeat_at = db.Column(db.DateTime)
+
+    __table_args__ = (db.Index("ix_job_status", status),)
+
+    def serialize(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "target_id": self.target_id,
+            "status": self.status,
+            "deleted_rows": self.deleted_rows,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+# Triggers that keep the counters of threads and messages up to date.
+# Being in the database, they also run for bulk inserts and for rows
+# deleted by ON DELETE CASCADE.
+_LAST_ACTIVITY = "(SELECT max(timestamp) FROM message WHERE thread_id = {}.thread_id)"
+COUNTER_TRIGGERS = {
+    "message_counters_insert": f"""
+        AFTER INSERT ON message BEGIN
+            UPDATE thread SET message_count = message_count + 1,
+                last_activity_at = {_LAST_ACTIVITY.format("NEW")}
+            WHERE id = NEW.thread_id;
+            UPDATE message SET reply_count = reply_count + 1
+            WHERE message_id = NEW.parent_id;
+        END""",
+    "message_counters_delete": f"""
+        AFTER DELETE ON message BEGIN
+            UPDATE thread SET message_count = message_count - 1,
+                last_activity_at = {_LAST_ACTIVITY.format("OLD")}
+            WHERE id = OLD.thread_id;
+            UPDATE message SET reply_count = reply_count - 1
+            WHERE message_id = OLD.parent_id;
+        END""",
+    "message_counters_update": f"""
+        AFTER UPDATE OF thread_id, parent_id, timestamp ON message BEGIN
+            UPDATE thread SET message_count = message_count - 1,
+                last_activity_at = {_LAST_ACTIVITY.format("OLD")}
+            WHERE id = OLD.thread_id;
+            UPDATE thread SET message_count = message_count + 1,
+                last_activity_at = {_LAST_ACTIVITY.format("NEW")}
+            WHERE id = NEW.thread_id;
+            UPDATE message SET reply_count = reply_count - 1
+            WHERE message_id = OLD.parent_id;
+            UPDATE message SET reply_count = reply_count + 1
+            WHERE message_id = NEW.parent_id;
+        END""",
+    "reaction_counters_insert": """
+        AFTER INSERT ON reaction BEGIN
+            UPDATE message SET reaction_count = reaction_count + 1
+            WHERE message_id = NEW.message_id;
+        END""",
+    "reaction_counters_delete": """
+        AFTER DELETE ON reaction BEGIN
+            UPDATE message SET reaction_count = reaction_count - 1
+            WHERE message_id = OLD.message_id;
+        END""",
+    "reaction_counters_update": """
+        AFTER UPDATE OF message_id ON reaction BEGIN
+            UPDATE message SET reaction_count = reaction_count - 1
+            WHERE message_id = OLD.message_id;
+            UPDATE message SET reaction_count = reaction_count + 1
+            WHERE message_id = NEW.message_id;
+        END""",
+}
+
+
+# Full-text index of message contents, kept in sync by triggers. It uses
+# the message table as its external content, so the text isn't stored twice.
+SEARCH_TABLE = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+        message_content, content='message', content_rowid='message_id'
+    )"""
+SEARCH_TRIGGERS = {
+    "message_fts_insert": """
+        AFTER INSERT ON message BEGIN
+            INSERT INTO message_fts(rowid, message_content)
+            VALUES (NEW.message_id, NEW.message_content);
+        END""",
+    "message_fts_delete": """
+        AFTER DELETE ON message BEGIN
+            INSERT INTO message_fts(message_fts, rowid, message_content)
+            VALUES ('delete', OLD.message_id, OLD.message_content);
+        END""",
+    "message_fts_update": """
+        AFTER UPDATE OF message_content ON message BEGIN
+            INSERT INTO message_fts(message_fts, rowid, message_content)
+            VALUES ('delete', OLD.message_id, OLD.message_content);
+            INSERT INTO message_fts(rowid, message_content)
+            VALUES (NEW.message_id, NEW.message_content);
+        END""",
+}
+message_fts = table_clause(
+    "message_fts",
+    column_clause("rowid"),
+    column_clause("message_content"),
+    column_clause("message_fts"),
+)
+
+
+@event.listens_for(db.metadata, "after_create")
+def create_search_index(target, connection, **kw):
+    """
+    Creates the full-text search table and the SEARCH_TRIGGERS if they are
+    missing from the database.
+    """
+    connection.exec_driver_sql(SEARCH_TABLE)
+    for name, body in SEARCH_TRIGGERS.items():
+        connection.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+
+
+def reindex_search(batch_size):
+    """
+    Rebuilds the full-text search index from the message table. Messages are
+    indexed batch_size at a time, each batch in its own transaction.
+    :param batch_size: number of messages indexed in one transaction
+    :return: number of indexed messages
+    """
+    db.session.execute(
+        message_fts.insert().values({message_fts.c.message_fts: "delete-all"})
+    )
+    db.session.commit()
+    indexed = 0
+    last_id = 0
+    while True:
+        batch = (
+            select(Message.message_id)
+            .where(Message.message_id > last_id)
+            .order_by(Message.message_id)
+            .limit(batch_size)
+            .subquery()
+        )
+        batch_end = db.session.execute(select(func.max(batch.c.message_id))).scalar()
+        if batch_end is None:
+            break
+        rows = select(Message.message_id, Message.message_content).where(
+            Message.message_id > last_id, Message.message_id <= batch_end
+        )
+        result = db.session.execute(
+            message_fts.insert().from_select(["rowid", "message_content"], rows)
+        )
+        db.session.commit()
+        indexed += result.rowcount
+        last_id = batch_end
+    return indexed
+
+
+@event.listens_for(db.metadata, "after_create")
+def create_counter_triggers(target, connection, **kw):
+    """
+    Creates the COUNTER_TRIGGERS that are missing from the database.
+    """
+    for name, body in COUNTER_TRIGGERS.items():
+        connection.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+
+
+def repair_counters():
+    """
+    Recomputes the counters of all threads and messages.
+    :return: number of threads and number of messages whose counters were wrong
+    """
+    reply = db.aliased(Message)
+    reaction_count = (
+        select(func.count())
+        .where(Reaction.message_id == Message.message_id)
+        .scalar_subquery()
+    )
+    reply_count = (
+        select(func.count())
+        .where(reply.parent_id == Message.message_id)
+        .scalar_subquery()
+    )
+    message_count = (
+        select(func.count()).where(Message.thread_id == Thread.id).scalar_subquery()
+    )
+    last_activity = (
+        select(func.max(Message.timestamp))
+        .where(Message.thread_id == Thread.id)
+        .scalar_subquery()
+    )
+    messages = db.session.execute(
+        update(Message)
+        .where(
+            (Message.reaction_count != reaction_count)
+            | (Message.reply_count != reply_count)
+        )
+        .values(reaction_count=reaction_count, reply_count=reply_count)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    threads = db.session.execute(
+        update(Thread)
+        .where(
+            (Thread.message_count != message_count)
+            | Thread.last_activity_at.is_distinct_from(last_activity)
+        )
+        .values(message_count=message_count, last_activity_at=last_activity)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return threads, messages
+
+
+def endpoint_queries():
+    """
+    Returns the queries the API runs for its endpoints, keyed by a
+    description of the query. Queries that list a whole table, such as
+    the thread collection, are not included because they scan by design.
+    """
+    page = (Message.timestamp, Message.message_id)
+    return {
+        "thread item": select(Thread).where(Thread.id == 1),
+        "message collection page": select(Message.message_id, Message.timestamp)
+        .where(Message.thread_id == 1)
+        .order_by(*page)
+        .limit(101),
+        "message collection next page": select(Message.message_id, Message.timestamp)
+        .where(Message.thread_id == 1, tuple_(*page) > tuple_(func.datetime(), 1))
+        .order_by(*page)
+        .limit(101),
+        "expanded message collection": select(
+            Message.message_id,
+            Message.timestamp,
+            Message.message_content,
+            Message.reaction_count,
+        )
+        .where(Message.thread_id == 1)
+        .order_by(*page)
+        .limit(101),
+        "message batch": select(Message).where(
+            Message.thread_id == 1, Message.message_id.in_([1, 2, 3])
+        ),
+        "message item": select(Message).where(Message.message_id == 1),
+        "messages by sender": select(Message).where(Message.sender_id == 1),
+        "replies to message": select(Message).where(Message.parent_id == 1),
+        "reaction collection": select(Reaction).where(Reaction.message_id == 1),
+        "existing reaction": select(Reaction).where(
+            Reaction.user_id == 1, Reaction.message_id == 1
+        ),
+        "reactions by user": select(Reaction).where(Reaction.user_id == 1),
+        "reaction item": select(Reaction).where(Reaction.reaction_id == 1),
+        "reaction summary": select(
+            Reaction.message_id, Reaction.reaction_type, func.count()
+        )
+        .join(Message, Reaction.message_id == Message.message_id)
+        .where(Message.thread_id == 1)
+        .group_by(Reaction.message_id, Reaction.reaction_type),
+        "media collection": select(Media).where(Media.message_id == 1),
+        "media item": select(Media).where(Media.media_id == 1),
+        "thread export messages": select(Message)
+        .where(Message.thread_id == 1)
+        .order_by(*page),
+        "thread export reactions": select(Reaction)
+        .join(Message, Reaction.message_id == Message.message_id)
+        .where(Message.thread_id == 1),
+        "thread export media": select(Media)
+        .join(Message, Media.message_id == Message.message_id)
+        .where(Message.thread_id == 1),
+        "user item": select(User).where(User.username == "user"),
+        "user batch": select(User).where(User.id.in_([1, 2, 3])),
+        "api key of user": select(ApiKey).where(ApiKey.user_id == 1),
+        "message search": select(
+            Message.message_id, func.bm25(message_fts.c.message_fts)
+        )
+        .join(Message, Message.message_id == message_fts.c.rowid)
+        .where(message_fts.c.message_fts.match("word"), Message.thread_id == 1),
+        "collection version": select(CollectionVersion.version).where(
+            CollectionVersion.name == "threads"
+        ),
+    }
+
+
+def explain_query_plans():
+    """
+    Runs EXPLAIN QUERY PLAN for every endpoint query.
+    :return: dictionary of query plan details (list of strings) by query
+    """
+    connection = db.session.connection()
+    plans = {}
+    for name, query in endpoint_queries().items():
+        sql = query.compile(
+            dialect=connection.dialect, compile_kwargs={"literal_binds": True}
+        )
+        rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}")
+        plans[name] = [row[-1] for row in rows]
+    return plans
+
+
+def is_table_scan(detail):
+    """
+    Checks if a query plan detail line is a full scan of a table
+    (or of all of its index entries).
+    """
+    words = detail.split()
+    return len(words) > 1 and words[0] == "SCAN" and words[1] in db.metadata.tables
+
+
+def add_missing_columns():
+    """
+    Adds the columns that are missing from tables of databases created
+    before the columns. The new columns must be nullable or have a server
+    default.
+    :return: list of the added columns
+    """
+    added = []
+    existing_tables = inspect(db.engine).get_table_names()
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            columns = inspect(db.engine).get_columns(table.name)
+            existing = {column["name"] for column in columns}
+            for column in table.columns:
+                if column.name not in existing:
+                    ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                    connection.exec_driver_sql(
+                        f"ALTER TABLE {table.name} ADD COLUMN {ddl}"
+                    )
+                    added.append(column)
+    return added
+
+
+def enable_autoincrement():
+    """
+    Rebuilds the tables of databases created before their primary keys used
+    AUTOINCREMENT, so that SQLite doesn't give the ids of deleted rows to
+    new rows. The rows keep their ids. Indexes and triggers of the tables
+    are dropped with the old tables and must be created again.
+    :return: names of the rebuilt tables
+    """
+    existing = dict(
+        db.session.execute(
+            db.text("SELECT name, sql FROM sqlite_master WHERE type = 'table'")
+        ).all()
+    )
+    db.session.commit()
+    tables = [
+        table
+        for table in db.metadata.sorted_tables
+        if table.dialect_options["sqlite"]["autoincrement"]
+        and table.name in existing
+        and "AUTOINCREMENT" not in existing[table.name].upper()
+    ]
+    if not tables:
+        return []
+    preparer = db.engine.dialect.identifier_preparer
+    with db.engine.connect() as connection:
+        # Dropping a table must not cascade to the rows that refer to it,
+        # and renaming the new table must not check the triggers of other
+        # tables while the old one is missing
+        connection.exec_driver_sql("PRAGMA foreign_keys=OFF")
+        connection.exec_driver_sql("PRAGMA legacy_alter_table=ON")
+        try:
+            connection.exec_driver_sql("BEGIN")
+            for table in tables:
+                name = preparer.format_table(table)
+                new_name = preparer.quote(f"new_{table.name}")
+                ddl = str(CreateTable(table).compile(dialect=connection.dialect))
+                ddl = ddl.strip().replace(name, new_name, 1)
+                columns = ", ".join(preparer.quote(c.name) for c in table.columns)
+                connection.exec_driver_sql(ddl)
+                connection.exec_driver_sql(
+                    f"INSERT INTO {new_name} ({columns}) SELECT {columns} FROM {name}"
+                )
+                connection.exec_driver_sql(f"DROP TABLE {name}")
+                connection.exec_driver_sql(f"ALTER TABLE {new_name} RENAME TO {name}")
+            create_counter_triggers(None, connection)
+            create_search_index(None, connection)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.exec_driver_sql("PRAGMA legacy_alter_table=OFF")
+            connection.exec_driver_sql("PRAGMA foreign_keys=ON")
+    return [table.name for table in tables]
+
+
+def duplicate_reactions():
+    """
+    Finds the reactions that break the rule of one reaction per user and
+    message in databases created before the rule was enforced.
+    :return: dictionary of the reaction ids, oldest first, by message id and
+        user id of the reactions
+    """
+    pairs = (
+        select(Reaction.message_id, Reaction.user_id)
+        .group_by(Reaction.message_id, Reaction.user_id)
+        .having(func.count() > 1)
+    )
+    rows = db.session.execute(
+        select(Reaction.message_id, Reaction.user_id, Reaction.reaction_id)
+        .where(tuple_(Reaction.message_id, Reaction.user_id).in_(pairs))
+        .order_by(Reaction.message_id, Reaction.user_id, Reaction.reaction_id)
+    )
+    duplicates = {}
+    for message_id, user_id, reaction_id in rows:
+        duplicates.setdefault((message_id, user_id), []).append(reaction_id)
+    return duplicates
+
+
 @click.command("init-db")
+@click.option(
+    "--remove-duplicate-reactions",
+    is_flag=True,
+    help="Keep only the oldest reaction of a user to a message",
+)
 @with_appcontext
-def init_db():
+def init_db(remove_duplicate_reactions):
+    searchable = "message_fts" in inspect(db.engine).get_table_names()
     db.create_all()
+    if not searchable:
+        # Index the messages of databases created before the search index
+        reindex_search(10000)
+    if add_missing_columns():
+        # Counter columns added to existing rows start from zero
+        repair_counters()
+    # The unique index of reactions can't be created while there are
+    # duplicates, and which of them to keep is up to the user
+    duplicates = duplicate_reactions()
+    if duplicates and not remove_duplicate_reactions:
+        lines = [
+            f"message {message_id}, user {user_id}: reactions "
+            + ", ".join(str(reaction_id) for reaction_id in reaction_ids)
+            for (message_id, user_id), reaction_ids in duplicates.items()
+        ]
+        raise click.ClickException(
+            "Users have reacted to the same message more than once:\n"
+            + "\n".join(lines)
+            + "\nRemove the duplicates or run init-db with"
+            " --remove-duplicate-reactions to keep the oldest ones"
+        )
+    for reaction_ids in duplicates.values():
+        for reaction_id in reaction_ids[1:]:
+            db.session.delete(db.session.get(Reaction, reaction_id))
+    db.session.commit()
+    enable_autoincrement()
+    # Add indexes that are missing from databases created before them
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+@click.command("repair-counters")
+@with_appcontext
+def repair_counters_command():
+    """
+    Recomputes the reaction, reply and message counters of all messages
+    and threads.
+    """
+    threads, messages = repair_counters()
+    click.echo(f"Repaired counters of {threads} threads and {messages} messages")
 
 
-@click.command("populate-db")
+@click.command("reindex-search")
+@click.option("--batch-size", default=10000, help="Messages indexed per transaction")
+@with_appcontext
+def reindex_search_command(batch_size):
+    """
+    Rebuilds the full-text search index of messages.
+    """
+    indexed = reindex_search(batch_size)
+    click.echo(f"Indexed {indexed} messages")
+
+
+@click.command("check-query-plans")
 @with_appcontext
-def populate_db():
-    from src.utils import sample_database
+def check_query_plans():
+    """
+    Checks that none of the endpoint queries scans a whole table.
+    """
+    scans = []
+    for name, details in explain_query_plans().items():
+        scanning = any(is_table_scan(detail) for detail in details)
+        click.echo(f"{'SCAN' if scanning else 'OK':<6}{name}")
+        for detail in details:
+            click.echo(f"      {detail}")
+        if scanning:
+            scans.append(name)
+    if scans:
+        raise click.ClickException(f"Queries scan a table: {', '.join(scans)}")
+
 
-    sample_database()
+@click.command("populate-db")
+@click.option("--users", type=click.IntRange(min=1), help="Number of users to generate")
+@click.option(
+    "--threads", type=click.IntRange(min=0), help="Number of threads to generate"
+)
+@click.option(
+    "--messages-per-thread",
+    type=click.IntRange(min=1),
+    help="Average number of messages in a thread",
+)
+@click.option(
+    "--reaction-rate",
+    type=click.FloatRange(min=0),
+    help="Average number of reactions to a message",
+)
+@click.option(
+    "--reply-depth", type=click.IntRange(min=0), help="Maximum depth of reply chains"
+)
+@click.option("--seed", type=int, help="Seed of the random generator")
+@click.option(
+    "--batch-size",
+    default=10000,
+    type=click.IntRange(min=1),
+    help="Rows inserted per transaction",
+)
+@with_appcontext
+def populate_db(
+    users, threads, messages_per_thread, reaction_rate, reply_depth, seed, batch_size
+):
+    """
+    Adds the small sample database, or with any of the generator options a
+    large generated dataset for capacity testing.
+    """
+    from src.utils import sample_database, synthetic_database
+
+    options = (users, threads, messages_per_thread, reaction_rate, reply_depth, seed)
+    if all(option is None for option in options):
+        sample_database()
+        return
+    created = synthetic_database(
+        users=100 if users is None else users,
+        threads=100 if threads is None else threads,
+        messages_per_thread=(
+            100 if messages_per_thread is None else messages_per_thread
+        ),
+        reaction_rate=0.5 if reaction_rate is None else reaction_rate,
+        reply_depth=5 if reply_depth is None else reply_depth,
+        seed=0 if seed is None else seed,
+        batch_size=batch_size,
+    )
+    click.echo(
+        "Created {} users, {} threads, {} messages and {} reactions".format(*created)
+    )
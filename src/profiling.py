@@ -0,0 +1,140 @@
+import json
+import time
+import random
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Timings of the current request, None when the request isn't profiled
+_profile = ContextVar("profile", default=None)
+# Timed parts of a request in the order they are reported
+TIMINGS = ("sql", "validation", "serialization")
+
+
+def init_app(app):
+    """
+    Adds the profiling hooks to an app. A PROFILING_SAMPLE_RATE fraction of
+    requests is profiled: their wall time, SQL time and statement count,
+    validation time and serialization time are returned in a Server-Timing
+    header (unless PROFILING_SERVER_TIMING is false) and logged as JSON.
+    Requests that aren't sampled are only logged with their wall time if
+    they take longer than PROFILING_SLOW_MS milliseconds.
+    """
+
+    @app.before_request
+    def _start_profile():
+        profile = {"start": time.perf_counter()}
+        if random.random() < app.config["PROFILING_SAMPLE_RATE"]:
+            profile.update(dict.fromkeys(TIMINGS, 0.0), statements=0, sampled=True)
+        g.profiling_token = _profile.set(profile)
+
+    @app.after_request
+    def _finish_profile(response):
+        profile = _profile.get()
+        if profile is None:
+            return response
+        wall = (time.perf_counter() - profile["start"]) * 1000
+        slow = app.config["PROFILING_SLOW_MS"]
+        if profile.get("sampled"):
+            record = _record(profile, wall, response.status_code)
+            if app.config["PROFILING_SERVER_TIMING"]:
+                response.headers["Server-Timing"] = _server_timing(record)
+            logger.info(json.dumps(record))
+        elif slow is not None and wall >= slow:
+            logger.info(json.dumps(_record(None, wall, response.status_code)))
+        return response
+
+    @app.teardown_request
+    def _end_profile(exc):
+        token = g.pop("profiling_token", None)
+        if token is not None:
+            _profile.reset(token)
+
+
+def _record(profile, wall, status):
+    """
+    Creates the log record of a request. Times are in milliseconds.
+    """
+    record = {
+        "method": request.method,
+        "path": request.path,
+        "endpoint": request.endpoint,
+        "status": status,
+        "wall_ms": round(wall, 3),
+    }
+    if profile is not None:
+        for name in TIMINGS:
+            record[f"{name}_ms"] = round(profile[name] * 1000, 3)
+        record["statements"] = profile["statements"]
+    return record
+
+
+def _server_timing(record):
+    """
+    Formats the timings of a request as a Server-Timing header value.
+    """
+    metrics = [f"app;dur={record['wall_ms']}"]
+    metrics.append(
+        f"sql;dur={record['sql_ms']};desc=\"{record['statements']} statements\""
+    )
+    metrics += [f"{name};dur={record[f'{name}_ms']}" for name in TIMINGS[1:]]
+    return ", ".join(metrics)
+
+
+def record(name, seconds):
+    """
+    Adds time to a timed part of the current request if it is profiled.
+    :param name: name of the part, one of TIMINGS
+    :param seconds: time spent in seconds
+    """
+    profile = _profile.get()
+    if profile is not None and "sampled" in profile:
+        profile[name] += seconds
+
+
+@contextmanager
+def timer(name):
+    """
+    Context manager that adds the time spent in it to a timed part of the
+    current request.
+    :param name: name of the part, one of TIMINGS
+    """
+    if _profile.get() is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+    profile = _profile.get()
+    if profile is not None and "sampled" in profile:
+        conn.info.setdefault("profiling.start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_statement(conn, cursor, statement, parameters, context, executemany):
+    profile = _profile.get()
+    if profile is not None and "sampled" in profile:
+        starts = conn.info.get("profiling.start")
+        if starts:
+            profile["sql"] += time.perf_counter() - starts.pop()
+            profile["statements"] += 1
+
+
+@event.listens_for(Engine, "handle_error")
+def _failed_statement(context):
+    starts = (
+        context.connection.info.get("profiling.start") if context.connection else None
+    )
+    if starts:
+        starts.pop()
@@ -0,0 +1,98 @@
+from flask import g
+from sqlalchemy import and_
+from werkzeug.exceptions import NotFound
+
+from src.app import db
+from src.models import Thread, Message, Reaction, Media, User, Job
+
+# URL variables that are resolved as a chain below a thread: the model of each
+# variable, its primary key, and its foreign key to the parent in the URL
+_CHAIN = (
+    ("message", Message, Message.message_id, Message.thread_id, Thread.id),
+    (
+        "reaction",
+        Reaction,
+        Reaction.reaction_id,
+        Reaction.message_id,
+        Message.message_id,
+    ),
+    ("media", Media, Media.media_id, Media.message_id, Message.message_id),
+)
+
+
+def _identity_map():
+    """
+    Returns the request-scoped identity map of resolved URL objects,
+    keyed by (model, id).
+    """
+    if "identity_map" not in g:
+        g.identity_map = {}
+    return g.identity_map
+
+
+def resolve_url_values(endpoint, values):
+    """
+    URL value preprocessor for the API blueprint.
+    Replaces the ids parsed by the URL converters with the database objects.
+    The thread, message, reaction and media of a nested URL are loaded with a
+    single joined query, which also checks that every object belongs to its
+    parent in the URL.
+    :param endpoint: the endpoint of the request
+    :param values: the URL variables of the request, modified in place
+    :raises NotFound: if an object doesn't exist or the chain doesn't match
+    """
+    if not values:
+        return
+    if "user" in values:
+        values["user"] = resolve_user(values["user"])
+    if "job" in values:
+        values["job"] = db.session.get(Job, values["job"])
+        if values["job"] is None:
+            raise NotFound
+    if "thread" in values:
+        values.update(resolve_chain(values))
+
+
+def resolve_user(username):
+    """
+    Fetches the user with the given username.
+    :param username: username from the URL
+    :return: the user object
+    """
+    identity_map = _identity_map()
+    key = (User, username)
+    if key not in identity_map:
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise NotFound
+        identity_map[key] = user
+    return identity_map[key]
+
+
+def resolve_chain(values):
+    """
+    Fetches the thread and the objects nested below it in the URL with one
+    joined query.
+    :param values: the URL variables with the ids of the objects
+    :return: dictionary of the fetched objects by URL variable name
+    """
+    identity_map = _identity_map()
+    names = ["thread"] + [link[0] for link in _CHAIN if link[0] in values]
+    models = {"thread": Thread, **{link[0]: link[1] for link in _CHAIN}}
+    keys = [(models[name], values[name]) for name in names]
+    if all(key in identity_map for key in keys):
+        return {name: identity_map[key] for name, key in zip(names, keys)}
+
+    query = db.session.query(Thread).filter(Thread.id == values["thread"])
+    for name, model, primary_key, foreign_key, parent_key in _CHAIN:
+        if name in values:
+            query = query.add_entity(model).join(
+                model, and_(foreign_key == parent_key, primary_key == values[name])
+            )
+    row = query.first()
+    if row is None:
+        raise NotFound
+    objects = row if len(names) > 1 else (row,)
+    for key, obj in zip(keys, objects):
+        identity_map[key] = obj
+    return dict(zip(names, objects))
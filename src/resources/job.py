@@ -0,0 +1,76 @@
+from flask_restful import Resource
+from werkzeug.routing import BaseConverter
+from werkzeug.exceptions import NotFound
+
+from src.app import db
+from src.utils import json_response, parse_id
+from src import jobs
+
+
+def start_job(kind, target_id):
+    """
+    Starts a background job, or finds the unfinished job that already does
+    the same thing, and creates the response of the request that started it.
+    :param kind: kind of the job, one of src.jobs.JOB_KINDS
+    :param target_id: id of the thread or user the job works on
+    :return:
+        Returns a response with the job in the response body, the URI of
+        the job as a Location header and status 202.
+    """
+    job, created = jobs.create_job(kind, target_id)
+    db.session.commit()
+    if created:
+        jobs.submit(job.id)
+    from src.api import api
+
+    uri = api.url_for(JobItem, job=job)
+    return json_response(job.serialize(), status=202, headers={"Location": uri})
+
+
+class JobItem(Resource):
+    """
+    Background job item resource.
+    """
+
+    def get(self, job):
+        """
+        GET method for job item.
+        Fetches the status of a background job, such as deleting a thread.
+        :param job:
+            The job object that is fetched.
+        :return:
+            Returns a response with the job's kind, target id, status
+            (pending, running, done or failed), number of deleted rows,
+            error and timestamps in the response body and status 200.
+        """
+        return json_response(job.serialize())
+
+
+class JobConverter(BaseConverter):
+    """
+    Converter for job URL variable.
+    """
+
+    def to_python(self, job_id):
+        """
+        Parses the id of the job picked from URL. The job object is fetched
+        from the database by src.resolver.resolve_url_values.
+        :param job_id:
+            ID of the job object in the database.
+        :return:
+            Returns the id of the job as an integer.
+        """
+        id = parse_id(job_id.split("-")[-1])
+        if id is None:
+            raise NotFound
+        return id
+
+    def to_url(self, db_job):
+        """
+        Uses the job object's id to create a URI for the object.
+        :param db_job:
+            The job object that the URI is created for.
+        :return:
+            Returns the job object's id attribute as the URI.
+        """
+        return f"job-{db_job.id}"
@@ -1,13 +1,15 @@
-import json
 from flask_restful import Resource
 from flask import Response, request
 from werkzeug.routing import BaseConverter
 from werkzeug.exceptions import NotFound, UnsupportedMediaType, BadRequest, Conflict
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from sqlalchemy.exc import IntegrityError
 
 from src.models import Media
 from src.app import db
+from src.validation import validate_json
+from src.utils import not_modified, json_response, item_response, parse_id
+from src.versioning import item_etag, collection_etag
 
 
 class MediaCollection(Resource):
@@ -26,15 +28,21 @@ class MediaCollection(Resource):
         :return:
             On successful media creation, returns a response with
             the created media's URI as a Location header,
-            and status 201.
+            and status 201. Returns status 409 if the message_id of the
+            body isn't the message of the URL.
         """
         if not request.json:
             raise UnsupportedMediaType
 
         try:
-            validate(request.json, Media.json_schema())
+            validate_json(request.json, Media)
         except ValidationError as exc:
             raise BadRequest(description=str(exc)) from exc
+        if request.json["message_id"] != message.message_id:
+            raise Conflict(
+                f"Media of message {request.json['message_id']} can't be "
+                f"created under message {message.message_id}"
+            )
 
         media = Media()
         media.deserialize(request.json)
@@ -58,12 +66,19 @@ class MediaCollection(Resource):
             message where the media needs to be extracted from
         :return:
             Returns a list with the media_ids of media contained
-            in the selected thread and status 200.
+            in the selected thread and status 200, or status 304 if the
+            collection matches the If-None-Match header.
         """
+        etag = collection_etag(f"message-{message.message_id}-media")
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
         thread_media = Media.query.filter_by(message=message).all()
         media_collection = [media.media_id for media in thread_media]
         body = {"media_ids": media_collection}
-        return Response(json.dumps(body), status=200, mimetype="application/json")
+        response = json_response(body)
+        response.set_etag(etag)
+        return response
 
 
 class MediaItem(Resource):
@@ -82,11 +97,13 @@ class MediaItem(Resource):
         :param thread:
             parent thread of the message containing the needed media
         :return:
-            returns with id, url, and message_id of the target media and status 200
+            returns with id, url, and message_id of the target media in the headers,
+            or in a JSON body if the Accept header asks for application/json,
+            and status 200, or status 304 if the media matches the If-None-Match header
         """
-        response_data = media.serialize()
-        response_data["media"] = str(media.media_id)
-        return Response(headers=response_data, status=200)
+        return item_response(
+            media.serialize(), item_etag(media), {"media": media.media_id}
+        )
 
     def put(self, media, message, thread):
         """
@@ -99,17 +116,24 @@ class MediaItem(Resource):
         :param thread:
             parent thread of the message
         :return:
-            returns status 204 upon successful edit
+            returns status 204 upon successful edit, or status 409 if the
+            message_id of the request body isn't the parent message
         """
         if not request.json:
             raise UnsupportedMediaType
 
         try:
-            validate(request.json, Media.json_schema())
+            validate_json(request.json, Media)
 
         except ValidationError as exc:
             raise BadRequest(description=str(exc)) from exc
 
+        # Moving the media would leave its URL pointing to nothing
+        if request.json["message_id"] != message.message_id:
+            raise Conflict(
+                f"Media of message {message.message_id} can't be moved "
+                f"to message {request.json['message_id']}"
+            )
         media.deserialize(request.json)
         try:
             db.session.commit()
@@ -142,17 +166,18 @@ class MediaConverter(BaseConverter):
 
     def to_python(self, media_id):
         """
-        Converts the media picked from URL to corresponding
-        database user object.
+        Parses the media id picked from URL. The media object is fetched
+        from the database together with its thread and message by
+        src.resolver.resolve_url_values.
         :param media_id:
             media id of the media object in the database
         :return:
-            returns media object from the database
+            returns the media id as an integer
         """
-        db_media = Media.query.filter_by(media_id=media_id).first()
-        if db_media is None:
+        id = parse_id(media_id)
+        if id is None:
             raise NotFound
-        return db_media
+        return id
 
     def to_url(self, db_media):
         """
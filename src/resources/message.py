@@ -1,13 +1,32 @@
-import json
+from datetime import datetime
 from flask_restful import Resource
 from flask import Response, request
 from werkzeug.routing import BaseConverter
 from werkzeug.exceptions import NotFound, UnsupportedMediaType, BadRequest, Conflict
-from jsonschema import validate, ValidationError, draft7_format_checker
+from jsonschema import ValidationError
+from sqlalchemy import tuple_, func, insert, select, literal
 from sqlalchemy.exc import IntegrityError
 
-from src.models import Message
+from src.models import Message, User
 from src.app import db
+from src.validation import validate_json
+from src.utils import (
+    json_response,
+    parse_limit,
+    parse_id,
+    parse_ids,
+    parse_bulk_items,
+    parse_max_depth,
+    ordered_by_ids,
+    encode_cursor,
+    decode_cursor,
+    next_page_link,
+    not_modified,
+    item_response,
+    BULK_INSERT_ROWS,
+)
+from src.versioning import item_etag, collection_etag, bump_collection_versions
+from src.events import queue_event
 
 
 class MessageCollection(Resource):
@@ -29,11 +48,7 @@ class MessageCollection(Resource):
             raise UnsupportedMediaType
 
         try:
-            validate(
-                request.json,
-                Message.json_schema(),
-                format_checker=draft7_format_checker,
-            )
+            validate_json(request.json, Message)
         except ValidationError as exc:
             raise BadRequest(description=str(exc)) from exc
 
@@ -50,21 +65,333 @@ class MessageCollection(Resource):
         uri = api.url_for(MessageItem, message=message, thread=thread)
         return Response(headers={"Location": uri}, status=201)
 
+    EXPAND_FIELDS = {"content", "reaction_counts"}
+
     def get(self, thread):
         """
         GET method for message collection.
-        Fetches all the message objects belonging to the message collection
-        from database.
+        Fetches one page of the message ids belonging to the message collection
+        from database, ordered by timestamp. The page is selected with the
+        limit and after query parameters, where after is the cursor returned
+        with the previous page.
+        The expand query parameter can be used to get the content
+        (expand=content) and the number of reactions (expand=reaction_counts)
+        of every message on the page with a single query.
+        Many messages of the thread can be fetched at once by giving their ids
+        in the ids query parameter (for example ?ids=1,2,3).
         :param thread:
             Thread object from which the message collection is fetched from.
         :return:
-            Returns a response with a list of message_id attributes of all messages
-            from the collection in the response body and status 200.
+            Returns a response with a list of message_id attributes of the messages
+            on the page (or a list of expanded messages, if expand was given)
+            and the cursor of the next page in the response body,
+            a Link header to the next page if there is one, and status 200.
+            With the ids parameter, returns a list of the requested messages
+            instead.
+            Returns status 304 if the collection matches the If-None-Match
+            header.
+        """
+        ids = parse_ids()
+        limit = parse_limit()
+        expand = set(filter(None, request.args.get("expand", "").split(",")))
+        if not expand <= self.EXPAND_FIELDS:
+            raise BadRequest(
+                description=f"expand must be one of {sorted(self.EXPAND_FIELDS)}"
+            )
+        etag = collection_etag(f"thread-{thread.id}-messages")
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+
+        if ids is not None:
+            messages = Message.query.filter(
+                Message.thread_id == thread.id, Message.message_id.in_(ids)
+            ).all()
+            messages = ordered_by_ids(
+                messages, ids, key=lambda message: message.message_id
+            )
+            body = [message.serialize() for message in messages]
+            response = json_response(body)
+            response.set_etag(etag)
+            return response
+
+        query = db.session.query(Message.message_id, Message.timestamp).filter(
+            Message.thread_id == thread.id
+        )
+        if "content" in expand:
+            query = query.add_columns(
+                Message.message_content, Message.sender_id, Message.parent_id
+            )
+        if "reaction_counts" in expand:
+            query = query.add_columns(Message.reaction_count)
+        after = request.args.get("after")
+        if after:
+            timestamp, message_id = decode_cursor(after)
+            query = query.filter(
+                tuple_(Message.timestamp, Message.message_id)
+                > tuple_(timestamp, message_id)
+            )
+        rows = query.order_by(Message.timestamp, Message.message_id)
+        rows = rows.limit(limit + 1).all()
+
+        headers = {}
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].timestamp, rows[-1].message_id)
+            headers["Link"] = f'<{next_page_link(next_cursor)}>; rel="next"'
+        if expand:
+            body = {"messages": [self._expanded(row, expand) for row in rows]}
+        else:
+            body = {"message_ids": [row.message_id for row in rows]}
+        body["next"] = next_cursor
+        response = json_response(body, headers=headers)
+        response.set_etag(etag)
+        return response
+
+    @staticmethod
+    def _expanded(row, expand):
+        """
+        Creates the expanded representation of a message from a query row.
+        :param row:
+            Query row of the message.
+        :param expand:
+            Set of the expanded fields.
+        :return:
+            Returns the message as a dictionary.
+        """
+        message = {"message_id": row.message_id}
+        if "content" in expand:
+            message["message_content"] = row.message_content
+            message["timestamp"] = row.timestamp
+            message["sender_id"] = row.sender_id
+            message["parent_id"] = row.parent_id
+        if "reaction_counts" in expand:
+            message["reaction_count"] = row.reaction_count
+        return message
+
+
+class MessageBulk(Resource):
+    """
+    Bulk message resource for importing many messages to a thread at once.
+    """
+
+    def post(self, thread):
+        """
+        POST method for bulk messages.
+        Validates every message in the request body and inserts the valid
+        ones to the thread with multi-row inserts of BULK_INSERT_ROWS rows
+        in one transaction.
+        The body is a JSON array of messages or NDJSON with one message
+        per line.
+        :param thread:
+            Thread object the messages are added to.
+        :return:
+            Returns a response with the result of every message (status and
+            message_id, or status and error) and the ids of the created
+            messages in the response body. The status is 201 if any messages
+            were created, otherwise 400.
+        """
+        items = parse_bulk_items()
+        results = [None] * len(items)
+        valid = {}
+        for index, doc in enumerate(items):
+            if doc is None:
+                results[index] = {
+                    "index": index,
+                    "status": 400,
+                    "error": "Invalid JSON",
+                }
+                continue
+            try:
+                validate_json(doc, Message)
+            except ValidationError as exc:
+                results[index] = {"index": index, "status": 400, "error": exc.message}
+                continue
+            valid[index] = doc
+
+        # Foreign keys are checked up front, so that one invalid message
+        # doesn't fail the insert of the whole batch
+        sender_ids = {doc["sender_id"] for doc in valid.values()}
+        parent_ids = {doc.get("parent_id") for doc in valid.values()} - {None}
+        senders = db.session.query(User.id).filter(User.id.in_(sender_ids))
+        senders = {sender.id for sender in senders}
+        # Replies must be in the same thread as the messages they reply to
+        parents = db.session.query(Message.message_id).filter(
+            Message.message_id.in_(parent_ids), Message.thread_id == thread.id
+        )
+        parents = {parent.message_id for parent in parents} | {None}
+        rows = []
+        indexes = []
+        for index, doc in valid.items():
+            if doc["sender_id"] not in senders:
+                error = f"User {doc['sender_id']} doesn't exist"
+            elif doc.get("parent_id") not in parents:
+                error = f"Message {doc['parent_id']} doesn't exist in the thread"
+            else:
+                rows.append(
+                    {
+                        "message_content": doc["message_content"],
+                        "timestamp": datetime.fromisoformat(doc["timestamp"]),
+                        "sender_id": doc["sender_id"],
+                        "parent_id": doc.get("parent_id"),
+                        "thread_id": thread.id,
+                    }
+                )
+                indexes.append(index)
+                continue
+            results[index] = {"index": index, "status": 409, "error": error}
+
+        message_ids = []
+        if rows:
+            try:
+                for start in range(0, len(rows), BULK_INSERT_ROWS):
+                    chunk = rows[start : start + BULK_INSERT_ROWS]
+                    stmt = insert(Message).values(chunk).returning(Message.message_id)
+                    # SQLite gives the rows of a statement ascending ids in
+                    # the order of the VALUES, but RETURNING may list them
+                    # in any order
+                    message_ids += sorted(db.session.scalars(stmt))
+                bump_collection_versions(
+                    db.session.connection(), {f"thread-{thread.id}-messages", "threads"}
+                )
+                for message_id, row in zip(message_ids, rows):
+                    data = Message(message_id=message_id, **row).serialize()
+                    queue_event(db.session, thread.id, "message.created", data)
+                db.session.commit()
+            except IntegrityError as exc:
+                db.session.rollback()
+                raise Conflict() from exc
+        for index, message_id in zip(indexes, message_ids):
+            results[index] = {"index": index, "status": 201, "message_id": message_id}
+
+        body = {"results": results, "message_ids": message_ids}
+        return json_response(body, status=201 if message_ids else 400)
+
+
+class MessageTree(Resource):
+    """
+    Reply tree resource of a thread.
+    """
+
+    def get(self, thread):
+        """
+        GET method for the reply tree of a thread.
+        Fetches the messages of the thread nested under the messages they
+        reply to. The max_depth query parameter limits the depth of the tree,
+        where 0 returns only the messages that aren't replies.
+        :param thread:
+            Thread object whose messages are fetched.
+        :return:
+            Returns a response with the nested messages in the response body
+            and status 200. Every message has its depth, number of replies,
+            number of reactions and the list of its replies ordered by
+            timestamp.
+        """
+        max_depth = parse_max_depth()
+        body = {"messages": self.reply_tree(thread, max_depth)}
+        return json_response(body)
+
+    @staticmethod
+    def reply_tree(thread, max_depth, root=None):
+        """
+        Fetches a reply tree with one recursive query and nests it.
+        :param thread:
+            Thread object whose messages are fetched.
+        :param max_depth:
+            Maximum depth of the tree, relative to the root messages.
+        :param root:
+            Message object at the root of the tree. If not given, the messages
+            of the thread that aren't replies are the roots.
+        :return:
+            Returns the list of root messages as dictionaries.
+        """
+        # Depth first order: the path of a message is the path of its parent
+        # followed by its own (timestamp, id) sort key
+        sort_key = func.printf("%s %010d/", Message.timestamp, Message.message_id)
+        tree = select(
+            Message.message_id,
+            Message.parent_id,
+            literal(0).label("depth"),
+            sort_key.label("path"),
+        ).where(Message.thread_id == thread.id)
+        if root is None:
+            tree = tree.where(Message.parent_id.is_(None))
+        else:
+            tree = tree.where(Message.message_id == root.message_id)
+        tree = tree.cte("tree", recursive=True)
+        tree = tree.union_all(
+            select(
+                Message.message_id,
+                Message.parent_id,
+                tree.c.depth + 1,
+                tree.c.path.concat(sort_key),
+            )
+            .join(tree, Message.parent_id == tree.c.message_id)
+            .where(Message.thread_id == thread.id, tree.c.depth < max_depth)
+        )
+        rows = (
+            db.session.query(
+                Message.message_id,
+                Message.message_content,
+                Message.timestamp,
+                Message.sender_id,
+                Message.parent_id,
+                tree.c.depth,
+                Message.reply_count,
+                Message.reaction_count,
+            )
+            .join(tree, tree.c.message_id == Message.message_id)
+            .order_by(tree.c.path)
+        )
+
+        roots = []
+        nodes = {}
+        for row in rows:
+            node = {
+                "message_id": row.message_id,
+                "message_content": row.message_content,
+                "timestamp": row.timestamp,
+                "sender_id": row.sender_id,
+                "parent_id": row.parent_id,
+                "depth": row.depth,
+                "reply_count": row.reply_count,
+                "reaction_count": row.reaction_count,
+                "replies": [],
+            }
+            # Parents come before their replies in depth first order
+            parent = nodes.get(row.parent_id) if row.depth > 0 else None
+            if parent is None:
+                roots.append(node)
+            else:
+                parent["replies"].append(node)
+            nodes[row.message_id] = node
+        return roots
+
+
+class MessageSubtree(Resource):
+    """
+    Reply tree resource of a message.
+    """
+
+    def get(self, thread, message):
+        """
+        GET method for the reply tree of a message.
+        Fetches the message and the replies to it, nested under the messages
+        they reply to. The max_depth query parameter limits the depth of the
+        tree, where 0 returns only the message itself.
+        :param thread:
+            Thread object the message belongs to.
+        :param message:
+            Message object at the root of the tree.
+        :return:
+            Returns a response with the nested message in the response body
+            and status 200, in the same format as the thread reply tree.
         """
-        messages = Message.query.filter_by(thread=thread).all()
-        message_collection = [message.message_id for message in messages]
-        body = {"message_ids": message_collection}
-        return Response(json.dumps(body), status=200, mimetype="application/json")
+        max_depth = parse_max_depth()
+        (root,) = MessageTree.reply_tree(thread, max_depth, root=message)
+        body = {"message": root}
+        return json_response(body)
 
 
 class MessageItem(Resource):
@@ -82,9 +409,11 @@ class MessageItem(Resource):
             The thread object that needs to be fetched from the database.
         :return:
             Returns a response with the fetched message object's id and
-            message attributes in the headers and status 200.
+            message attributes in the headers, or in a JSON body if the
+            Accept header asks for application/json, and status 200, or
+            status 304 if the message matches the If-None-Match header.
         """
-        return Response(headers=message.serialize(), status=200)
+        return item_response(message.serialize(), item_etag(message))
 
     def put(self, thread, message):
         """
@@ -101,11 +430,7 @@ class MessageItem(Resource):
             raise UnsupportedMediaType
 
         try:
-            validate(
-                request.json,
-                Message.json_schema(),
-                format_checker=draft7_format_checker,
-            )
+            validate_json(request.json, Message)
         except ValidationError as exc:
             raise BadRequest(description=str(exc)) from exc
 
@@ -139,18 +464,18 @@ class MessageConverter(BaseConverter):
 
     def to_python(self, message_id):
         """
-        Converts the message picked from URL to corresponding
-        database message object.
+        Parses the id of the message picked from URL. The message object is
+        fetched from the database together with its thread by
+        src.resolver.resolve_url_values.
         :param message_id:
             ID of the message object in the database.
         :return:
-            Returns the message object fetched from the database.
+            Returns the id of the message as an integer.
         """
-        id = message_id.split("-")[-1]
-        db_message = Message.query.filter_by(message_id=id).first()
-        if db_message is None:
+        id = parse_id(message_id.split("-")[-1])
+        if id is None:
             raise NotFound
-        return db_message
+        return id
 
     def to_url(self, db_message):
         """
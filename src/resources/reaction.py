@@ -1,13 +1,22 @@
-import json
 from flask_restful import Resource
 from flask import Response, request
 from werkzeug.routing import BaseConverter
-from werkzeug.exceptions import NotFound, UnsupportedMediaType, BadRequest, Conflict
-from jsonschema import validate, ValidationError
+from werkzeug.exceptions import (
+    NotFound,
+    UnsupportedMediaType,
+    BadRequest,
+    Conflict,
+    Forbidden,
+)
+from jsonschema import ValidationError
+from sqlalchemy import func, literal
 from sqlalchemy.exc import IntegrityError
 
-from src.models import Reaction
+from src.models import Reaction, Message, ApiKey
 from src.app import db
+from src.validation import validate_json
+from src.utils import not_modified, json_response, item_response, parse_id
+from src.versioning import item_etag, collection_etag
 
 
 class ReactionCollection(Resource):
@@ -27,14 +36,20 @@ class ReactionCollection(Resource):
         :return:
             On successful reaction creation, returns a response with
             the created reaction's URI as a Location header,
-            and status 201.
+            and status 201. Returns status 409 if the message_id of the
+            body isn't the message of the URL.
         """
         if not request.json:
             raise UnsupportedMediaType
         try:
-            validate(request.json, Reaction.json_schema())
+            validate_json(request.json, Reaction)
         except ValidationError as exc:
             raise BadRequest(description=str(exc))
+        if request.json["message_id"] != message.message_id:
+            raise Conflict(
+                f"Reactions to message {request.json['message_id']} can't be "
+                f"created under message {message.message_id}"
+            )
         reaction = Reaction()
         reaction.deserialize(request.json)
         # Check if reaction already exists
@@ -50,7 +65,7 @@ class ReactionCollection(Resource):
             db.session.commit()
         except IntegrityError as exc:
             raise Conflict(
-                f"Reaction with id {request.json['reaction_id']} already exists"
+                f"User {reaction.user_id} has already reacted to the message with id {reaction.message_id}"
             ) from exc
         from src.api import api
 
@@ -69,12 +84,89 @@ class ReactionCollection(Resource):
             The thread object the reactions' parent message belongs to.
         :return:
             Returns a list with the reaction_ids of the reactions to the
-            message and status 200.
+            message and status 200, or status 304 if the collection matches
+            the If-None-Match header.
         """
+        etag = collection_etag(f"message-{message.message_id}-reactions")
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
         reactions = Reaction.query.filter_by(message=message).all()
         reaction_collection = [reaction.reaction_id for reaction in reactions]
         body = {"reaction_ids": reaction_collection}
-        return Response(json.dumps(body), status=200, mimetype="application/json")
+        response = json_response(body)
+        response.set_etag(etag)
+        return response
+
+
+class ReactionSummary(Resource):
+    """
+    Reaction summary resource of a thread.
+    """
+
+    def get(self, thread):
+        """
+        GET method for reaction summary.
+        Counts the reactions of every message in the thread by reaction type
+        with a single grouped query. If the request has an Api-key header,
+        the reactions of the key's user are included as well.
+        :param thread:
+            The thread object whose reactions are counted.
+        :return:
+            Returns a response with the reaction counts by message id and
+            reaction type, and with an Api-key header the caller's reaction
+            type by message id, in the response body and status 200.
+            Messages without reactions are left out. Returns status 304 if
+            the summary matches the If-None-Match header.
+        """
+        caller = self._caller()
+        etag = collection_etag(f"thread-{thread.id}-messages") + f"-reactions-{caller}"
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+
+        reacted = (
+            func.max(Reaction.user_id == caller) if caller is not None else literal(0)
+        )
+        rows = (
+            db.session.query(
+                Reaction.message_id,
+                Reaction.reaction_type,
+                func.count().label("count"),
+                reacted.label("reacted"),
+            )
+            .join(Message, Reaction.message_id == Message.message_id)
+            .filter(Message.thread_id == thread.id)
+            .group_by(Reaction.message_id, Reaction.reaction_type)
+        )
+        reactions = {}
+        caller_reactions = {}
+        for row in rows:
+            reactions.setdefault(row.message_id, {})[row.reaction_type] = row.count
+            if row.reacted:
+                caller_reactions[row.message_id] = row.reaction_type
+        body = {"reactions": reactions}
+        if caller is not None:
+            body["reacted"] = caller_reactions
+        response = json_response(body)
+        response.set_etag(etag)
+        response.vary.add("Api-key")
+        return response
+
+    @staticmethod
+    def _caller():
+        """
+        Finds the user of the API key in the Api-key header.
+        :return:
+            Returns the id of the user, or None if there is no Api-key header.
+        """
+        token = request.headers.get("Api-key", "").strip()
+        if not token:
+            return None
+        db_key = db.session.get(ApiKey, ApiKey.key_hash(token))
+        if db_key is None or db_key.user_id is None:
+            raise Forbidden
+        return db_key.user_id
 
 
 class ReactionItem(Resource):
@@ -94,10 +186,12 @@ class ReactionItem(Resource):
             The reaction object that needs to be fetched from the database.
         :return:
             Returns a response with the fetched reaction object's id, type,
-            message_id and user_id attributes in the headers and status 200.
+            message_id and user_id attributes in the headers, or in a JSON
+            body if the Accept header asks for application/json, and status
+            200, or status 304 if the reaction matches the If-None-Match
+            header.
         """
-        response_data = reaction.serialize()
-        return Response(headers=response_data, status=200)
+        return item_response(reaction.serialize(), item_etag(reaction))
 
     def delete(self, reaction, message, thread):
         """
@@ -127,21 +221,29 @@ class ReactionItem(Resource):
         :param reaction:
             The reaction object whose attributes are being rewritten.
         :return:
-            On successful rewrite, returns a response with status 204.
+            On successful rewrite, returns a response with status 204, or
+            status 409 if the message_id of the request body isn't the
+            message of the reaction.
         """
         if not request.json:
             raise UnsupportedMediaType
         try:
-            validate(request.json, Reaction.json_schema())
+            validate_json(request.json, Reaction)
         except ValidationError as exc:
             raise BadRequest(description=str(exc)) from exc
+        # Moving the reaction would leave its URL pointing to nothing
+        if request.json["message_id"] != message.message_id:
+            raise Conflict(
+                f"Reactions to message {message.message_id} can't be moved "
+                f"to message {request.json['message_id']}"
+            )
         reaction.deserialize(request.json)
         try:
             db.session.add(reaction)
             db.session.commit()
         except IntegrityError as exc:
             raise Conflict(
-                f"Reaction with id {request.json['reaction_id']} already exists"
+                f"User {reaction.user_id} has already reacted to the message with id {reaction.message_id}"
             ) from exc
         return Response(status=204)
 
@@ -153,17 +255,18 @@ class ReactionConverter(BaseConverter):
 
     def to_python(self, reaction_id):
         """
-        Converts the reaction picked from URL to corresponding
-        database user object.
+        Parses the id of the reaction picked from URL. The reaction object is
+        fetched from the database together with its thread and message by
+        src.resolver.resolve_url_values.
         :param reaction_id:
             Id of the reaction object in the database.
         :return:
-            Returns the reaction object fetched from the database.
+            Returns the id of the reaction as an integer.
         """
-        db_reaction = Reaction.query.filter_by(reaction_id=reaction_id).first()
-        if db_reaction is None:
+        id = parse_id(reaction_id)
+        if id is None:
             raise NotFound
-        return db_reaction
+        return id
 
     def to_url(self, db_reaction):
         """
@@ -0,0 +1,137 @@
+import html
+from flask_restful import Resource
+from flask import request
+from werkzeug.exceptions import BadRequest
+from sqlalchemy import func, tuple_
+
+from src.models import Message, message_fts
+from src.app import db
+from src.utils import (
+    parse_id,
+    parse_limit,
+    encode_cursor,
+    decode_cursor,
+    next_page_link,
+    json_response,
+)
+
+# The matches are marked with control characters in the snippets, so that
+# the snippets can be HTML escaped before the markers become <mark> tags
+MARK_START = "\x02"
+MARK_END = "\x03"
+
+
+class MessageSearch(Resource):
+    """
+    Full-text message search resource.
+    """
+
+    def get(self):
+        """
+        GET method for message search.
+        Searches the messages whose content contains all the words in the q
+        query parameter (a word ending with * matches any word that starts
+        with it), best matches first. The results can be limited to a thread
+        and to a sender with the thread and sender query parameters, and are
+        paginated with the limit and after query parameters like the message
+        collection.
+        :return:
+            Returns a response with the matching messages, their rank and an
+            HTML escaped snippet of the content with the matches inside
+            <mark> tags, and the cursor of the next page in the response
+            body, a Link header to the next page if there is one, and
+            status 200.
+        """
+        match = self._match_expression(request.args.get("q", ""))
+        limit = parse_limit()
+        filters = [message_fts.c.message_fts.match(match)]
+        for name, key in (("thread", Message.thread_id), ("sender", Message.sender_id)):
+            value = request.args.get(name)
+            if value is not None:
+                id = parse_id(value)
+                if id is None:
+                    raise BadRequest(description=f"{name} must be an integer id")
+                filters.append(key == id)
+
+        ranked = (
+            db.session.query(
+                Message.message_id,
+                Message.thread_id,
+                Message.sender_id,
+                Message.timestamp,
+                func.bm25(message_fts.c.message_fts).label("rank"),
+                func.snippet(
+                    message_fts.c.message_fts, 0, MARK_START, MARK_END, "...", 16
+                ).label("snippet"),
+            )
+            .join(Message, Message.message_id == message_fts.c.rowid)
+            .filter(*filters)
+            .subquery()
+        )
+        query = db.session.query(ranked)
+        after = request.args.get("after")
+        if after:
+            rank, message_id = decode_cursor(after, parse=float)
+            query = query.filter(
+                tuple_(ranked.c.rank, ranked.c.message_id) > tuple_(rank, message_id)
+            )
+        rows = query.order_by(ranked.c.rank, ranked.c.message_id)
+        rows = rows.limit(limit + 1).all()
+
+        headers = {}
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].rank, rows[-1].message_id)
+            headers["Link"] = f'<{next_page_link(next_cursor)}>; rel="next"'
+        body = {
+            "results": [
+                {
+                    "message_id": row.message_id,
+                    "thread_id": row.thread_id,
+                    "sender_id": row.sender_id,
+                    "timestamp": row.timestamp,
+                    "rank": row.rank,
+                    "snippet": self._snippet_html(row.snippet),
+                }
+                for row in rows
+            ],
+            "next": next_cursor,
+        }
+        return json_response(body, headers=headers)
+
+    @staticmethod
+    def _match_expression(q):
+        """
+        Converts the search words to an FTS5 query that matches messages
+        containing all of them. Every word is quoted, so the FTS5 query
+        syntax can't be used (or misused) from the request.
+        :param q:
+            The search words.
+        :return:
+            Returns the FTS5 match expression.
+        """
+        terms = []
+        for word in q.split():
+            prefix = word.endswith("*")
+            word = word.rstrip("*")
+            if word:
+                quoted = '"' + word.replace('"', '""') + '"'
+                terms.append(quoted + "*" if prefix else quoted)
+        if not terms:
+            raise BadRequest(description="q must contain at least one word")
+        return " ".join(terms)
+
+    @staticmethod
+    def _snippet_html(snippet):
+        """
+        Escapes the message content in a snippet and marks the matches with
+        <mark> tags. Marker characters in the content itself only add mark
+        tags, so no other HTML gets through.
+        :param snippet:
+            Snippet with the matches between MARK_START and MARK_END.
+        :return:
+            Returns the snippet as HTML.
+        """
+        snippet = html.escape(snippet)
+        return snippet.replace(MARK_START, "<mark>").replace(MARK_END, "</mark>")
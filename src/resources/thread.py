@@ -1,13 +1,27 @@
-import json
 from flask_restful import Resource
-from flask import Response, request
+from flask import Response, request, stream_with_context, current_app
 from werkzeug.routing import BaseConverter
 from werkzeug.exceptions import NotFound, UnsupportedMediaType, BadRequest, Conflict
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from sqlalchemy.exc import IntegrityError
 
-from src.models import Thread
+from src.models import Thread, Message, Reaction, Media
 from src.app import db
+from src.validation import validate_json
+from src.utils import (
+    json_response,
+    parse_id,
+    parse_ids,
+    ordered_by_ids,
+    not_modified,
+    ndjson_chunks,
+    gzip_chunks,
+    STREAM_BATCH_SIZE,
+    item_response,
+)
+from src.resources.job import start_job
+from src.versioning import item_etag, collection_etag
+from src import events
 
 
 class ThreadCollection(Resource):
@@ -29,7 +43,7 @@ class ThreadCollection(Resource):
             raise UnsupportedMediaType
 
         try:
-            validate(request.json, Thread.json_schema())
+            validate_json(request.json, Thread)
         except ValidationError as exc:
             raise BadRequest(description=str(exc)) from exc
 
@@ -45,18 +59,79 @@ class ThreadCollection(Resource):
         uri = api.url_for(ThreadItem, thread=thread)
         return Response(headers={"Location": uri}, status=201)
 
+    INCLUDE_FIELDS = {"title", "counts"}
+
     def get(self):
         """
         GET method for thread collection.
         Fetches all thread objects from database.
+        Many threads can be fetched at once by giving their ids in the
+        ids query parameter (for example ?ids=1,2,3).
+        The include=title query parameter adds the id and title of every thread
+        to the response body, and include=counts adds the number of messages
+        and the timestamp of the latest message (for example include=title,counts).
+        Returns status 304 if the collection matches the If-None-Match header.
         :return:
             Returns a response with a list of thread_id attributes of all threads
             in the response body and status 200.
+            With the ids parameter, returns a list of the requested threads
+            instead.
         """
-        threads = Thread.query.all()
-        thread_collection = [thread.id for thread in threads]
-        body = {"thread_ids": thread_collection}
-        return Response(json.dumps(body), status=200, mimetype="application/json")
+        ids = parse_ids()
+        include = set(filter(None, request.args.get("include", "").split(",")))
+        if not include <= self.INCLUDE_FIELDS:
+            raise BadRequest(
+                description=f"include must be one of {sorted(self.INCLUDE_FIELDS)}"
+            )
+        etag = collection_etag("threads")
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+
+        if ids is not None:
+            threads = Thread.query.filter(Thread.id.in_(ids)).all()
+            threads = ordered_by_ids(threads, ids, key=lambda thread: thread.id)
+            body = [thread.serialize() for thread in threads]
+            response = json_response(body)
+            response.set_etag(etag)
+            return response
+
+        if include:
+            query = db.session.query(Thread.id)
+            if "title" in include:
+                query = query.add_columns(Thread.title)
+            if "counts" in include:
+                query = query.add_columns(Thread.message_count, Thread.last_activity_at)
+            threads = query.all()
+            body = {
+                "thread_ids": [thread.id for thread in threads],
+                "threads": [self._included(thread, include) for thread in threads],
+            }
+        else:
+            threads = db.session.query(Thread.id).all()
+            body = {"thread_ids": [thread.id for thread in threads]}
+        response = json_response(body)
+        response.set_etag(etag)
+        return response
+
+    @staticmethod
+    def _included(row, include):
+        """
+        Creates the representation of a thread with the included fields.
+        :param row:
+            Query row of the thread.
+        :param include:
+            Set of the included fields.
+        :return:
+            Returns the thread as a dictionary.
+        """
+        thread = {"thread_id": row.id}
+        if "title" in include:
+            thread["title"] = row.title
+        if "counts" in include:
+            thread["message_count"] = row.message_count
+            thread["last_activity_at"] = row.last_activity_at
+        return thread
 
 
 class ThreadItem(Resource):
@@ -72,9 +147,11 @@ class ThreadItem(Resource):
             The thread object that needs to be fetched from the database.
         :return:
             Returns a response with the fetched thread object's id and
-            thread attributes in the headers and status 200.
+            thread attributes in the headers, or in a JSON body if the
+            Accept header asks for application/json, and status 200, or
+            status 304 if the thread matches the If-None-Match header.
         """
-        return Response(headers=thread.serialize(), status=200)
+        return item_response(thread.serialize(), item_etag(thread))
 
     def put(self, thread):
         """
@@ -89,7 +166,7 @@ class ThreadItem(Resource):
             raise UnsupportedMediaType
 
         try:
-            validate(request.json, Thread.json_schema())
+            validate_json(request.json, Thread)
         except ValidationError as exc:
             raise BadRequest(description=str(exc)) from exc
 
@@ -103,15 +180,120 @@ class ThreadItem(Resource):
     def delete(self, thread):
         """
         DELETE method for thread item.
-        Deletes an existing thread object from the database.
+        Starts a background job that deletes the thread and its messages
+        from the database in small transactions, so that other writes
+        aren't blocked while a large thread is deleted.
         :param thread:
             The thread object which is deleted.
         :return:
-            Returns a response with status 204.
+            Returns a response with the job in the response body, the URI
+            of the job as a Location header and status 202.
         """
-        db.session.delete(thread)
-        db.session.commit()
-        return Response(status=204)
+        return start_job("delete-thread", thread.id)
+
+
+class ThreadExport(Resource):
+    """
+    Thread export resource
+    """
+
+    def get(self, thread):
+        """
+        GET method for thread export.
+        Streams the thread and all of its messages, reactions and media as
+        NDJSON, one row per line with its type in the type field. Rows are
+        fetched STREAM_BATCH_SIZE at a time, so memory use doesn't grow with
+        the size of the thread. The response is gzip compressed if the
+        client accepts it.
+        :param thread:
+            The thread object that is exported.
+        :return:
+            Returns a streamed NDJSON response with status 200.
+        """
+        chunks = ndjson_chunks(self._records(thread))
+        compress = request.accept_encodings["gzip"] > 0
+        if compress:
+            chunks = gzip_chunks(chunks)
+        response = Response(
+            stream_with_context(chunks), status=200, mimetype="application/x-ndjson"
+        )
+        if compress:
+            response.headers["Content-Encoding"] = "gzip"
+        response.headers["Vary"] = "Accept-Encoding"
+        response.headers["Content-Disposition"] = (
+            f"attachment; filename=thread-{thread.id}.ndjson"
+        )
+        return response
+
+    @staticmethod
+    def _records(thread):
+        """
+        Fetches the rows of the thread in batches.
+        :param thread:
+            The thread object that is exported.
+        :return:
+            Generator of the rows as dictionaries.
+        """
+        yield {"type": "thread", **thread.serialize()}
+        messages = (
+            Message.query.filter(Message.thread_id == thread.id)
+            .order_by(Message.timestamp, Message.message_id)
+            .yield_per(STREAM_BATCH_SIZE)
+        )
+        for message in messages:
+            yield {"type": "message", **message.serialize()}
+        reactions = (
+            Reaction.query.join(Message, Reaction.message_id == Message.message_id)
+            .filter(Message.thread_id == thread.id)
+            .yield_per(STREAM_BATCH_SIZE)
+        )
+        for reaction in reactions:
+            yield {"type": "reaction", **reaction.serialize()}
+        media = (
+            Media.query.join(Message, Media.message_id == Message.message_id)
+            .filter(Message.thread_id == thread.id)
+            .yield_per(STREAM_BATCH_SIZE)
+        )
+        for item in media:
+            yield {"type": "media", **item.serialize()}
+
+
+class ThreadEvents(Resource):
+    """
+    Thread event stream resource
+    """
+
+    def get(self, thread):
+        """
+        GET method for thread events.
+        Streams the messages, reactions and media that are created, updated
+        or deleted in the thread as Server-Sent Events, once their
+        transaction is committed. The event type is the kind of the row and
+        the change (for example message.created) and the data is the row,
+        or its ids when it was deleted. A client that reconnects with the
+        Last-Event-ID header gets the events it missed, or a reset event if
+        they are no longer available and the thread must be fetched again.
+        :param thread:
+            The thread object whose events are streamed.
+        :return:
+            Returns a streamed text/event-stream response with status 200.
+        """
+        last_event_id = request.headers.get("Last-Event-ID")
+        if last_event_id is None:
+            last_event_id = events.current_event_id()
+        elif last_event_id.isascii() and last_event_id.isdigit():
+            last_event_id = int(last_event_id)
+        else:
+            raise BadRequest(description="Last-Event-ID must be an event id")
+        # The stream doesn't use the database, so the request context and
+        # its connection are released while the client waits for events
+        stream = events.subscribe(
+            thread.id, last_event_id, current_app.config["EVENT_KEEPALIVE"]
+        )
+        response = Response(stream, status=200, mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
 
 
 class ThreadConverter(BaseConverter):
@@ -121,18 +303,17 @@ class ThreadConverter(BaseConverter):
 
     def to_python(self, thread_id):
         """
-        Converts the thread picked from URL to corresponding
-        database thread object.
+        Parses the id of the thread picked from URL. The thread object is
+        fetched from the database by src.resolver.resolve_url_values.
         :param thread_id:
             ID of the thread object in the database.
         :return:
-            Returns the thread object fetched from the database.
+            Returns the id of the thread as an integer.
         """
-        id = thread_id.split("-")[-1]
-        db_thread = Thread.query.filter_by(id=id).first()
-        if db_thread is None:
+        id = parse_id(thread_id.split("-")[-1])
+        if id is None:
             raise NotFound
-        return db_thread
+        return id
 
     def to_url(self, db_thread):
         """
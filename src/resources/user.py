@@ -2,13 +2,23 @@ import secrets
 from flask_restful import Resource
 from flask import Response, request
 from werkzeug.routing import BaseConverter
-from werkzeug.exceptions import NotFound, UnsupportedMediaType, BadRequest, Conflict
-from jsonschema import validate, ValidationError
+from werkzeug.exceptions import UnsupportedMediaType, BadRequest, Conflict
+from jsonschema import ValidationError
 from sqlalchemy.exc import IntegrityError
 
 from src.models import User, ApiKey
 from src.app import db
-from src.utils import require_authentication
+from src.validation import validate_json
+from src.utils import (
+    require_authentication,
+    parse_ids,
+    ordered_by_ids,
+    not_modified,
+    json_response,
+    item_response,
+)
+from src.resources.job import start_job
+from src.versioning import item_etag, collection_etag
 
 
 class UserCollection(Resource):
@@ -32,7 +42,7 @@ class UserCollection(Resource):
             raise UnsupportedMediaType
 
         try:
-            validate(request.json, User.json_schema())
+            validate_json(request.json, User)
         except ValidationError as exc:
             raise BadRequest(description=str(exc)) from exc
 
@@ -55,6 +65,30 @@ class UserCollection(Resource):
         uri = api.url_for(UserItem, user=user)
         return Response(headers={"Location": uri, "Api-key": token}, status=201)
 
+    def get(self):
+        """
+        GET method for user collection.
+        Fetches the users whose ids are given in the ids query parameter
+        (for example ?ids=1,2,3) from the database.
+        :return:
+            Returns a response with a list of the requested users' ids and
+            usernames in the response body and status 200, or status 304
+            if the users match the If-None-Match header.
+        """
+        ids = parse_ids()
+        if ids is None:
+            raise BadRequest(description="ids query parameter is required")
+        etag = collection_etag("users")
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+        users = User.query.filter(User.id.in_(ids)).all()
+        users = ordered_by_ids(users, ids, key=lambda user: user.id)
+        body = [user.serialize() for user in users]
+        response = json_response(body)
+        response.set_etag(etag)
+        return response
+
 
 class UserItem(Resource):
     """
@@ -69,9 +103,11 @@ class UserItem(Resource):
             The user object that needs to be fetched from the database.
         :return:
             Returns a response with the fetched user object's id and
-            username attributes in the headers and status 200.
+            username attributes in the headers, or in a JSON body if the
+            Accept header asks for application/json, and status 200, or
+            status 304 if the user matches the If-None-Match header.
         """
-        return Response(headers=user.serialize(), status=200)
+        return item_response(user.serialize(), item_etag(user))
 
     @require_authentication
     def put(self, user):
@@ -88,7 +124,7 @@ class UserItem(Resource):
             raise UnsupportedMediaType
 
         try:
-            validate(request.json, User.json_schema())
+            validate_json(request.json, User)
         except ValidationError as exc:
             raise BadRequest(description=str(exc)) from exc
 
@@ -105,16 +141,16 @@ class UserItem(Resource):
     def delete(self, user):
         """
         DELETE method for user item.
-        Deletes an existing user object from the database.
+        Starts a background job that deletes the user and its messages and
+        reactions from the database in small transactions.
         Requires authentication.
         :param user:
             The user object that is being deleted.
         :return:
-            Returns a response with status 204.
+            Returns a response with the job in the response body, the URI
+            of the job as a Location header and status 202.
         """
-        db.session.delete(user)
-        db.session.commit()
-        return Response(status=204)
+        return start_job("delete-user", user.id)
 
 
 class UserConverter(BaseConverter):
@@ -124,17 +160,14 @@ class UserConverter(BaseConverter):
 
     def to_python(self, username):
         """
-        Converts the username picked from URL to corresponding
-        database user object.
+        Picks the username from URL. The user object is fetched from
+        the database by src.resolver.resolve_url_values.
         :param username:
             Username of the user object in the database.
         :return:
-            Returns the user object fetched from the database.
+            Returns the username.
         """
-        db_user = User.query.filter_by(username=username).first()
-        if db_user is None:
-            raise NotFound
-        return db_user
+        return username
 
     def to_url(self, db_user):
         """
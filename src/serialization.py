@@ -0,0 +1,83 @@
+import json
+import datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# Name of the encoder in use, set by configure
+_settings = {"encoder": "json"}
+
+
+def _default(obj):
+    """
+    Encodes the values that the encoders don't support natively.
+    """
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _orjson_dumps(obj):
+    # Integer keys are allowed like in the json module
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, default=_default, ensure_ascii=False).encode()
+
+
+_json_encoder = json.JSONEncoder(default=_default, separators=(",", ":"))
+
+
+def _json_dumps(obj):
+    return _json_encoder.encode(obj).encode()
+
+
+_ENCODERS = {"orjson": _orjson_dumps, "ujson": _ujson_dumps, "json": _json_dumps}
+_MODULES = {"orjson": orjson, "ujson": ujson, "json": json}
+
+
+def available_encoders():
+    """
+    Returns the names of the installed encoders, fastest first.
+    """
+    return [name for name in _ENCODERS if _MODULES[name] is not None]
+
+
+def configure(encoder):
+    """
+    Sets the encoder used for response bodies, NDJSON exports and events.
+    Called when the app is created.
+    :param encoder:
+        orjson, ujson or json, or auto for the fastest installed one
+    """
+    if encoder == "auto":
+        encoder = available_encoders()[0]
+    if encoder not in _ENCODERS:
+        raise ValueError(f"Unknown JSON encoder {encoder}")
+    if _MODULES[encoder] is None:
+        raise ImportError(f"JSON encoder {encoder} is not installed")
+    _settings["encoder"] = encoder
+
+
+def encoder_name():
+    """
+    Returns the name of the encoder in use.
+    """
+    return _settings["encoder"]
+
+
+def dumps(obj):
+    """
+    Encodes a value as compact JSON. Dates and datetimes are encoded as
+    ISO 8601 strings.
+    :param obj: JSON serializable value
+    :return: the encoded bytes
+    """
+    return _ENCODERS[_settings["encoder"]](obj)
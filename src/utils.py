@@ -1,15 +1,45 @@
+import base64
 import datetime
+import json
+import random
 import secrets
-from flask import request
-from werkzeug.exceptions import Forbidden
+import zlib
+from urllib.parse import urlencode
+from flask import Response, request
+from werkzeug.exceptions import Forbidden, BadRequest, UnsupportedMediaType
+from sqlalchemy import insert, select, delete, func
+from src import key_cache, profiling, events, serialization
 from src.app import db
 from src.models import Thread, Message, User, Reaction, Media, ApiKey
+from src.models import COUNTER_TRIGGERS, SEARCH_TRIGGERS
+from src.models import create_counter_triggers, create_search_index, reindex_search
+from src.models import MAX_ID
+from src.versioning import bump_collection_versions
 
 # API keys to be used in the sample database that can be used in testing
 KEY1 = secrets.token_urlsafe()
 KEY2 = secrets.token_urlsafe()
 KEY3 = secrets.token_urlsafe()
 
+# Page size limits for paginated collections
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+# Maximum number of ids in a single batch request
+MAX_BATCH_IDS = 500
+# Maximum number of items in a single bulk request
+MAX_BULK_ITEMS = 10000
+# Rows per multi-row INSERT, so that the bound parameters stay below the
+# 999 variables that older SQLite versions allow in a statement
+BULK_INSERT_ROWS = 150
+# Number of rows fetched at a time and size of the chunks in streamed responses
+STREAM_BATCH_SIZE = 1000
+STREAM_CHUNK_SIZE = 64 * 1024
+# Maximum depth of reply trees, also guards against reply cycles. Every
+# level adds two levels of nesting to the JSON body, and the encoders can't
+# encode bodies nested much deeper (orjson stops at 255 levels), so deeper
+# replies are fetched from the subtree of a message at the deepest level
+MAX_TREE_DEPTH = 100
+
 
 def sample_database():
     """
@@ -211,13 +241,336 @@ def sample_database():
     db.session.commit()
 
 
+# Words of the generated message contents
+SYNTHETIC_WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+    "incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud "
+    "exercitation ullamco laboris nisi aliquip ex ea commodo consequat duis aute "
+    "irure in reprehenderit voluptate velit esse cillum eu fugiat nulla pariatur "
+    "excepteur sint occaecat cupidatat non proident sunt culpa qui officia deserunt "
+    "mollit anim id est laborum"
+).split()
+# Generated messages are spread over the year before this time, so that the
+# same seed always creates the same database
+SYNTHETIC_END = datetime.datetime(2024, 1, 1)
+SYNTHETIC_PERIOD = datetime.timedelta(days=365)
+
+
+def _zipf_weights(count):
+    """
+    Returns cumulative weights of count items whose popularity follows
+    Zipf's law, the most popular item first.
+    """
+    weights = []
+    total = 0.0
+    for rank in range(1, count + 1):
+        total += 1 / rank
+        weights.append(total)
+    return weights
+
+
+def _thread_sizes(threads, messages_per_thread, rng):
+    """
+    Splits threads * messages_per_thread messages between the threads so
+    that a few hot threads have most of the messages and the rest form a
+    long tail. Every thread has at least one message.
+    """
+    weights = _zipf_weights(threads)
+    total = threads * messages_per_thread
+    sizes = [
+        max(1, round(total * (weight - previous) / weights[-1]))
+        for previous, weight in zip([0.0] + weights, weights)
+    ]
+    rng.shuffle(sizes)
+    return sizes
+
+
+def _reply_tree(size, reply_depth, rng):
+    """
+    Picks the parent of every message of a thread. The first message opens
+    the thread and the others reply to one of the recent messages. A reply
+    that would go deeper than reply_depth replies to a random ancestor of
+    the message instead.
+    :return: lists of the parent index (or None) and reply count of every message
+    """
+    parents = [None]
+    depths = [0]
+    reply_counts = [0] * size
+    for index in range(1, size):
+        parent = rng.randrange(max(0, index - 50), index)
+        if depths[parent] >= reply_depth:
+            for _ in range(rng.randint(1, reply_depth + 1)):
+                if parent is not None:
+                    parent = parents[parent]
+        parents.append(parent)
+        if parent is None:
+            depths.append(0)
+        else:
+            depths.append(depths[parent] + 1)
+            reply_counts[parent] += 1
+    return parents, reply_counts
+
+
+def synthetic_database(
+    users, threads, messages_per_thread, reaction_rate, reply_depth, seed, batch_size
+):
+    """
+    Adds a large generated dataset to the database for capacity testing.
+    Thread sizes follow Zipf's law, so a few threads are hot and most
+    are small, and so do the numbers of messages sent by the users. The
+    rows are added with multi-row inserts, batch_size rows at a time, each
+    batch in its own transaction. The counter and search triggers are
+    dropped during the inserts, the counters are computed while generating
+    and the search index is rebuilt at the end. The same arguments always
+    generate the same data.
+    :param users: number of users to create
+    :param threads: number of threads to create
+    :param messages_per_thread: average number of messages in a thread
+    :param reaction_rate: average number of reactions to a message
+    :param reply_depth: maximum depth of replies, 0 creates no replies
+    :param seed: seed of the random generator
+    :param batch_size: number of rows inserted in one transaction
+    :return: numbers of created users, threads, messages and reactions
+    """
+    rng = random.Random(seed)
+    first_user, first_thread, first_message = (
+        db.session.execute(select(func.coalesce(func.max(key), 0))).scalar() + 1
+        for key in (User.id, Thread.id, Message.message_id)
+    )
+    user_ids = range(first_user, first_user + users)
+    sender_weights = _zipf_weights(users)
+    password = User.password_hash("password")
+    start = SYNTHETIC_END - SYNTHETIC_PERIOD
+    period = SYNTHETIC_PERIOD.total_seconds()
+
+    connection = db.session.connection()
+    for name in list(COUNTER_TRIGGERS) + list(SEARCH_TRIGGERS):
+        connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {name}")
+    rows = {User: [], Thread: [], Message: [], Reaction: []}
+    created = dict.fromkeys(rows, 0)
+
+    def flush(force=False):
+        pending = len(rows[User]) + len(rows[Message]) + len(rows[Reaction])
+        if not force and pending < batch_size:
+            return
+        # Parents are inserted before the rows that refer to them. The
+        # inserts use the tables, since ORM bulk inserts are split into a
+        # statement per combination of null columns.
+        for model, batch in rows.items():
+            if batch:
+                db.session.execute(insert(model.__table__), batch)
+                created[model] += len(batch)
+                batch.clear()
+        db.session.commit()
+
+    try:
+        for user_id in user_ids:
+            rows[User].append(
+                {"id": user_id, "username": f"synth{user_id}", "password": password}
+            )
+            flush()
+
+        message_id = first_message
+        sizes = _thread_sizes(threads, messages_per_thread, rng)
+        for thread_id, size in enumerate(sizes, start=first_thread):
+            # Seconds from the start of the period to each message
+            thread_start = rng.random() * period
+            times = sorted(
+                thread_start + rng.random() * (period - thread_start)
+                for _ in range(size)
+            )
+            parents, reply_counts = _reply_tree(size, reply_depth, rng)
+            senders = rng.choices(user_ids, cum_weights=sender_weights, k=size)
+            rows[Thread].append(
+                {
+                    "id": thread_id,
+                    "title": " ".join(rng.choices(SYNTHETIC_WORDS, k=5)).capitalize(),
+                    "message_count": size,
+                    "last_activity_at": start + datetime.timedelta(seconds=times[-1]),
+                }
+            )
+            for index in range(size):
+                reactions = 0
+                if reaction_rate > 0:
+                    reactions = round(rng.expovariate(1 / reaction_rate))
+                reactors = rng.sample(user_ids, min(reactions, users))
+                types = rng.choices((1, 2, 3), (6, 3, 1), k=len(reactors))
+                for user_id, reaction_type in zip(reactors, types):
+                    rows[Reaction].append(
+                        {
+                            "reaction_type": reaction_type,
+                            "user_id": user_id,
+                            "message_id": message_id + index,
+                        }
+                    )
+                parent = parents[index]
+                words = rng.choices(SYNTHETIC_WORDS, k=rng.randint(3, 30))
+                rows[Message].append(
+                    {
+                        "message_id": message_id + index,
+                        "message_content": " ".join(words).capitalize(),
+                        "timestamp": start + datetime.timedelta(seconds=times[index]),
+                        "sender_id": senders[index],
+                        "thread_id": thread_id,
+                        "parent_id": None if parent is None else message_id + parent,
+                        "reaction_count": len(reactors),
+                        "reply_count": reply_counts[index],
+                    }
+                )
+                flush()
+            message_id += size
+        flush(force=True)
+    finally:
+        db.session.rollback()
+        connection = db.session.connection()
+        create_counter_triggers(db.metadata, connection)
+        create_search_index(db.metadata, connection)
+        # Rows inserted without the session don't bump the collection versions
+        bump_collection_versions(
+            connection,
+            {"users", "threads"}
+            | {
+                f"thread-{id}-messages"
+                for id in range(first_thread, first_thread + threads)
+            },
+        )
+        db.session.commit()
+    reindex_search(batch_size)
+    return (created[User], created[Thread], created[Message], created[Reaction])
+
+
+def delete_thread(thread):
+    """
+    Deletes a thread in the current session. Its messages and their
+    replies, reactions and media are deleted by the ON DELETE CASCADE
+    foreign keys without loading them, so the number of statements doesn't
+    depend on the size of the thread. Subscribers of the thread get one
+    thread.deleted event instead of an event per message.
+    :param thread: the thread that is deleted
+    """
+    bump_collection_versions(db.session.connection(), {f"thread-{thread.id}-messages"})
+    events.queue_event(
+        db.session, thread.id, "thread.deleted", {"thread_id": thread.id}
+    )
+    db.session.delete(thread)
+
+
+def delete_user(user, thread_ids=()):
+    """
+    Deletes a user in the current session. The messages and reactions of
+    the user are deleted by the ON DELETE CASCADE foreign keys without
+    loading them. The versions of the collections they were in are bumped
+    here, and every thread they were in gets one user.deleted event.
+    :param user: the user that is deleted
+    :param thread_ids:
+        ids of the threads that earlier transactions deleted messages or
+        reactions of the user from, which also get the event
+    """
+    connection = db.session.connection()
+    sent = select(Message.thread_id).where(Message.sender_id == user.id).distinct()
+    thread_ids = set(thread_ids) | set(connection.execute(sent).scalars())
+    reacted = connection.execute(
+        select(Reaction.message_id, Message.thread_id)
+        .join(Message, Message.message_id == Reaction.message_id)
+        .where(Reaction.user_id == user.id)
+    ).all()
+    thread_ids.update(thread_id for _, thread_id in reacted)
+    names = {f"thread-{thread_id}-messages" for thread_id in thread_ids}
+    names.update(f"message-{message_id}-reactions" for message_id, _ in reacted)
+    if thread_ids:
+        # Message counts and last activity of the threads change
+        names.add("threads")
+    bump_collection_versions(connection, names)
+    for thread_id in sorted(thread_ids):
+        events.queue_event(db.session, thread_id, "user.deleted", {"user_id": user.id})
+    db.session.delete(user)
+
+
+def delete_thread_messages(thread_id, limit):
+    """
+    Deletes up to limit messages of a thread in the current transaction,
+    newest first, together with their replies, reactions and media. Used
+    to delete a large thread in small transactions before the thread
+    itself is deleted with delete_thread.
+    :param thread_id: id of the thread
+    :param limit: maximum number of messages to delete
+    :return: number of deleted messages, not counting cascaded replies
+    """
+    connection = db.session.connection()
+    chunk = (
+        select(Message.message_id)
+        .where(Message.thread_id == thread_id)
+        .order_by(Message.message_id.desc())
+        .limit(limit)
+    )
+    deleted = connection.execute(
+        delete(Message.__table__).where(Message.message_id.in_(chunk.scalar_subquery()))
+    ).rowcount
+    if deleted:
+        bump_collection_versions(
+            connection, {"threads", f"thread-{thread_id}-messages"}
+        )
+    return deleted
+
+
+def delete_user_rows(user_id, limit):
+    """
+    Deletes up to limit reactions of a user in the current transaction, or
+    up to limit messages when the user has no reactions left. Used to
+    delete an active user in small transactions before the user itself is
+    deleted with delete_user.
+    :param user_id: id of the user
+    :param limit: maximum number of rows to delete
+    :return:
+        number of deleted rows, not counting cascaded rows, and the ids of
+        the threads they were in
+    """
+    connection = db.session.connection()
+    reactions = connection.execute(
+        select(Reaction.reaction_id, Reaction.message_id, Message.thread_id)
+        .join(Message, Message.message_id == Reaction.message_id)
+        .where(Reaction.user_id == user_id)
+        .limit(limit)
+    ).all()
+    if reactions:
+        connection.execute(
+            delete(Reaction.__table__).where(
+                Reaction.reaction_id.in_([row.reaction_id for row in reactions])
+            )
+        )
+        thread_ids = {row.thread_id for row in reactions}
+        names = {f"message-{row.message_id}-reactions" for row in reactions}
+        names.update(f"thread-{thread_id}-messages" for thread_id in thread_ids)
+        bump_collection_versions(connection, names)
+        return len(reactions), thread_ids
+
+    messages = connection.execute(
+        select(Message.message_id, Message.thread_id)
+        .where(Message.sender_id == user_id)
+        .order_by(Message.message_id.desc())
+        .limit(limit)
+    ).all()
+    if messages:
+        connection.execute(
+            delete(Message.__table__).where(
+                Message.message_id.in_([row.message_id for row in messages])
+            )
+        )
+        thread_ids = {row.thread_id for row in messages}
+        names = {f"thread-{thread_id}-messages" for thread_id in thread_ids}
+        bump_collection_versions(connection, names | {"threads"})
+        return len(messages), thread_ids
+    return 0, set()
+
+
 # Modified from Exercise 2 Validating Keys example
 # https://lovelace.oulu.fi/ohjelmoitava-web/ohjelmoitava-web/implementing-rest-apis-with-flask/#validating-keys
 def require_authentication(func):
     """
     Authentication decorator for resource methods.
     Checks that the request headers contain correct API key related
-    to the user object that is being accessed.
+    to the user object that is being accessed. Verified keys are kept
+    in src.key_cache, so repeated requests skip the database lookup.
     """
 
     def wrapper(self, user, *args, **kwargs):
@@ -226,9 +579,285 @@ def require_authentication(func):
         except KeyError:
             raise Forbidden
         key_hash = ApiKey.key_hash(token)
+        if key_cache.lookup(user.username, key_hash, user.id, user.version):
+            return func(self, user, *args, **kwargs)
+        since = key_cache.generation()
         db_key = ApiKey.query.filter_by(user=user).first()
         if db_key is not None and secrets.compare_digest(key_hash, db_key.key):
+            key_cache.store(user.username, key_hash, user.id, user.version, since)
             return func(self, user, *args, **kwargs)
         raise Forbidden
 
     return wrapper
+
+
+def json_response(body, status=200, headers=None):
+    """
+    Creates a response with a JSON body encoded by src.serialization. The
+    time spent serializing the body is recorded for request profiling.
+    :param body: JSON serializable body of the response
+    :param status: status code of the response
+    :param headers: additional headers of the response
+    :return: the response
+    """
+    with profiling.timer("serialization"):
+        data = serialization.dumps(body)
+    return Response(data, status=status, mimetype="application/json", headers=headers)
+
+
+def headers_response(doc, status=200):
+    """
+    Creates a response that has the representation of an item in its
+    headers. Values are converted to strings, dates formatted like in JSON
+    bodies.
+    :param doc: the representation of the item
+    :param status: status code of the response
+    :return: the response
+    """
+    headers = {
+        key: value.isoformat() if isinstance(value, datetime.date) else str(value)
+        for key, value in doc.items()
+    }
+    return Response(headers=headers, status=status)
+
+
+def wants_json_body():
+    """
+    Checks whether the client asks for item representations in a JSON body
+    by listing application/json in its Accept header. Other clients get the
+    representation in the headers of the response.
+    """
+    return any(
+        mimetype == "application/json" and quality > 0
+        for mimetype, quality in request.accept_mimetypes
+    )
+
+
+def item_response(doc, etag, header_fields=None):
+    """
+    Creates the response of an item GET request. The representation of the
+    item is in a JSON body if the client asks for one, and in the headers
+    otherwise. The two representations have different ETags.
+    :param doc: the representation of the item
+    :param etag: the ETag of the item
+    :param header_fields: fields that are only included in the headers,
+        kept for the clients that read them
+    :return: the response, or a 304 response if the client already has the
+        current version of the representation
+    """
+    as_json = wants_json_body()
+    if as_json:
+        etag += "-json"
+    response = not_modified(etag)
+    if response is None:
+        if as_json:
+            response = json_response(doc)
+        else:
+            response = headers_response({**doc, **(header_fields or {})})
+        response.set_etag(etag)
+    response.vary.add("Accept")
+    return response
+
+
+def not_modified(etag):
+    """
+    Checks the If-None-Match header of the request against the current ETag
+    of the requested resource.
+    :param etag: the current ETag of the resource
+    :return: a 304 response if the client already has the current version
+        of the resource, otherwise None
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def ndjson_chunks(records):
+    """
+    Encodes records as NDJSON, one JSON document per line. Lines are joined
+    to chunks of about STREAM_CHUNK_SIZE bytes, so that a streamed response
+    isn't written one line at a time.
+    :param records: iterable of JSON serializable records
+    :return: generator of the encoded chunks
+    """
+    lines = []
+    size = 0
+    for record in records:
+        line = serialization.dumps(record) + b"\n"
+        lines.append(line)
+        size += len(line)
+        if size >= STREAM_CHUNK_SIZE:
+            yield b"".join(lines)
+            lines = []
+            size = 0
+    if lines:
+        yield b"".join(lines)
+
+
+def gzip_chunks(chunks):
+    """
+    Compresses a stream of chunks to a single gzip stream.
+    :param chunks: iterable of bytes
+    :return: generator of the compressed chunks
+    """
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def parse_limit():
+    """
+    Reads the page size from the limit query parameter.
+    :return: the requested page size, or the default page size if not given
+    """
+    limit = request.args.get("limit", DEFAULT_PAGE_LIMIT)
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise BadRequest(description="limit must be an integer")
+    if not 1 <= limit <= MAX_PAGE_LIMIT:
+        raise BadRequest(description=f"limit must be between 1 and {MAX_PAGE_LIMIT}")
+    return limit
+
+
+def parse_max_depth():
+    """
+    Reads the maximum depth of a reply tree from the max_depth query parameter.
+    :return: the requested depth, or MAX_TREE_DEPTH if not given
+    """
+    max_depth = request.args.get("max_depth", MAX_TREE_DEPTH)
+    try:
+        max_depth = int(max_depth)
+    except ValueError:
+        raise BadRequest(description="max_depth must be an integer")
+    if not 0 <= max_depth <= MAX_TREE_DEPTH:
+        raise BadRequest(
+            description=f"max_depth must be between 0 and {MAX_TREE_DEPTH}"
+        )
+    return max_depth
+
+
+def parse_id(value):
+    """
+    Parses an id given as a string of ASCII digits. Ids that don't fit the
+    integers of SQLite are rejected, since querying them would overflow.
+    :param value: the id as a string
+    :return: the id as an integer, or None if the string isn't a valid id
+    """
+    if not (value.isascii() and value.isdigit()):
+        return None
+    id = int(value)
+    return id if id <= MAX_ID else None
+
+
+def parse_ids():
+    """
+    Reads the comma separated list of ids from the ids query parameter.
+    :return: list of unique ids in the requested order,
+        or None if the parameter was not given
+    """
+    if "ids" not in request.args:
+        return None
+    ids = [parse_id(id) for id in request.args["ids"].split(",") if id]
+    if None in ids:
+        raise BadRequest(description="ids must be a comma separated list of ids")
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > MAX_BATCH_IDS:
+        raise BadRequest(description=f"At most {MAX_BATCH_IDS} ids can be requested")
+    return ids
+
+
+def parse_bulk_items():
+    """
+    Reads the items of a bulk request from the request body. The body is
+    either a JSON array or NDJSON (Content-Type application/x-ndjson) with
+    one JSON document per line.
+    :return: list of the items, NDJSON lines that are not valid JSON
+        are returned as None
+    """
+    if request.mimetype == "application/x-ndjson":
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+    elif request.is_json:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            raise BadRequest(description="Request body must be a JSON array")
+    else:
+        raise UnsupportedMediaType
+    if not items:
+        raise BadRequest(description="Request body has no items")
+    if len(items) > MAX_BULK_ITEMS:
+        raise BadRequest(
+            description=f"At most {MAX_BULK_ITEMS} items can be sent at once"
+        )
+    return items
+
+
+def ordered_by_ids(objects, ids, key):
+    """
+    Orders objects fetched with an IN query to the order of the requested ids.
+    Ids that were not found are left out.
+    :param objects: the fetched objects
+    :param ids: list of the requested ids
+    :param key: function that returns the id of an object
+    :return: list of the objects in the requested order
+    """
+    by_id = {key(obj): obj for obj in objects}
+    return [by_id[id] for id in ids if id in by_id]
+
+
+def encode_cursor(sort_value, row_id):
+    """
+    Creates an opaque pagination cursor from the sort key of the last row
+    on a page.
+    :param sort_value: timestamp (or other sort value, such as the search
+        rank) of the last row
+    :param row_id: id of the last row
+    :return: URL safe cursor string
+    """
+    if isinstance(sort_value, datetime.datetime):
+        sort_value = sort_value.isoformat()
+    data = json.dumps([sort_value, row_id]).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_cursor(cursor, parse=datetime.datetime.fromisoformat):
+    """
+    Decodes a cursor created with encode_cursor.
+    :param cursor: cursor string from the request
+    :param parse: function that converts the sort value back from JSON
+    :return: tuple of the sort value (timestamp by default) and id the
+        cursor points to
+    """
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(cursor + padding))
+        row_id = int(row_id)
+        if not 0 <= row_id <= MAX_ID:
+            raise ValueError("Row id out of range")
+        return parse(sort_value), row_id
+    except (ValueError, TypeError) as exc:
+        raise BadRequest(description="Invalid cursor") from exc
+
+
+def next_page_link(cursor):
+    """
+    Builds the URL of the next page, keeping the other query parameters
+    of the current request.
+    :param cursor: cursor that points to the last row of the current page
+    :return: URL of the next page
+    """
+    args = request.args.to_dict()
+    args["after"] = cursor
+    return f"{request.base_url}?{urlencode(args)}"
@@ -0,0 +1,74 @@
+import time
+import threading
+from jsonschema import Draft7Validator
+from jsonschema.exceptions import best_match
+
+from src import profiling
+
+# Compiled validators and validation timing for each model
+_validators = {}
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def compile_validators():
+    """
+    Compiles the JSON schema validators of all models that are written through
+    the API. Called once when the app is created, so that the schemas are
+    built and checked only once instead of on every request.
+    """
+    from src.models import Thread, Message, User, Reaction, Media
+
+    register(Thread)
+    register(Message, format_checker=Draft7Validator.FORMAT_CHECKER)
+    register(User)
+    register(Reaction)
+    register(Media)
+
+
+def register(model, format_checker=None):
+    """
+    Compiles the validator for a model's JSON schema and adds it to the registry.
+    :param model: model class with a json_schema method
+    :param format_checker: format checker to use with the schema, if any
+    :return: the compiled validator
+    """
+    schema = model.json_schema()
+    Draft7Validator.check_schema(schema)
+    validator = Draft7Validator(schema, format_checker=format_checker)
+    _validators[model] = validator
+    with _stats_lock:
+        _stats.setdefault(model.__name__, {"count": 0, "time": 0.0})
+    return validator
+
+
+def validate_json(instance, model):
+    """
+    Validates a JSON document against a model's compiled schema.
+    Raises the same ValidationError as jsonschema.validate if the
+    document is invalid.
+    :param instance: the JSON document to validate
+    :param model: model class whose schema is used
+    """
+    validator = _validators.get(model)
+    if validator is None:
+        validator = register(model)
+    start = time.perf_counter()
+    error = best_match(validator.iter_errors(instance))
+    elapsed = time.perf_counter() - start
+    with _stats_lock:
+        stats = _stats[model.__name__]
+        stats["count"] += 1
+        stats["time"] += elapsed
+    profiling.record("validation", elapsed)
+    if error is not None:
+        raise error
+
+
+def validation_stats():
+    """
+    Returns the number of validations and the total time spent validating
+    (in seconds) for each model.
+    """
+    with _stats_lock:
+        return {name: dict(stats) for name, stats in _stats.items()}
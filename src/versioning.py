@@ -0,0 +1,149 @@
+from sqlalchemy import event, inspect, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session, MANYTOONE
+
+from src.app import db
+
+
+def row_changed(obj):
+    """
+    Checks if a flush will update the row of an object, that is if a column
+    or a many-to-one relationship of the object was changed. Changes to
+    collections, such as a new message of a user, don't count.
+    """
+    state = inspect(obj)
+    attrs = [attr.key for attr in state.mapper.column_attrs]
+    attrs += [
+        rel.key for rel in state.mapper.relationships if rel.direction is MANYTOONE
+    ]
+    return any(state.attrs[key].history.has_changes() for key in attrs)
+
+
+def item_etag(obj):
+    """
+    Creates the ETag of an item from its table, primary key and row version.
+    """
+    state = inspect(obj)
+    key = "-".join(str(value) for value in state.identity)
+    return f"{state.mapper.local_table.name}-{key}-{obj.version}"
+
+
+def collection_etag(name):
+    """
+    Creates the ETag of a collection from its collection version. Only the
+    version row is read, so this is cheap to check before the collection
+    query.
+    :param name: name of the collection, see collection_names
+    """
+    from src.models import CollectionVersion
+
+    version = db.session.execute(
+        select(CollectionVersion.version).where(CollectionVersion.name == name)
+    ).scalar()
+    return f"{name}-{version or 0}"
+
+
+def foreign_key_values(obj, column, relationship):
+    """
+    Returns the current and previous values of a foreign key of an object.
+    The key can have been changed through the column or the relationship.
+    Unloaded attributes are not loaded.
+    """
+    state = inspect(obj)
+    values = set(state.attrs[column].history.sum())
+    for parent in state.attrs[relationship].history.deleted or ():
+        if parent is not None and inspect(parent).identity:
+            values.add(inspect(parent).identity[0])
+    values.discard(None)
+    return values
+
+
+def _changes_thread_counters(session, message):
+    """
+    Checks if a message changes the message count or last activity of a
+    thread, which are included in the thread collection.
+    """
+    if message in session.new or message in session.deleted:
+        return True
+    state = inspect(message)
+    return any(
+        state.attrs[key].history.has_changes()
+        for key in ("thread_id", "thread", "timestamp")
+    )
+
+
+def collection_names(session, objects):
+    """
+    Returns the names of the collections whose representation changes when
+    the given objects are added, updated or deleted.
+    """
+    from src.models import Thread, Message, User, Reaction, Media
+
+    names = set()
+    reacted = set()
+    for obj in objects:
+        if isinstance(obj, Thread):
+            names.add("threads")
+        elif isinstance(obj, User):
+            names.add("users")
+        elif isinstance(obj, Message):
+            if _changes_thread_counters(session, obj):
+                names.add("threads")
+            for thread_id in foreign_key_values(obj, "thread_id", "thread"):
+                names.add(f"thread-{thread_id}-messages")
+        elif isinstance(obj, Reaction):
+            for message_id in foreign_key_values(obj, "message_id", "message"):
+                names.add(f"message-{message_id}-reactions")
+                reacted.add(message_id)
+        elif isinstance(obj, Media):
+            for message_id in foreign_key_values(obj, "message_id", "message"):
+                names.add(f"message-{message_id}-media")
+    if reacted:
+        # Expanded message collections include reaction counts
+        threads = session.connection().execute(
+            select(Message.thread_id).where(Message.message_id.in_(reacted))
+        )
+        names.update(f"thread-{thread_id}-messages" for thread_id, in threads)
+    return names
+
+
+@event.listens_for(Session, "before_flush")
+def _bump_row_versions(session, flush_context, instances):
+    """
+    Increments the version of every changed row. The increment is done in
+    the UPDATE statement, so concurrent updates get different versions.
+    """
+    for obj in session.dirty:
+        if hasattr(type(obj), "version") and row_changed(obj):
+            obj.version = type(obj).version + 1
+
+
+def bump_collection_versions(connection, names):
+    """
+    Increments the versions of the given collections. Inserts that bypass
+    the session, such as bulk inserts, must call this themselves.
+    :param connection: connection of the transaction that changed the collections
+    :param names: names of the changed collections
+    """
+    from src.models import CollectionVersion
+
+    if not names:
+        return
+    stmt = insert(CollectionVersion).values([{"name": name} for name in names])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[CollectionVersion.name],
+        set_={"version": CollectionVersion.version + 1},
+    )
+    connection.execute(stmt)
+
+
+@event.listens_for(Session, "after_flush")
+def _bump_collection_versions(session, flush_context):
+    """
+    Increments the version of every collection that the flush changed.
+    """
+    changed = [obj for obj in session.dirty if row_changed(obj)]
+    names = collection_names(
+        session, list(session.new) + changed + list(session.deleted)
+    )
+    bump_collection_versions(session.connection(), names)
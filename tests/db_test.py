@@ -3,11 +3,14 @@ import pytest
 import tempfile
 import secrets
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from src.app import create_app, db
 from src.models import Thread, Message, User, Reaction, Media, ApiKey
+from src.models import CollectionVersion, message_fts, repair_counters
+from src import events, jobs
+from src.utils import delete_thread, delete_user
 from sqlalchemy.engine import Engine
-from sqlalchemy import event
+from sqlalchemy import event, select, func
 from sqlalchemy.exc import IntegrityError, StatementError
 
 
@@ -129,17 +132,19 @@ def test_reaction_relationships(app):
     with app.app_context():
         thread = _get_thread()
         user = _get_user()
+        user2 = _get_user(username="username2")
         message = _get_message(user, thread)
         reaction1 = _get_reaction(user=user, message=message)
-        reaction2 = _get_reaction(user=user, message=message)
+        reaction2 = _get_reaction(user=user2, message=message)
 
         assert reaction1.message_id == message.message_id
         assert reaction2.message_id == message.message_id
         assert reaction1.user_id == user.id
-        assert reaction2.user_id == user.id
+        assert reaction2.user_id == user2.id
 
         db.session.add(thread)
         db.session.add(user)
+        db.session.add(user2)
         db.session.add(reaction1)
         db.session.add(reaction2)
         db.session.commit()
@@ -448,6 +453,156 @@ def test_thread_delete_cascades(app):
         assert Message.query.count() == 0
 
 
+def test_delete_without_loading(app):
+    """
+    Tests that deleting a thread or a user deletes their rows with database
+    cascades without loading them, keeps the counters and the search index
+    up to date, bumps the versions of the changed collections and sends one
+    event per affected thread.
+    """
+    with app.app_context():
+        user, other_user = _get_user(), _get_user("other")
+        thread, other_thread = _get_thread(), _get_thread()
+        message = _get_message(user=other_user, thread=thread)
+        reply = _get_message(user=user, thread=thread, parent=message)
+        other = _get_message(user=other_user, thread=other_thread)
+        db.session.add_all(
+            [reply, other, _get_reaction(user, other), _get_media(message=message)]
+        )
+        db.session.add(_get_reaction(other_user, reply))
+        db.session.commit()
+        user_id, other_id = user.id, other.message_id
+        thread_id, other_thread_id = thread.id, other_thread.id
+        versions = dict(
+            db.session.query(CollectionVersion.name, CollectionVersion.version)
+        )
+        db.session.expunge_all()
+
+        since = events.current_event_id()
+        statements = []
+
+        def listen(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", listen)
+        try:
+            delete_user(db.session.get(User, user_id))
+            db.session.commit()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", listen)
+        # Messages and reactions aren't loaded into the session
+        assert not any(
+            s.startswith(("SELECT message.", "SELECT reaction.reaction_id"))
+            for s in statements
+        )
+        assert Message.query.count() == 2
+        assert Reaction.query.count() == 0
+        assert repair_counters() == (0, 0)
+        new_versions = dict(
+            db.session.query(CollectionVersion.name, CollectionVersion.version)
+        )
+        for name in (
+            f"thread-{thread_id}-messages",
+            f"thread-{other_thread_id}-messages",
+            f"message-{other_id}-reactions",
+        ):
+            assert new_versions[name] > versions.get(name, 0)
+        assert _published_events(thread_id, since) == ["user.deleted"]
+        assert _published_events(other_thread_id, since) == ["user.deleted"]
+
+        since = events.current_event_id()
+        delete_thread(db.session.get(Thread, thread_id))
+        db.session.commit()
+        assert Message.query.count() == 1
+        assert Media.query.count() == 0
+        assert db.session.query(message_fts).count() == 1
+        assert _published_events(thread_id, since) == ["thread.deleted"]
+
+
+def test_delete_jobs(app):
+    """
+    Tests that deletion jobs delete a user and a thread in chunks, keeping
+    the counters up to date, and that a job that raises is marked failed.
+    """
+    app.config.update(JOB_CHUNK_SIZE=2, JOB_CHUNK_DELAY=0)
+    with app.app_context():
+        user, other_user = _get_user(), _get_user("other")
+        thread, other_thread = _get_thread(), _get_thread()
+        messages = [_get_message(user=user, thread=thread) for _ in range(3)]
+        other = _get_message(user=other_user, thread=other_thread)
+        reactions = [_get_reaction(user, message) for message in [other] + messages]
+        db.session.add_all(messages + reactions)
+        db.session.commit()
+        since = events.current_event_id()
+
+        user_job, _ = jobs.create_job("delete-user", user.id)
+        failing_job, _ = jobs.create_job("unknown", 1)
+        db.session.commit()
+        jobs.submit(user_job.id)
+        jobs.submit(failing_job.id)
+        jobs.wait()
+        db.session.expire_all()
+        # 4 reactions, 3 messages and the user
+        assert (user_job.status, user_job.deleted_rows) == ("done", 8)
+        assert failing_job.status == "failed"
+        assert "unknown" in failing_job.error
+        assert User.query.count() == 1
+        assert Message.query.count() == 1
+        assert Reaction.query.count() == 0
+        assert repair_counters() == (0, 0)
+        assert _published_events(thread.id, since) == ["user.deleted"]
+        assert _published_events(other_thread.id, since) == ["user.deleted"]
+
+        thread_job, _ = jobs.create_job("delete-thread", other_thread.id)
+        db.session.commit()
+        jobs.submit(thread_job.id)
+        jobs.wait()
+        db.session.expire_all()
+        assert (thread_job.status, thread_job.deleted_rows) == ("done", 2)
+        assert Thread.query.count() == 1
+        assert Message.query.count() == 0
+
+
+def test_job_claims(app):
+    """
+    Tests that a job is run only by the worker that claims it, and that a
+    running job is taken over only when its heartbeat has gone stale.
+    """
+    app.config.update(JOB_CHUNK_SIZE=2, JOB_CHUNK_DELAY=0)
+    with app.app_context():
+        user, thread = _get_user(), _get_thread()
+        db.session.add_all([_get_message(user, thread) for _ in range(3)])
+        db.session.commit()
+        job, _ = jobs.create_job("delete-thread", thread.id)
+        db.session.commit()
+        # Another worker claimed the job and is still running it
+        job.status, job.owner = "running", "other-worker"
+        job.heartbeat_at = datetime.now()
+        db.session.commit()
+        jobs.submit(job.id)
+        jobs.wait()
+        db.session.expire_all()
+        assert (job.status, job.owner, job.deleted_rows) == (
+            "running",
+            "other-worker",
+            0,
+        )
+        assert Message.query.count() == 3
+
+        # The other worker stopped reporting progress
+        job.heartbeat_at = datetime.now() - timedelta(
+            seconds=app.config["JOB_STALE_AFTER"] + 1
+        )
+        db.session.commit()
+        jobs.submit(job.id)
+        jobs.submit(job.id)
+        jobs.wait()
+        db.session.expire_all()
+        assert (job.status, job.deleted_rows) == ("done", 4)
+        assert job.owner != "other-worker"
+        assert Thread.query.count() == 0
+
+
 def test_apikey_delete_doesnt_cascade(app):
     """
     Tests that deleting an API key doesn't delete connected user.
@@ -467,3 +622,341 @@ def test_apikey_delete_doesnt_cascade(app):
 
         assert User.query.count() == 1
         assert ApiKey.query.count() == 0
+
+
+def test_reaction_unique_per_user(app):
+    """
+    Tests that a user can't react to the same message twice.
+    """
+    with app.app_context():
+        user = _get_user()
+        message = _get_message(user, _get_thread())
+        db.session.add(_get_reaction(user, message))
+        db.session.add(_get_reaction(user, message))
+        with pytest.raises(IntegrityError):
+            db.session.commit()
+
+
+def test_check_query_plans(app):
+    """
+    Tests that no endpoint query scans a table, and that the check fails
+    when a needed index is missing.
+    """
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["check-query-plans"])
+    assert result.exit_code == 0
+    # Full-text searches are reported as scans of the virtual table index
+    scans = [line for line in result.output.splitlines() if "SCAN " in line]
+    assert all("VIRTUAL TABLE INDEX" in line for line in scans)
+
+    with app.app_context():
+        db.session.execute(db.text("DROP INDEX ix_media_message"))
+        db.session.commit()
+        # Pooled connections cache the previously prepared EXPLAIN statements
+        db.engine.dispose()
+    result = runner.invoke(args=["check-query-plans"])
+    assert result.exit_code != 0
+    assert "media collection" in result.output
+
+
+def test_populate_synthetic(app):
+    """
+    Tests that populate-db generates the requested amount of data with
+    correct counters and search index, keeps the triggers, and generates
+    the same data again with the same seed.
+    """
+    runner = app.test_cli_runner()
+    args = ["populate-db", "--users", "20", "--threads", "10"]
+    args += ["--messages-per-thread", "30", "--reply-depth", "3", "--seed", "1"]
+    result = runner.invoke(args=args + ["--batch-size", "50"])
+    assert result.exit_code == 0
+    assert "Created 20 users, 10 threads" in result.output
+    with app.app_context():
+        messages = Message.query.order_by(Message.message_id).all()
+        assert abs(len(messages) - 300) <= 10
+        sizes = sorted(thread.message_count for thread in Thread.query)
+        assert sizes[-1] > 5 * sizes[0]
+        assert repair_counters() == (0, 0)
+        reply = messages[-1]
+        depth = 0
+        while reply.parent is not None:
+            reply, depth = reply.parent, depth + 1
+        assert depth <= 3
+        contents = [(m.message_content, m.timestamp) for m in messages]
+        found = db.session.execute(
+            select(func.count())
+            .select_from(message_fts)
+            .where(message_fts.c.message_fts.match("lorem"))
+        ).scalar()
+        assert found == sum("lorem" in m.message_content.lower() for m in messages)
+
+        # Triggers are back in place
+        thread = db.session.get(Thread, 1)
+        count = thread.message_count
+        db.session.add(_get_message(user=db.session.get(User, 1), thread=thread))
+        db.session.commit()
+        assert thread.message_count == count + 1
+
+    # The same seed generates the same messages again after the existing ones
+    result = runner.invoke(args=args)
+    assert result.exit_code == 0
+    with app.app_context():
+        messages = Message.query.filter(Message.message_id > len(contents) + 1)
+        messages = messages.order_by(Message.message_id).all()
+        assert [(m.message_content, m.timestamp) for m in messages] == contents
+
+
+def test_row_versions(app):
+    """
+    Tests that the row version of an object is incremented on update, and
+    that the versions of the collections it belongs to are incremented.
+    """
+    with app.app_context():
+        thread = _get_thread()
+        message = _get_message(user=_get_user(), thread=thread)
+        db.session.add(message)
+        db.session.commit()
+        assert thread.version == 1
+        assert message.version == 1
+        threads = db.session.get(CollectionVersion, "threads").version
+        messages = db.session.get(CollectionVersion, "thread-1-messages").version
+
+        message.message_content = "edited"
+        db.session.commit()
+        assert message.version == 2
+        assert thread.version == 1
+        assert db.session.get(CollectionVersion, "threads").version == threads
+        assert (
+            db.session.get(CollectionVersion, "thread-1-messages").version
+            == messages + 1
+        )
+
+
+def _published_events(thread_id, since):
+    """
+    Returns the types of the events of a thread published after an event id.
+    """
+    types = []
+    for message in events.subscribe(thread_id, since, keepalive=0):
+        if message == ": keepalive\n\n":
+            break
+        if not message.startswith(":"):
+            types.append(message.split("\n")[1].split(": ")[1])
+    return types
+
+
+def test_events(app):
+    """
+    Tests that events are published when a transaction is committed, not
+    when it is rolled back, and that a message moved to another thread is
+    deleted from the events of the old thread.
+    """
+    with app.app_context():
+        since = events.current_event_id()
+        thread, other = _get_thread(), _get_thread()
+        message = _get_message(user=_get_user(), thread=thread)
+        db.session.add_all([message, other])
+        db.session.flush()
+        assert events.current_event_id() == since
+        db.session.commit()
+        assert _published_events(thread.id, since) == ["message.created"]
+
+        since = events.current_event_id()
+        db.session.add(_get_reaction(user=message.user, message=message))
+        db.session.flush()
+        db.session.rollback()
+        assert events.current_event_id() == since
+
+        assert message.thread is thread
+        message.thread = other
+        db.session.commit()
+        assert _published_events(thread.id, since) == ["message.deleted"]
+        assert _published_events(other.id, since) == ["message.updated"]
+
+
+def test_counters(app):
+    """
+    Tests that the thread and message counters are kept up to date on insert,
+    update and delete, including rows deleted by database cascades, and that
+    repair-counters fixes counters that are wrong.
+    """
+    with app.app_context():
+        user = _get_user()
+        thread = _get_thread()
+        other_thread = _get_thread()
+        message = _get_message(user=user, thread=thread)
+        reply = _get_message(user=user, thread=thread, parent=message)
+        reaction = _get_reaction(user=user, message=message)
+        db.session.add_all([other_thread, reply, reaction])
+        db.session.commit()
+        assert thread.message_count == 2
+        assert thread.last_activity_at == reply.timestamp
+        assert message.reply_count == 1
+        assert message.reaction_count == 1
+
+        # Moving a reply to another thread
+        reply.thread = other_thread
+        reply.parent = None
+        db.session.commit()
+        assert thread.message_count == 1
+        assert other_thread.message_count == 1
+        assert message.reply_count == 0
+
+        # Replies deleted by ON DELETE CASCADE
+        reply.thread = thread
+        reply.parent = message
+        db.session.commit()
+        db.session.delete(reaction)
+        db.session.execute(db.text("DELETE FROM message WHERE parent_id IS NULL"))
+        db.session.commit()
+        assert thread.message_count == 0
+        assert thread.last_activity_at is None
+
+        db.session.execute(db.text("UPDATE thread SET message_count = 5"))
+        db.session.commit()
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["repair-counters"])
+    assert result.exit_code == 0
+    assert "2 threads and 0 messages" in result.output
+    with app.app_context():
+        assert [thread.message_count for thread in Thread.query] == [0, 0]
+
+
+def test_add_missing_columns(app):
+    """
+    Tests that init-db adds the version column to a database created
+    before it.
+    """
+    with app.app_context():
+        db.session.execute(db.text("ALTER TABLE thread DROP COLUMN version"))
+        db.session.execute(db.text("INSERT INTO thread (title) VALUES ('old')"))
+        db.session.commit()
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["init-db"])
+    assert result.exit_code == 0
+    with app.app_context():
+        assert Thread.query.first().version == 1
+
+
+def test_init_db_duplicate_reactions(app):
+    """
+    Tests that init-db lists the duplicate reactions of a database created
+    before the unique index of reactions, and removes all but the oldest
+    of them when asked to.
+    """
+    with app.app_context():
+        db.session.execute(db.text("DROP INDEX ix_reaction_message_user"))
+        user, thread = _get_user(), _get_thread()
+        message = _get_message(user, thread)
+        reactions = [_get_reaction(user, message) for i in range(3)]
+        db.session.add_all(reactions)
+        db.session.commit()
+        reaction_ids = [reaction.reaction_id for reaction in reactions]
+        message_id = message.message_id
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["init-db"])
+    assert result.exit_code == 1
+    assert (
+        f"message {message_id}, user 1: reactions "
+        f"{reaction_ids[0]}, {reaction_ids[1]}, {reaction_ids[2]}" in result.output
+    )
+    with app.app_context():
+        assert Reaction.query.count() == 3
+
+    result = runner.invoke(args=["init-db", "--remove-duplicate-reactions"])
+    assert result.exit_code == 0, result.output
+    with app.app_context():
+        assert [reaction.reaction_id for reaction in Reaction.query] == reaction_ids[:1]
+        assert Message.query.one().reaction_count == 1
+        db.session.add(_get_reaction(User.query.one(), Message.query.one()))
+        with pytest.raises(IntegrityError):
+            db.session.commit()
+
+
+def test_enable_autoincrement(app):
+    """
+    Tests that init-db rebuilds tables created without AUTOINCREMENT, so
+    that the ids of deleted rows aren't reused, keeping the rows, triggers
+    and foreign keys.
+    """
+    options = [table.dialect_options["sqlite"] for table in db.metadata.sorted_tables]
+    autoincrement = [option["autoincrement"] for option in options]
+    with app.app_context():
+        db.drop_all()
+        for option in options:
+            option["autoincrement"] = False
+        try:
+            db.create_all()
+        finally:
+            for option, value in zip(options, autoincrement):
+                option["autoincrement"] = value
+        user, thread = _get_user(), _get_thread()
+        message = _get_message(user, thread)
+        db.session.add_all([message, _get_reaction(user, message)])
+        db.session.commit()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["init-db"])
+    assert result.exit_code == 0, result.output
+    with app.app_context():
+        schema = dict(
+            db.session.execute(
+                db.text("SELECT name, sql FROM sqlite_master WHERE type = 'table'")
+            ).all()
+        )
+        for name in ("thread", "message", "user", "reaction", "media"):
+            assert "AUTOINCREMENT" in schema[name]
+        assert Reaction.query.one().message_id == Message.query.one().message_id
+        assert db.session.execute(db.text("PRAGMA foreign_key_check")).all() == []
+        assert db.session.execute(db.text("PRAGMA foreign_keys")).scalar() == 1
+
+        thread = Thread.query.one()
+        reply = _get_message(User.query.one(), thread)
+        db.session.add(reply)
+        db.session.commit()
+        reply_id = reply.message_id
+        db.session.delete(reply)
+        db.session.commit()
+        reply = _get_message(User.query.one(), thread)
+        db.session.add(reply)
+        db.session.commit()
+        assert reply.message_id == reply_id + 1
+        # The counter and search triggers were created again
+        db.session.refresh(thread)
+        assert thread.message_count == 2
+        assert repair_counters() == (0, 0)
+        assert (
+            db.session.execute(select(func.count()).select_from(message_fts)).scalar()
+            == 2
+        )
+
+
+def test_sqlite_pragmas(app):
+    """
+    Tests that the configured SQLite pragmas and pool settings are used.
+    """
+    with app.app_context():
+        assert db.session.execute(db.text("PRAGMA journal_mode")).scalar() == "wal"
+        assert db.session.execute(db.text("PRAGMA synchronous")).scalar() == 1
+        assert db.session.execute(db.text("PRAGMA busy_timeout")).scalar() == 5000
+        assert db.engine.pool.size() == app.config["SQLITE_POOL_OPTIONS"]["pool_size"]
+
+
+def test_sqlite_pragmas_disabled():
+    """
+    Tests that the pragmas can be disabled from the config.
+    """
+    db_fd, db_fname = tempfile.mkstemp()
+    config = {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "SQLITE_PRAGMAS": {},
+    }
+    app = create_app(config)
+    with app.app_context():
+        assert db.session.execute(db.text("PRAGMA journal_mode")).scalar() == "delete"
+        db.session.remove()
+        db.engine.dispose()
+    os.close(db_fd)
+    os.unlink(db_fname)
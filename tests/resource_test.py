@@ -1,6 +1,8 @@
 import os
 import re
+import gzip
 import json
+import logging
 import pytest
 import tempfile
 import pytz
@@ -9,7 +11,11 @@ from sqlalchemy.engine import Engine
 from sqlalchemy import event
 
 from src.app import create_app, db
-from src.utils import sample_database, KEY1, KEY2
+from src import profiling, metrics, jobs, key_cache, serialization
+from src.key_cache import key_cache_stats
+from src.models import ApiKey, User, Thread, Message
+from src.utils import sample_database, encode_cursor, KEY1, KEY2
+from src.utils import BULK_INSERT_ROWS, MAX_TREE_DEPTH
 
 
 @event.listens_for(Engine, "connect")
@@ -39,6 +45,17 @@ def _populate_test_db():
     sample_database()
 
 
+def _finished_job(client, resp):
+    """
+    Waits for the background job started by a request to finish and
+    returns the job.
+    """
+    jobs.wait()
+    resp = client.get(resp.headers["Location"])
+    assert resp.status_code == 200
+    return resp.json
+
+
 def _get_user(username="username", password="password"):
     return {"username": username, "password": password}
 
@@ -73,6 +90,185 @@ def _get_media(media_url=None, message_id=None):
     return {"media_url": media_url, "message_id": message_id}
 
 
+class TestProfiling(object):
+    MESSAGES_URL = "/api/threads/thread-1/messages/"
+
+    def test_profiling(self, client, caplog):
+        """
+        Tests request profiling.
+        Case 1: Sampled write -> Server-Timing header with SQL and validation
+            times and a log line with the same timings
+        Case 2: Sampled read -> Server-Timing header with serialization time
+        Case 3: Request that isn't sampled -> no header
+        Case 4: Slow request that isn't sampled -> log line with wall time
+        """
+        app = client.application
+        app.config.update(PROFILING_SAMPLE_RATE=1.0, PROFILING_SLOW_MS=None)
+        profiling.init_app(app)
+        caplog.set_level(logging.INFO, logger="src.profiling")
+
+        # Case 1
+        resp = client.post(self.MESSAGES_URL, json=_get_message())
+        assert resp.status_code == 201
+        timing = resp.headers["Server-Timing"]
+        assert re.match(r'app;dur=[\d.]+, sql;dur=[\d.]+;desc="\d+ statements"', timing)
+        assert "validation;dur=" in timing
+        record = json.loads(caplog.records[-1].getMessage())
+        assert record["endpoint"] == "api.messagecollection"
+        assert record["status"] == 201
+        assert record["statements"] > 0
+        assert record["validation_ms"] > 0
+
+        # Case 2
+        resp = client.get(self.MESSAGES_URL)
+        record = json.loads(caplog.records[-1].getMessage())
+        assert record["serialization_ms"] > 0
+        assert f"serialization;dur={record['serialization_ms']}" in (
+            resp.headers["Server-Timing"]
+        )
+
+        # Case 3
+        app.config["PROFILING_SAMPLE_RATE"] = 0
+        count = len(caplog.records)
+        resp = client.get(self.MESSAGES_URL)
+        assert "Server-Timing" not in resp.headers
+        assert len(caplog.records) == count
+
+        # Case 4
+        app.config["PROFILING_SLOW_MS"] = 0
+        resp = client.get(self.MESSAGES_URL)
+        record = json.loads(caplog.records[-1].getMessage())
+        assert record["path"] == self.MESSAGES_URL
+        assert "wall_ms" in record and "sql_ms" not in record
+
+
+class TestApiDocs(object):
+    def test_get(self, client):
+        """
+        Tests the API documentation.
+        Case 1: Documentation file isn't read before it's requested
+        Case 2: Get API spec -> 200 with the documented paths
+        Case 3: API_DOCS disabled -> 404
+        """
+        # Case 1
+        assert client.application.swag._template is None
+
+        # Case 2
+        resp = client.get("/apispec_1.json")
+        assert resp.status_code == 200
+        assert "/threads/{thread}/" in resp.json["paths"]
+        assert client.get("/apidocs/").status_code == 200
+
+        # Case 3
+        app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "API_DOCS": False})
+        assert app.test_client().get("/apidocs/").status_code == 404
+
+
+class TestMetrics(object):
+    REACTIONS_URL = "/api/threads/thread-1/messages/message-1/reactions/"
+    REACTIONS_ROUTE = "/api/threads/<thread>/messages/<message>/reactions/"
+
+    @staticmethod
+    def _value(text, name, **labels):
+        """
+        Returns the value of a sample in a metrics response, 0 if it's
+        missing.
+        """
+        pattern = re.escape(name)
+        if labels:
+            pattern += (
+                r"\{"
+                + ",".join(
+                    f'{key}="{re.escape(value)}"' for key, value in labels.items()
+                )
+                + r"\}"
+            )
+        match = re.search(rf"^{pattern} (\S+)$", text, re.MULTILINE)
+        return float(match.group(1)) if match else 0
+
+    def test_metrics(self, client):
+        """
+        Tests the metrics endpoint.
+        Case 1: Requests are counted by route template, method and status
+            and their duration is added to the route's histogram
+        Case 2: Requests that don't match a route -> counted as unmatched
+        Case 3: Connection pool wait times, the in-flight gauge and the API
+            key cache statistics are reported
+        Case 4: Metrics of other processes in METRICS_DIR are added, gauges
+            only for processes that are running
+        """
+        labels = {"route": self.REACTIONS_ROUTE, "method": "GET"}
+        before = client.get("/metrics").get_data(as_text=True)
+
+        # Case 1
+        client.get(self.REACTIONS_URL)
+        client.get(self.REACTIONS_URL)
+        resp = client.get("/metrics")
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/plain"
+        text = resp.get_data(as_text=True)
+        assert "# TYPE http_request_duration_seconds histogram" in text
+        name = "http_requests_total"
+        ok = dict(labels, status="200")
+        assert self._value(text, name, **ok) == self._value(before, name, **ok) + 2
+        name = "http_request_duration_seconds_count"
+        assert (
+            self._value(text, name, **labels) == self._value(before, name, **labels) + 2
+        )
+        buckets = re.findall(
+            rf'^http_request_duration_seconds_bucket\{{route="{re.escape(self.REACTIONS_ROUTE)}",'
+            r'method="GET",le="([^"]+)"\} (\S+)$',
+            text,
+            re.MULTILINE,
+        )
+        assert buckets[-1][0] == "+Inf"
+        counts = [float(count) for _, count in buckets]
+        assert counts == sorted(counts)
+        assert counts[-1] == self._value(text, name, **labels)
+
+        # Case 2
+        client.get("/api/nonexistent/")
+        text = client.get("/metrics").get_data(as_text=True)
+        assert self._value(
+            text, "http_requests_total", route="unmatched", method="GET", status="404"
+        )
+
+        # Case 3
+        assert self._value(text, "db_pool_checkout_wait_seconds_count") > 0
+        # The scrape itself is in flight
+        assert self._value(text, "http_requests_in_flight") == 1
+        stats = key_cache_stats()
+        assert self._value(text, "api_key_cache_hits_total") == stats["hits"]
+        assert self._value(text, "api_key_cache_misses_total") == stats["misses"]
+        assert "# TYPE api_key_cache_size gauge" in text
+
+        # Case 4
+        with tempfile.TemporaryDirectory() as directory:
+            metrics.configure(directory, 5)
+            try:
+                key = [self.REACTIONS_ROUTE, "GET", "200"]
+                other = {
+                    "counters": {"http_requests_total": [[key, 5]]},
+                    "histograms": {},
+                    "gauges": {"http_requests_in_flight": [[[], 3]]},
+                }
+                # A pid that can't be running
+                with open(os.path.join(directory, "metrics-99999999.json"), "w") as f:
+                    json.dump(other, f)
+                text = client.get("/metrics").get_data(as_text=True)
+                assert os.path.exists(
+                    os.path.join(directory, f"metrics-{os.getpid()}.json")
+                )
+                ok = dict(labels, status="200")
+                name = "http_requests_total"
+                assert (
+                    self._value(text, name, **ok) == self._value(before, name, **ok) + 7
+                )
+                assert self._value(text, "http_requests_in_flight") == 1
+            finally:
+                metrics.configure(None, 5)
+
+
 class TestUserCollection(object):
     RESOURCE_URL = "/api/users/"
 
@@ -109,6 +305,31 @@ class TestUserCollection(object):
         resp = client.post(self.RESOURCE_URL, json=invalid_user)
         assert resp.status_code == 400
 
+    def test_get(self, client):
+        """
+        Tests batch get method for user collection.
+        Case 1: Get existing users by ids -> 200
+        Case 2: Get without ids -> 400
+        Case 3: Invalid ids or ids beyond 64 bits -> 400
+        """
+        # Case 1
+        resp = client.get(self.RESOURCE_URL + "?ids=3,1,99")
+        assert resp.status_code == 200
+        assert json.loads(resp.data) == [
+            {"user_id": 3, "username": "user3"},
+            {"user_id": 1, "username": "user1"},
+        ]
+
+        # Case 2
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 400
+
+        # Case 3
+        resp = client.get(self.RESOURCE_URL + "?ids=1,a")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?ids=1,99999999999999999999999")
+        assert resp.status_code == 400
+
 
 class TestUserItem(object):
     RESOURCE_URL = "/api/users/user1/"
@@ -121,6 +342,7 @@ class TestUserItem(object):
         Tests get method for user item.
         Case 1: Get existing user -> 200
         Case 2: Get non-existing user -> 404
+        Case 3: Get existing user as JSON -> 200 with a JSON body
         """
         # Case 1
         resp = client.get(self.RESOURCE_URL)
@@ -131,6 +353,11 @@ class TestUserItem(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+        # Case 3
+        resp = client.get(self.RESOURCE_URL, headers={"Accept": "application/json"})
+        assert resp.status_code == 200
+        assert resp.json["username"] == self.RESOURCE_URL.split("/")[-2]
+
     def test_put(self, client):
         """
         Tests put method for user item.
@@ -192,7 +419,7 @@ class TestUserItem(object):
         Tests delete method for user item.
         Case 1: Delete without API key -> 403
         Case 2: Delete with wrong API key -> 403
-        Case 3: Delete existing user -> 204
+        Case 3: Delete existing user -> 202 with a job that deletes it
         Case 4: Delete previously deleted user -> 404
         Case 5: Delete non-existing resource -> 404
         """
@@ -206,7 +433,10 @@ class TestUserItem(object):
 
         # Case 3
         resp = client.delete(self.RESOURCE_URL, headers={"Api-key": self.RESOURCE_KEY})
-        assert resp.status_code == 204
+        assert resp.status_code == 202
+        job = _finished_job(client, resp)
+        assert job["kind"] == "delete-user"
+        assert job["status"] == "done"
 
         # Case 4
         resp = client.delete(self.RESOURCE_URL, headers={"Api-key": self.RESOURCE_KEY})
@@ -216,6 +446,65 @@ class TestUserItem(object):
         resp = client.delete(self.INVALID_URL, headers={"Api-key": self.RESOURCE_KEY})
         assert resp.status_code == 404
 
+    def test_key_cache(self, client):
+        """
+        Tests caching of verified API keys.
+        Case 1: Repeated request with the same key -> cache hit
+        Case 2: Request with a rotated key -> 403
+        Case 3: Request with the new key -> 204
+        Case 4: Key cached by another process before the key was rotated
+            -> 403
+        """
+        user = _get_user(username="user1")
+        # Case 1
+        resp = client.put(
+            self.RESOURCE_URL, headers={"Api-key": self.RESOURCE_KEY}, json=user
+        )
+        assert resp.status_code == 204
+        before = key_cache_stats()
+        resp = client.put(
+            self.RESOURCE_URL, headers={"Api-key": self.RESOURCE_KEY}, json=user
+        )
+        assert resp.status_code == 204
+        assert key_cache_stats()["hits"] == before["hits"] + 1
+
+        # Case 2
+        with client.application.app_context():
+            db_key = ApiKey.query.filter_by(user_id=1).first()
+            db_key.key = ApiKey.key_hash("rotated key")
+            db.session.commit()
+        resp = client.put(
+            self.RESOURCE_URL, headers={"Api-key": self.RESOURCE_KEY}, json=user
+        )
+        assert resp.status_code == 403
+
+        # Case 3
+        resp = client.put(
+            self.RESOURCE_URL, headers={"Api-key": "rotated key"}, json=user
+        )
+        assert resp.status_code == 204
+
+        # Case 4
+        with client.application.app_context():
+            db_user = db.session.get(User, 1)
+            version = db_user.version
+            db_key = ApiKey.query.filter_by(user_id=1).first()
+            db_key.key = ApiKey.key_hash("second key")
+            db.session.commit()
+            assert db_user.version == version + 1
+        # Cached by a process that didn't see the change
+        key_cache.store(
+            "user1",
+            ApiKey.key_hash("rotated key"),
+            1,
+            version,
+            key_cache.generation(),
+        )
+        resp = client.put(
+            self.RESOURCE_URL, headers={"Api-key": "rotated key"}, json=user
+        )
+        assert resp.status_code == 403
+
 
 class TestReactionCollection(object):
     RESOURCE_URL = "/api/threads/thread-1/messages/message-1/reactions/"
@@ -246,6 +535,16 @@ class TestReactionCollection(object):
         )
         resp = client.post(self.RESOURCE_URL, json=invalid_reaction)
         assert resp.status_code == 400
+        reaction = _get_reaction(
+            reaction_type=9, user_id=99999999999999999999999, message_id=1
+        )
+        resp = client.post(self.RESOURCE_URL, json=reaction)
+        assert resp.status_code == 400
+
+        # Case 5
+        reaction = _get_reaction(reaction_type=9, user_id=2, message_id=4)
+        resp = client.post(self.RESOURCE_URL, json=reaction)
+        assert resp.status_code == 409
 
     def test_get(self, client):
         """
@@ -264,6 +563,109 @@ class TestReactionCollection(object):
         assert resp.status_code == 404
 
 
+class TestMessageSearch(object):
+    RESOURCE_URL = "/api/search/"
+
+    def test_get(self, client):
+        """
+        Tests get method for message search.
+        Case 1: Search a word -> 200 with matches and snippets
+        Case 2: Search with thread and sender filters -> 200
+        Case 3: Search pages -> 200 with every match once
+        Case 4: Search an edited message -> 200 with the new content only
+        Case 5: Search without words or with an invalid filter -> 400
+        Case 6: Search a message with HTML -> 200 with the content escaped
+            in the snippet
+        """
+        # Case 1
+        resp = client.get(self.RESOURCE_URL + "?q=opening")
+        assert resp.status_code == 200
+        results = resp.json["results"]
+        assert [result["message_id"] for result in results] == [1, 5, 9]
+        assert results[0]["snippet"] == "Thread <mark>opening</mark> message"
+
+        # Case 2
+        resp = client.get(self.RESOURCE_URL + "?q=repl*&thread=2&sender=3")
+        assert resp.status_code == 200
+        assert [result["message_id"] for result in resp.json["results"]] == [7]
+
+        # Case 3
+        url = self.RESOURCE_URL + "?q=reply&limit=3"
+        message_ids = []
+        while url:
+            resp = client.get(url)
+            assert resp.status_code == 200
+            message_ids += [result["message_id"] for result in resp.json["results"]]
+            link = resp.headers.get("Link")
+            url = link[1 : link.index(">")] if link else None
+        assert sorted(message_ids) == [2, 3, 4, 6, 7, 8, 10, 11]
+
+        # Case 4
+        message = _get_message(message_content="edited content")
+        resp = client.put("/api/threads/thread-1/messages/message-1/", json=message)
+        assert resp.status_code == 204
+        resp = client.get(self.RESOURCE_URL + "?q=edited")
+        assert [result["message_id"] for result in resp.json["results"]] == [1]
+        resp = client.get(self.RESOURCE_URL + "?q=opening&thread=1")
+        assert resp.json["results"] == []
+
+        # Case 5
+        resp = client.get(self.RESOURCE_URL + "?q=")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?q=reply&thread=thread-1")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?q=reply&sender=²")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?q=reply&thread=99999999999999999999999")
+        assert resp.status_code == 400
+
+        # Case 6
+        content = '<script>alert("x")</script> \x02escaped\x03 & <b>bold</b>'
+        message = _get_message(message_content=content)
+        resp = client.post("/api/threads/thread-1/messages/", json=message)
+        assert resp.status_code == 201
+        resp = client.get(self.RESOURCE_URL + "?q=bold")
+        (result,) = resp.json["results"]
+        assert result["snippet"] == (
+            "&lt;script&gt;alert(&quot;x&quot;)&lt;/script&gt; "
+            "<mark>escaped</mark> &amp; &lt;b&gt;<mark>bold</mark>&lt;/b&gt;"
+        )
+
+
+class TestReactionSummary(object):
+    RESOURCE_URL = "/api/threads/thread-2/reactions/summary/"
+    INVALID_URL = "/api/threads/thread-4/reactions/summary/"
+
+    def test_get(self, client):
+        """
+        Tests get method for reaction summary.
+        Case 1: Get summary -> 200 with counts by message and type
+        Case 2: Get summary with API key -> 200 with the caller's reactions
+        Case 3: Get summary with wrong API key -> 403
+        Case 4: Get summary of non-existing thread -> 404
+        """
+        # Case 1
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.json == {"reactions": {"5": {"1": 2}, "8": {"1": 1}}}
+
+        # Case 2
+        resp = client.get(self.RESOURCE_URL, headers={"Api-key": KEY2})
+        assert resp.status_code == 200
+        assert resp.json["reacted"] == {}
+        resp = client.get(self.RESOURCE_URL, headers={"Api-key": KEY1})
+        assert resp.status_code == 200
+        assert resp.json["reacted"] == {"5": 1, "8": 1}
+
+        # Case 3
+        resp = client.get(self.RESOURCE_URL, headers={"Api-key": "wrong key"})
+        assert resp.status_code == 403
+
+        # Case 4
+        resp = client.get(self.INVALID_URL)
+        assert resp.status_code == 404
+
+
 class TestReactionItem(object):
     RESOURCE_URL = "/api/threads/thread-1/messages/message-1/reactions/2/"
     INVALID_URL = (
@@ -275,6 +677,8 @@ class TestReactionItem(object):
         Tests get method for user item.
         Case 1: Get existing user -> 200
         Case 2: Get non-existing user -> 404
+        Case 3: Get reaction through a message it doesn't belong to -> 404
+        Case 4: Get existing reaction as JSON -> 200 with a JSON body
         """
         # Case 1
         resp = client.get(self.RESOURCE_URL)
@@ -285,6 +689,20 @@ class TestReactionItem(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+        # Case 3
+        resp = client.get("/api/threads/thread-1/messages/message-4/reactions/2/")
+        assert resp.status_code == 404
+
+        # Case 4
+        resp = client.get(self.RESOURCE_URL, headers={"Accept": "application/json"})
+        assert resp.status_code == 200
+        assert resp.json == {
+            "reaction_id": 2,
+            "reaction_type": 1,
+            "user_id": 2,
+            "message_id": 1,
+        }
+
     def test_put(self, client):
         """
         Tests put method for user item.
@@ -293,6 +711,7 @@ class TestReactionItem(object):
         Case 3: Put non-json data -> 400/415
         Case 4: Put invalid user -> 400
         Case 5: Put to non-existing resource -> 404
+        Case 6: Change message_id -> 409 and the reaction stays at its URL
         """
         reaction = _get_reaction(reaction_type=1, user_id=1, message_id=1)
         # Case 1
@@ -319,6 +738,14 @@ class TestReactionItem(object):
         resp = client.put(self.INVALID_URL, json=reaction)
         assert resp.status_code == 404
 
+        # Case 6
+        reaction = _get_reaction(reaction_type=1, user_id=1, message_id=2)
+        resp = client.put(self.RESOURCE_URL, json=reaction)
+        assert resp.status_code == 409
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.headers["message_id"] == "1"
+
     def test_delete(self, client):
         """
         Tests delete method for user item.
@@ -383,6 +810,49 @@ class TestThreadCollection(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+    def test_get_batch(self, client):
+        """
+        Tests batch get method for thread collection.
+        Case 1: Get threads by ids -> 200
+        Case 2: Get thread ids with titles -> 200
+        Case 3: Too many ids or ids beyond 64 bits -> 400
+        Case 4: Invalid include -> 400
+        Case 5: Get thread ids with counts -> 200
+        """
+        # Case 1
+        resp = client.get(self.RESOURCE_URL + "?ids=2,1,2")
+        assert resp.status_code == 200
+        assert json.loads(resp.data) == [
+            {"thread_id": 2, "title": "Thread title 2"},
+            {"thread_id": 1, "title": "Thread title 1"},
+        ]
+
+        # Case 2
+        resp = client.get(self.RESOURCE_URL + "?include=title")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["thread_ids"] == [1, 2, 3]
+        assert body["threads"][2] == {"thread_id": 3, "title": "Thread title 3"}
+
+        # Case 3
+        ids = ",".join(str(id) for id in range(1, 1000))
+        resp = client.get(self.RESOURCE_URL + "?ids=" + ids)
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?ids=99999999999999999999999")
+        assert resp.status_code == 400
+
+        # Case 4
+        resp = client.get(self.RESOURCE_URL + "?include=messages")
+        assert resp.status_code == 400
+
+        # Case 5
+        resp = client.get(self.RESOURCE_URL + "?include=title,counts")
+        assert resp.status_code == 200
+        thread = json.loads(resp.data)["threads"][0]
+        assert thread["title"] == "Thread title 1"
+        assert thread["message_count"] == 4
+        assert thread["last_activity_at"] is not None
+
 
 class TestThreadItem(object):
     RESOURCE_URL = "/api/threads/thread-1/"
@@ -393,6 +863,8 @@ class TestThreadItem(object):
         Tests get method for thread item.
         Case 1: Get existing thread -> 200
         Case 2: Get non-existing thread -> 404
+        Case 3: Get with ids that aren't ASCII digits or don't fit 64 bits
+            -> 404
         """
         # Case 1
         resp = client.get(self.RESOURCE_URL)
@@ -403,6 +875,78 @@ class TestThreadItem(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+        # Case 3
+        for url in [
+            "/api/threads/thread-²/",
+            "/api/threads/thread-1/messages/message-²/",
+            "/api/threads/thread-1/messages/message-1/reactions/²/",
+            "/api/threads/thread-1/messages/message-4/media/²/",
+            "/api/threads/thread-99999999999999999999999/",
+            "/api/threads/thread-1/messages/message-9223372036854775808/",
+            "/api/threads/thread-1/messages/message-1/reactions/99999999999999999999999/",
+            "/api/threads/thread-1/messages/message-4/media/99999999999999999999999/",
+        ]:
+            resp = client.get(url)
+            assert resp.status_code == 404
+
+    def test_get_conditional(self, client):
+        """
+        Tests conditional get for thread item.
+        Case 1: Get with the current ETag -> 304
+        Case 2: Get with the ETag from before an update -> 200 with a new ETag
+        """
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+
+        # Case 1
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.headers["ETag"] == etag
+
+        # Case 2
+        client.put(self.RESOURCE_URL, json=_get_thread(title="New title"))
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+
+    def test_get_json(self, client):
+        """
+        Tests get method for thread item with a JSON body.
+        Case 1: Get with Accept: application/json -> 200 with a JSON body
+        Case 2: Get without an Accept header -> 200 with headers, other ETag
+        Case 3: Get with the ETag of the JSON body -> 304
+        Case 4: Get with the ETag of the headers asking for JSON -> 200
+        """
+        accept = {"Accept": "application/json"}
+
+        # Case 1
+        resp = client.get(self.RESOURCE_URL, headers=accept)
+        assert resp.status_code == 200
+        assert resp.mimetype == "application/json"
+        assert resp.json == {"thread_id": 1, "title": "Thread title 1"}
+        assert "title" not in resp.headers
+        assert "Accept" in resp.headers["Vary"]
+        etag = resp.headers["ETag"]
+
+        # Case 2
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.headers["title"] == "Thread title 1"
+        assert resp.data == b""
+        assert "Accept" in resp.headers["Vary"]
+        assert resp.headers["ETag"] != etag
+        headers_etag = resp.headers["ETag"]
+
+        # Case 3
+        resp = client.get(self.RESOURCE_URL, headers={**accept, "If-None-Match": etag})
+        assert resp.status_code == 304
+        assert "Accept" in resp.headers["Vary"]
+
+        # Case 4
+        resp = client.get(
+            self.RESOURCE_URL, headers={**accept, "If-None-Match": headers_etag}
+        )
+        assert resp.status_code == 200
+
     def test_put(self, client):
         """
         Tests put method for thread item.
@@ -438,13 +982,21 @@ class TestThreadItem(object):
     def test_delete(self, client):
         """
         Tests delete method for thread item.
-        Case 1: Delete existing thread -> 204
+        Case 1: Delete existing thread -> 202 with a job that deletes it
+            a chunk of messages at a time
         Case 2: Delete previously deleted thread -> 404
         Case 3: Delete non-existing resource -> 404
         """
         # Case 1
+        client.application.config.update(JOB_CHUNK_SIZE=1, JOB_CHUNK_DELAY=0)
+        messages = client.get(self.RESOURCE_URL + "messages/").json["message_ids"]
         resp = client.delete(self.RESOURCE_URL)
-        assert resp.status_code == 204
+        assert resp.status_code == 202
+        assert resp.json["status"] in ("pending", "running")
+        job = _finished_job(client, resp)
+        assert job["status"] == "done"
+        # The messages one at a time and the thread
+        assert job["deleted_rows"] == len(messages) + 1
 
         # Case 2
         resp = client.delete(self.RESOURCE_URL)
@@ -455,6 +1007,158 @@ class TestThreadItem(object):
         assert resp.status_code == 404
 
 
+class TestJobItem(object):
+    INVALID_URL = "/api/jobs/job-100/"
+
+    def test_get(self, client):
+        """
+        Tests get method for job item.
+        Case 1: Job of a deletion -> 200 with the job
+        Case 2: Deleting the same thread again before the job has run -> 202
+            with the same job
+        Case 3: Non-existing job or an id that isn't ASCII digits or doesn't
+            fit 64 bits -> 404
+        """
+        # Case 1
+        resp = client.delete("/api/threads/thread-2/")
+        location = resp.headers["Location"]
+        assert location.endswith(f"/api/jobs/job-{resp.json['job_id']}/")
+        job = _finished_job(client, resp)
+        assert job["target_id"] == 2
+        assert job["finished_at"] is not None
+
+        # Case 2
+        with client.application.app_context():
+            job, created = jobs.create_job("delete-thread", 3)
+            db.session.commit()
+            assert created
+            job_id = job.id
+        resp = client.delete("/api/threads/thread-3/")
+        assert resp.status_code == 202
+        assert resp.json["job_id"] == job_id
+        assert resp.json["status"] == "pending"
+
+        # Case 3
+        resp = client.get(self.INVALID_URL)
+        assert resp.status_code == 404
+        resp = client.get("/api/jobs/job-²/")
+        assert resp.status_code == 404
+        resp = client.get("/api/jobs/job-99999999999999999999999/")
+        assert resp.status_code == 404
+
+
+class TestThreadExport(object):
+    RESOURCE_URL = "/api/threads/thread-1/export/"
+    INVALID_URL = "/api/threads/thread-4/export/"
+
+    def test_get(self, client):
+        """
+        Tests get method for thread export.
+        Case 1: Export existing thread -> 200 with every row of the thread
+        Case 2: Export with gzip accepted -> 200 with gzip encoded body
+        Case 3: Export non-existing thread -> 404
+        """
+        # Case 1
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.mimetype == "application/x-ndjson"
+        rows = [json.loads(line) for line in resp.data.decode().splitlines()]
+        types = [row["type"] for row in rows]
+        assert types.count("thread") == 1
+        assert types.count("message") == 4
+        assert types.count("reaction") == 3
+        assert types.count("media") == 3
+
+        # Case 2
+        resp = client.get(self.RESOURCE_URL, headers={"Accept-Encoding": "gzip"})
+        assert resp.status_code == 200
+        assert resp.headers["Content-Encoding"] == "gzip"
+        lines = gzip.decompress(resp.data).decode().splitlines()
+        assert [json.loads(line) for line in lines] == rows
+
+        # Case 3
+        resp = client.get(self.INVALID_URL)
+        assert resp.status_code == 404
+
+
+def _read_event(stream):
+    """
+    Reads the next Server-Sent Events message from a streamed response,
+    skipping comments.
+    """
+    chunk = next(stream).decode()
+    while chunk.startswith(":"):
+        chunk = next(stream).decode()
+    fields = {}
+    for line in chunk.splitlines():
+        name, _, value = line.partition(": ")
+        fields[name] = value
+    return fields
+
+
+class TestThreadEvents(object):
+    RESOURCE_URL = "/api/threads/thread-1/events/"
+    INVALID_URL = "/api/threads/thread-4/events/"
+    MESSAGES_URL = "/api/threads/thread-1/messages/"
+
+    def test_get(self, client):
+        """
+        Tests get method for thread events.
+        Case 1: Message posted after connecting -> message.created event
+        Case 2: Reconnect with Last-Event-ID -> missed events are sent again
+        Case 3: Reconnect with unknown Last-Event-ID -> reset event
+        Case 4: No events -> keepalive comment
+        Case 5: Invalid Last-Event-ID -> 400
+        Case 6: Events of non-existing thread -> 404
+        """
+        # Case 1
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/event-stream"
+        stream = resp.iter_encoded()
+        location = client.post(self.MESSAGES_URL, json=_get_message()).location
+        client.post("/api/threads/thread-2/messages/", json=_get_message())
+        event = _read_event(stream)
+        assert event["event"] == "message.created"
+        data = json.loads(event["data"])
+        assert location.endswith(f"message-{data['message_id']}/")
+        resp.close()
+
+        # Case 2
+        headers = {"Last-Event-ID": str(int(event["id"]) - 1)}
+        resp = client.get(self.RESOURCE_URL, headers=headers)
+        stream = resp.iter_encoded()
+        client.delete(location)
+        assert _read_event(stream) == event
+        deleted = _read_event(stream)
+        assert deleted["event"] == "message.deleted"
+        assert json.loads(deleted["data"])["message_id"] == data["message_id"]
+        resp.close()
+
+        # Case 3
+        resp = client.get(self.RESOURCE_URL, headers={"Last-Event-ID": "100000"})
+        assert _read_event(resp.iter_encoded())["event"] == "reset"
+        resp.close()
+
+        # Case 4
+        client.application.config["EVENT_KEEPALIVE"] = 0.01
+        resp = client.get(self.RESOURCE_URL)
+        stream = resp.iter_encoded()
+        assert next(stream) == b": connected\n\n"
+        assert next(stream) == b": keepalive\n\n"
+        resp.close()
+
+        # Case 5
+        resp = client.get(self.RESOURCE_URL, headers={"Last-Event-ID": "abc"})
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL, headers={"Last-Event-ID": "²"})
+        assert resp.status_code == 400
+
+        # Case 6
+        resp = client.get(self.INVALID_URL)
+        assert resp.status_code == 404
+
+
 class TestMessageCollection(object):
     RESOURCE_URL = "/api/threads/thread-1/messages/"
     INVALID_URL = "/api/threads/thread-4/messages/"
@@ -493,12 +1197,332 @@ class TestMessageCollection(object):
         # Case 1
         resp = client.get(self.RESOURCE_URL)
         assert resp.status_code == 200
-        assert json.loads(resp.data)["message_ids"] == [1, 2, 3, 4]
+        # Messages are ordered by timestamp, the sample replies are not
+        # assigned ids in creation order
+        assert json.loads(resp.data)["message_ids"] == [1, 2, 4, 3]
 
         # Case 2
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+    def test_get_conditional(self, client):
+        """
+        Tests conditional get for message collection.
+        Case 1: Get with the current ETag -> 304
+        Case 2: Get after a reaction to a message of the thread -> 200
+        Case 3: Get after a message is added to another thread -> 304
+        """
+        url = self.RESOURCE_URL + "?expand=reaction_counts"
+        resp = client.get(url)
+        etag = resp.headers["ETag"]
+
+        # Case 1
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+
+        # Case 2
+        reaction = _get_reaction(reaction_type=1, user_id=3, message_id=2)
+        client.post(self.RESOURCE_URL + "message-2/reactions/", json=reaction)
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        etag = resp.headers["ETag"]
+
+        # Case 3
+        client.post("/api/threads/thread-2/messages/", json=_get_message())
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+
+    def test_get_pages(self, client):
+        """
+        Tests paginated get method for message collection.
+        Case 1: Get first page -> 200, next cursor and Link header
+        Case 2: Follow the Link header to the last page -> 200, no next cursor
+        Case 3: Invalid limit -> 400
+        Case 4: Invalid cursor or a cursor with an id beyond 64 bits -> 400
+        """
+        # Case 1
+        resp = client.get(self.RESOURCE_URL + "?limit=3")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["message_ids"] == [1, 2, 4]
+        assert body["next"]
+        link = resp.headers["Link"]
+        assert link.endswith('>; rel="next"')
+
+        # Case 2
+        resp = client.get(link[1 : link.index(">")])
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["message_ids"] == [3]
+        assert body["next"] is None
+        assert "Link" not in resp.headers
+
+        # Case 3
+        resp = client.get(self.RESOURCE_URL + "?limit=0")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?limit=abc")
+        assert resp.status_code == 400
+
+        # Case 4
+        resp = client.get(self.RESOURCE_URL + "?after=not-a-cursor")
+        assert resp.status_code == 400
+        cursor = encode_cursor("2020-01-01", 99999999999999999999999)
+        resp = client.get(self.RESOURCE_URL + "?after=" + cursor)
+        assert resp.status_code == 400
+        resp = client.get("/api/search/?q=reply&after=" + cursor)
+        assert resp.status_code == 400
+
+    def test_get_batch(self, client):
+        """
+        Tests batch get method for message collection.
+        Case 1: Get messages of the thread by ids -> 200
+        Case 2: Messages of other threads are not returned -> 200
+        """
+        # Case 1
+        resp = client.get(self.RESOURCE_URL + "?ids=2,1")
+        assert resp.status_code == 200
+        messages = json.loads(resp.data)
+        assert [message["message_id"] for message in messages] == [2, 1]
+        assert messages[1]["message_content"] == "Thread opening message"
+
+        # Case 2
+        resp = client.get(self.RESOURCE_URL + "?ids=1,5")
+        assert resp.status_code == 200
+        assert [message["message_id"] for message in json.loads(resp.data)] == [1]
+
+    def test_get_expanded(self, client):
+        """
+        Tests expanded get method for message collection.
+        Case 1: Get messages with content and reaction counts -> 200
+        Case 2: Get messages with only reaction counts -> 200
+        Case 3: Invalid expand field -> 400
+        """
+        # Case 1
+        resp = client.get(self.RESOURCE_URL + "?expand=content,reaction_counts")
+        assert resp.status_code == 200
+        messages = json.loads(resp.data)["messages"]
+        assert [message["message_id"] for message in messages] == [1, 2, 4, 3]
+        assert messages[0]["message_content"] == "Thread opening message"
+        assert messages[0]["parent_id"] is None
+        assert messages[1]["parent_id"] == 1
+        assert [message["reaction_count"] for message in messages] == [1, 1, 0, 1]
+
+        # Case 2
+        resp = client.get(self.RESOURCE_URL + "?expand=reaction_counts&limit=1")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["messages"] == [{"message_id": 1, "reaction_count": 1}]
+        assert body["next"]
+
+        # Case 3
+        resp = client.get(self.RESOURCE_URL + "?expand=everything")
+        assert resp.status_code == 400
+
+
+class TestMessageBulk(object):
+    RESOURCE_URL = "/api/threads/thread-1/messages/bulk/"
+    INVALID_URL = "/api/threads/thread-4/messages/bulk/"
+
+    def test_post(self, client):
+        """
+        Tests posting to bulk messages.
+        Case 1: Valid messages posted as JSON array -> 201
+        Case 2: Valid messages posted as NDJSON -> 201
+        Case 3: Mixed valid and invalid messages, including parent ids of the
+            wrong type and replies to messages of other threads -> 201 with
+            per-item errors
+        Case 4: Only invalid messages -> 400
+        Case 5: Non-json data posted -> 400/415
+        Case 6: Post to non-existing thread -> 404
+        """
+        # Case 1
+        messages = [_get_message(message_content=f"import {i}") for i in range(3)]
+        resp = client.post(self.RESOURCE_URL, json=messages)
+        assert resp.status_code == 201
+        body = resp.json
+        assert len(body["message_ids"]) == 3
+        assert [result["status"] for result in body["results"]] == [201] * 3
+        for message_id, message in zip(body["message_ids"], messages):
+            resp = client.get(f"/api/threads/thread-1/messages/message-{message_id}/")
+            assert resp.headers["message_content"] == message["message_content"]
+
+        # Case 2
+        data = "\n".join(json.dumps(message) for message in messages)
+        resp = client.post(
+            self.RESOURCE_URL, data=data, content_type="application/x-ndjson"
+        )
+        assert resp.status_code == 201
+        assert len(resp.json["message_ids"]) == 3
+
+        # Case 3
+        messages = [
+            _get_message(),
+            _get_message(message_content=None),
+            _get_message(sender_id=99),
+            _get_message(parent_id=999),
+            _get_message(parent_id=1),
+            _get_message(parent_id=[1]),
+            _get_message(parent_id="1"),
+            _get_message(parent_id=99999999999999999999999),
+            _get_message(sender_id=99999999999999999999999),
+            _get_message(parent_id=7),
+        ]
+        resp = client.post(self.RESOURCE_URL, json=messages)
+        assert resp.status_code == 201
+        statuses = [result["status"] for result in resp.json["results"]]
+        assert statuses == [201, 400, 409, 409, 201, 400, 400, 400, 400, 409]
+        assert len(resp.json["message_ids"]) == 2
+
+        # Case 4
+        resp = client.post(self.RESOURCE_URL, json=[_get_message(sender_id=99)])
+        assert resp.status_code == 400
+        assert resp.json["message_ids"] == []
+
+        # Case 5
+        resp = client.post(self.RESOURCE_URL, data="non-json data")
+        assert resp.status_code in [400, 415]
+
+        # Case 6
+        resp = client.post(self.INVALID_URL, json=[_get_message()])
+        assert resp.status_code == 404
+
+    def test_post_statements(self, client):
+        """
+        Tests that bulk messages are inserted with multi-row inserts.
+        Case 1: Post more messages than fit in one insert -> 201 with one
+            insert per BULK_INSERT_ROWS messages and ids in request order
+        """
+        messages = [
+            _get_message(message_content=f"import {i}")
+            for i in range(BULK_INSERT_ROWS + 50)
+        ]
+        statements = []
+
+        def listen(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        # Case 1
+        event.listen(Engine, "before_cursor_execute", listen)
+        try:
+            resp = client.post(self.RESOURCE_URL, json=messages)
+        finally:
+            event.remove(Engine, "before_cursor_execute", listen)
+        assert resp.status_code == 201
+        inserts = [s for s in statements if s.startswith("INSERT INTO message ")]
+        assert len(inserts) == 2
+        message_ids = resp.json["message_ids"]
+        assert message_ids == sorted(message_ids)
+        for index in (0, BULK_INSERT_ROWS, len(messages) - 1):
+            url = f"/api/threads/thread-1/messages/message-{message_ids[index]}/"
+            resp = client.get(url)
+            assert resp.headers["message_content"] == f"import {index}"
+
+
+class TestMessageTree(object):
+    RESOURCE_URL = "/api/threads/thread-2/tree/"
+    INVALID_URL = "/api/threads/thread-4/tree/"
+
+    def test_get(self, client):
+        """
+        Tests get method for thread reply tree.
+        Case 1: Get tree of existing thread -> 200 with nested messages
+        Case 2: Get tree with max_depth -> 200 without deeper replies
+        Case 3: Get tree with invalid max_depth -> 400
+        Case 4: Get tree of non-existing thread -> 404
+        """
+        # Case 1
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        (root,) = resp.json["messages"]
+        assert root["parent_id"] is None
+        assert root["depth"] == 0
+        assert root["reply_count"] == 2
+        assert root["reaction_count"] == 2
+        assert [reply["message_id"] for reply in root["replies"]] == [6, 7]
+        (deepest,) = root["replies"][1]["replies"]
+        assert deepest["message_id"] == 8
+        assert deepest["depth"] == 2
+
+        # Case 2
+        resp = client.get(self.RESOURCE_URL + "?max_depth=1")
+        assert resp.status_code == 200
+        (root,) = resp.json["messages"]
+        assert root["replies"][1]["reply_count"] == 1
+        assert root["replies"][1]["replies"] == []
+
+        # Case 3
+        resp = client.get(self.RESOURCE_URL + "?max_depth=-1")
+        assert resp.status_code == 400
+
+        # Case 4
+        resp = client.get(self.INVALID_URL)
+        assert resp.status_code == 404
+
+    def test_get_deep(self, client):
+        """
+        Tests get method for thread reply tree with a reply chain deeper than
+        MAX_TREE_DEPTH, encoded with every installed encoder.
+        Case 1: Get tree -> 200 with the chain cut at MAX_TREE_DEPTH
+        Case 2: Get subtree of the deepest returned message -> 200 with the
+            rest of the chain
+        """
+        with client.application.app_context():
+            thread = db.session.get(Thread, 2)
+            parent = db.session.get(Message, 8)
+            for i in range(MAX_TREE_DEPTH + 20):
+                parent = Message(
+                    message_content=f"Reply {i}",
+                    timestamp=datetime.now(),
+                    sender_id=1,
+                    thread=thread,
+                    parent=parent,
+                )
+                db.session.add(parent)
+            db.session.commit()
+
+        try:
+            for encoder in serialization.available_encoders():
+                serialization.configure(encoder)
+                # Case 1
+                resp = client.get(self.RESOURCE_URL)
+                assert resp.status_code == 200
+                node = resp.json["messages"][0]
+                while node["replies"]:
+                    node = node["replies"][-1]
+                assert node["depth"] == MAX_TREE_DEPTH
+                assert node["reply_count"] == 1
+
+                # Case 2
+                resp = client.get(
+                    f"/api/threads/thread-2/messages/message-{node['message_id']}/"
+                    "subtree/"
+                )
+                assert resp.status_code == 200
+                node = resp.json["message"]
+                while node["replies"]:
+                    node = node["replies"][-1]
+                assert node["message_content"] == f"Reply {MAX_TREE_DEPTH + 19}"
+        finally:
+            serialization.configure(client.application.config["JSON_ENCODER"])
+
+    def test_get_subtree(self, client):
+        """
+        Tests get method for message reply tree.
+        Case 1: Get subtree of existing message -> 200
+        Case 2: Get subtree through a thread the message doesn't belong to -> 404
+        """
+        # Case 1
+        resp = client.get("/api/threads/thread-2/messages/message-7/subtree/")
+        assert resp.status_code == 200
+        root = resp.json["message"]
+        assert root["message_id"] == 7
+        assert root["depth"] == 0
+        assert [reply["message_id"] for reply in root["replies"]] == [8]
+
+        # Case 2
+        resp = client.get("/api/threads/thread-1/messages/message-7/subtree/")
+        assert resp.status_code == 404
+
 
 class TestMessageItem(object):
     RESOURCE_URL = "/api/threads/thread-1/messages/message-1/"
@@ -509,6 +1533,8 @@ class TestMessageItem(object):
         Tests get method for message item.
         Case 1: Get existing message -> 200
         Case 2: Get non-existing message -> 404
+        Case 3: Get message through a thread it doesn't belong to -> 404
+        Case 4: Get existing message as JSON -> 200 with a JSON body
         """
         # Case 1
         resp = client.get(self.RESOURCE_URL)
@@ -519,6 +1545,50 @@ class TestMessageItem(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+        # Case 3
+        resp = client.get("/api/threads/thread-2/messages/message-1/")
+        assert resp.status_code == 404
+
+        # Case 4
+        timestamp = client.get(self.RESOURCE_URL).headers["timestamp"]
+        resp = client.get(self.RESOURCE_URL, headers={"Accept": "application/json"})
+        assert resp.status_code == 200
+        assert resp.json["message_content"] == "Thread opening message"
+        assert resp.json["timestamp"] == timestamp
+
+    def test_get_conditional_recreated(self, client):
+        """
+        Tests that ETags stay unique when the newest message is deleted and
+        another message is created.
+        Case 1: Get the new message with the deleted message's ETag -> 200
+        Case 2: Get the reactions of the new message with the ETag of the
+            deleted message's reactions -> 200
+        """
+        collection = "/api/threads/thread-1/messages/"
+        resp = client.post(collection, json=_get_message(message_content="first"))
+        url = resp.headers["Location"]
+        client.post(
+            url + "reactions/",
+            json=_get_reaction(message_id=int(url.split("-")[-1][:-1])),
+        )
+        etag = client.get(url).headers["ETag"]
+        reactions_etag = client.get(url + "reactions/").headers["ETag"]
+        assert client.delete(url).status_code == 204
+        resp = client.post(collection, json=_get_message(message_content="second"))
+        new_url = resp.headers["Location"]
+        assert new_url != url
+
+        # Case 1
+        resp = client.get(new_url, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.headers["message_content"] == "second"
+
+        # Case 2
+        resp = client.get(
+            new_url + "reactions/", headers={"If-None-Match": reactions_etag}
+        )
+        assert resp.status_code == 200
+
     def test_put(self, client):
         """
         Tests put method for message item.
@@ -584,6 +1654,7 @@ class TestMediaCollection(object):
     Case6: Invalid media_url empty -> 400
     Case7: Too long media_url -> 400
     Case8: No message with that ID/Conflict -> 409
+    Case9: Message of the body isn't the message of the URL -> 409
     """
 
     def test_post(self, client):
@@ -632,6 +1703,11 @@ class TestMediaCollection(object):
         resp = client.post(self.RESOURCE_URL, json=media)
         assert resp.status_code == 409
 
+        # Case9
+        media = _get_media(media_url=test_picture, message_id=1)
+        resp = client.post(self.RESOURCE_URL, json=media)
+        assert resp.status_code == 409
+
     def test_get(self, client):
         """
         Tests get method for media collection.
@@ -657,25 +1733,33 @@ class TestMediaItem(object):
         """
         Case1: Get valid media -> 200
         Case2: Get non-existing media -> 404
+        Case3: Get valid media as JSON -> 200 with a JSON body
         """
 
         # Case1
         resp = client.get(self.VALID_URL)
         assert resp.status_code == 200
+        assert resp.headers["media_id"] == resp.headers["media"] == "3"
 
         # Case2
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+        # Case3
+        resp = client.get(self.VALID_URL, headers={"Accept": "application/json"})
+        assert resp.status_code == 200
+        assert resp.json["media_id"] == 3
+        assert resp.json["message_id"] == 4
+        assert "media" not in resp.json
+
     def test_put(self, client):
         """
         Case1: Valid Put -> 204
-        Case2: Change message_id -> 204
+        Case2: Change message_id -> 409 and the media stays at its URL
         Case 3: Put non-json data -> 400/415
         Case 4: Put invalid media_url -> 400
         Case 5: Put to non-existing resource -> 404
         """
-
         test_picture = "https://upload.wikimedia.org/wikipedia/commons/5/51/Google.png"
         media = _get_media(media_url=test_picture, message_id=4)
         media1 = _get_media(media_url=test_picture, message_id=2)
@@ -687,8 +1771,10 @@ class TestMediaItem(object):
 
         # Case2
         resp = client.put(self.VALID_URL, json=media1)
-
-        assert resp.status_code == 204
+        assert resp.status_code == 409
+        resp = client.get(self.VALID_URL)
+        assert resp.status_code == 200
+        assert resp.headers["message_id"] == "4"
 
         # Case3
         resp = client.put(self.VALID_URL, json="non-json-data")
@@ -1,7 +1,10 @@
 import os
+import json
 import tempfile
 import pytest
+from datetime import datetime, timezone
 
+from src import serialization
 from src.utils import sample_database
 from src.app import create_app, db
 from src.models import Thread, Message, User, Reaction, Media
@@ -33,3 +36,32 @@ def test_sample_database(app):
         assert User.query.count() == 3
         assert Reaction.query.count() == 9
         assert Media.query.count() == 5
+
+
+def test_serialization(app):
+    """
+    Tests that every installed JSON encoder encodes the same values, with
+    datetimes as ISO 8601 strings, and that the fastest one is used by
+    default.
+    """
+    value = {
+        "timestamp": datetime(2024, 1, 2, 3, 4, 5, 678000),
+        "aware": datetime(2024, 1, 2, tzinfo=timezone.utc),
+        "text": 'hyvää päivää "quoted"\n',
+        1: [None, 1.5, True],
+    }
+    expected = {
+        "timestamp": "2024-01-02T03:04:05.678000",
+        "aware": "2024-01-02T00:00:00+00:00",
+        "text": 'hyvää päivää "quoted"\n',
+        "1": [None, 1.5, True],
+    }
+    assert serialization.encoder_name() == serialization.available_encoders()[0]
+    try:
+        for encoder in serialization.available_encoders():
+            serialization.configure(encoder)
+            assert json.loads(serialization.dumps(value)) == expected
+        with pytest.raises(ValueError):
+            serialization.configure("pickle")
+    finally:
+        serialization.configure(app.config["JSON_ENCODER"])
@@ -0,0 +1,37 @@
+import pytest
+from jsonschema import ValidationError
+
+from src.models import Message, Media
+from src.validation import compile_validators, validate_json, validation_stats
+
+
+def test_validate_json():
+    """
+    Tests validating documents with the compiled validators.
+    """
+    compile_validators()
+    message = {
+        "message_content": "message content",
+        "timestamp": "2023-01-01T00:00:00+00:00",
+        "sender_id": 1,
+    }
+    validate_json(message, Message)
+
+    message["timestamp"] = "not a timestamp"
+    with pytest.raises(ValidationError):
+        validate_json(message, Message)
+
+    with pytest.raises(ValidationError):
+        validate_json({"media_url": "image.gif", "message_id": 1}, Media)
+
+
+def test_validation_stats():
+    """
+    Tests that validation count and time are recorded for each model.
+    """
+    compile_validators()
+    before = validation_stats()["Media"]["count"]
+    validate_json({"media_url": "image.png", "message_id": 1}, Media)
+    stats = validation_stats()["Media"]
+    assert stats["count"] == before + 1
+    assert stats["time"] > 0